@@ -16,7 +16,9 @@ import argparse
 
 sys.path.append("../modules")
 from Common import orb
-from Common.nameServiceLocation import name_service_address
+from Common import tracing
+from Common import resolver
+from Common.nameServiceLocation import name_service_addresses
 from Common.objectType import object_type
 
 # -----------------------------------------------------------------------------
@@ -29,8 +31,9 @@ Client for a fortune database. It reads a random fortune from the database.\
 
 parser = argparse.ArgumentParser(description=description)
 parser.add_argument(
-    "-w", "--write", metavar="FORTUNE", dest="fortune",
-    help="Write a new fortune to the database."
+    "-w", "--write", metavar="FORTUNE", dest="fortunes", action="append",
+    help="Write a new fortune to the database. May be repeated to write "
+         "several fortunes in a single round trip."
 )
 parser.add_argument(
     "-i", "--interactive", action="store_true", dest="interactive",
@@ -44,36 +47,78 @@ parser.add_argument(
     "-p", "--peer", metavar="PEER_ID", dest="peer_id", type=int,
     help="The identifier of a particular server peer."
 )
+parser.add_argument(
+    "-T", "--trace", metavar="FILE", dest="trace", default=None,
+    help="Append the spans of traced calls to FILE (JSON lines). "
+         "Merge the files of all processes with traceMerge.py."
+)
 opts = parser.parse_args()
 
 server_type = opts.type
 server_id = opts.peer_id
 assert server_type != "object", "Change the object type to something unique!"
+if opts.trace:
+    tracing.configure(opts.trace, "client")
 
 # -----------------------------------------------------------------------------
 # The main program
 # -----------------------------------------------------------------------------
 
-# Connect to the name service to obtain the address of the server.
-ns = orb.Stub(name_service_address)
+# Obtain the address of the server from the name service. It picks the
+# least loaded server; the members it lists are cached, so later lookups
+# by id in interactive mode do not ask it again.
+names = resolver.Resolver(name_service_addresses)
 
-if server_id is None:
-    server_address = tuple(ns.require_any(server_type))
-else:
-    server_address = tuple(ns.require_object(server_type, server_id))
 
-print("Connecting to server: {}".format(server_address))
+def connect():
+    """Return a stub of a server, as chosen by the name service."""
+    if server_id is None:
+        server_address = names.require_any(server_type)
+    else:
+        server_address = names.require_object(server_type, server_id)
+    print("Connecting to server: {}".format(server_address))
+    return orb.Stub(server_address)
+
+
+def read():
+    """Read a fortune, moving to another server if this one is gone."""
+    global db
+    for attempt in range(3):
+        try:
+            return db.read()
+        except Exception as err:
+            if not resolver.connection_error(err) or attempt == 2:
+                raise
+            names.invalidate(db.address)
+            db = connect()
+
+
+def write(fortune):
+    """Write a fortune. A write is not retried, as it may have been done."""
+    global db
+    try:
+        db.write(fortune)
+    except Exception as err:
+        if resolver.connection_error(err):
+            names.invalidate(db.address)
+            db = connect()
+        raise
 
 # Create the database object.
-db = orb.Stub(server_address)
+db = connect()
 
 if not opts.interactive:
     # Run in the normal mode.
-    if opts.fortune is not None:
-        print("Writing '{}' to the fortune database.".format(opts.fortune))
-        db.write(opts.fortune)
+    if opts.fortunes is not None:
+        with db.batch() as batch:
+            for fortune in opts.fortunes:
+                print("Writing '{}' to the fortune database.".format(fortune))
+                batch.write(fortune)
+        for fortune, result in zip(opts.fortunes, batch.results):
+            if isinstance(result, orb.ExternalError):
+                print("Could not write '{}': {}".format(fortune, result))
     else:
-        print(db.read())
+        print(read())
 
 else:
     # Run in the interactive mode.
@@ -92,9 +137,9 @@ Choose one of the following commands:
         sys.stdout.write("Command> ")
         command = input()
         if command == "r":
-            print(db.read())
+            print(read())
         elif (len(command) > 1 and command[0] == "w" and
                 command[1] in [" ", "\t"]):
-            db.write(command[2:].strip())
+            write(command[2:].strip())
         elif command == "h":
             menu()
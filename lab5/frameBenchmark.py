@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Compare the ways of framing messages on a socket.
+
+Messages are sent over a local socket pair and read back on the other
+end, once with the stream wrapper of socket.makefile() and payloads
+built by concatenation, and once with wireCodec.FrameReader and frames
+encoded in place. Two workloads are measured: small control messages,
+like the token requests of the distributed lock, and large batches of
+fortunes, like the replies of readAll.
+"""
+
+import sys
+import time
+import socket
+import argparse
+import threading
+
+sys.path.append("../modules")
+from Common import wireCodec
+from Common import orb
+
+# -----------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# -----------------------------------------------------------------------------
+
+description = """\
+Measure the throughput of the old and the buffer-based message framing.\
+"""
+
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument(
+    "-n", "--small", metavar="COUNT", dest="small", type=int, default=50000,
+    help="Number of small control messages to send."
+)
+parser.add_argument(
+    "-b", "--batches", metavar="COUNT", dest="batches", type=int, default=20,
+    help="Number of fortune batches to send."
+)
+parser.add_argument(
+    "-s", "--size", metavar="MB", dest="size", type=float, default=4.0,
+    help="Approximate size of a fortune batch, in megabytes."
+)
+
+# -----------------------------------------------------------------------------
+# Auxiliary functions
+# -----------------------------------------------------------------------------
+
+
+def encode_concatenated(message):
+    """Encode a binary frame the way it was done before FrameReader."""
+    payload = wireCodec.encode_value(message)
+    return wireCodec.HEADER.pack(wireCodec.MAGIC, 0, len(payload)) + payload
+
+
+def encode_in_place(message):
+    return wireCodec.BINARY.encode(message)
+
+
+def read_with_makefile(sock, count):
+    reader = sock.makefile(mode="rb")
+    for _ in range(count):
+        codec, payload = wireCodec.read_frame(reader)
+        codec.decode(payload)
+    reader.close()
+
+
+def read_with_frame_reader(sock, count):
+    reader = wireCodec.FrameReader(sock)
+    for _ in range(count):
+        codec, payload = reader.read_frame()
+        codec.decode(payload)
+
+
+def run(messages, encode, read):
+    """Send messages through a socket pair; return (seconds, bytes)."""
+    left, right = socket.socketpair()
+    sent = [0]
+
+    def send():
+        for message in messages:
+            data = encode(message)
+            sent[0] += len(data)
+            left.sendall(data)
+
+    started = time.perf_counter()
+    sender = threading.Thread(target=send)
+    sender.start()
+    read(right, len(messages))
+    sender.join()
+    took = time.perf_counter() - started
+    left.close()
+    right.close()
+    return took, sent[0]
+
+
+def report(title, messages):
+    print(title)
+    for name, encode, read in (
+            ("makefile + concatenation", encode_concatenated, read_with_makefile),
+            ("FrameReader + in place", encode_in_place, read_with_frame_reader)):
+        took, size = run(messages, encode, read)
+        print("    {:<26} {:>12.0f} msgs/s {:>10.1f} MB/s".format(
+            name, len(messages) / took, size / took / 2 ** 20))
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    opts = parser.parse_args()
+
+    token = orb.make_method("request_token", [3, 1742], call_id=17, oneway=True)
+    report("Control messages ({}):".format(opts.small), [token] * opts.small)
+
+    fortune = "A fortune long enough to be a realistic line of the database."
+    lines = int(opts.size * 2 ** 20 / (len(fortune) + 3))
+    batch = {"result": [fortune] * lines, "id": 1}
+    report("Fortune batches ({} x {:.1f} MB):".format(opts.batches, opts.size),
+           [batch] * opts.batches)
@@ -18,7 +18,9 @@ import argparse
 
 sys.path.append("../modules")
 from Common import orb
-from Common.nameServiceLocation import name_service_address
+from Common import tracing
+from Common import wireCodec
+from Common.nameServiceLocation import name_service_addresses
 from Common.objectType import object_type
 
 from Server.peerList import PeerList
@@ -32,10 +34,16 @@ class Client(orb.Peer):
 
     """Distributed mutual exclusion client class."""
 
-    def __init__(self, local_address, ns_address, client_type):
+    # Calls that must be served while acquire() waits for the token.
+    priority_methods = orb.Peer.priority_methods | {
+        "request_token", "obtain_token", "membership_changed",
+        "swim_ping", "swim_ping_req"
+    }
+
+    def __init__(self, local_address, ns_address, client_type, gossip=False):
         """Initialize the client."""
         orb.Peer.__init__(self, local_address, ns_address, client_type)
-        self.peer_list = PeerList(self)
+        self.peer_list = PeerList(self, gossip)
         self.distributed_lock = DistributedLock(self, self.peer_list)
         self.dispatched_calls = {
             "display_peers":      self.peer_list.display_peers,
@@ -43,7 +51,10 @@ class Client(orb.Peer):
             "release":            self.distributed_lock.release,
             "request_token":      self.distributed_lock.request_token,
             "obtain_token":       self.distributed_lock.obtain_token,
-            "display_status":     self.distributed_lock.display_status
+            "display_status":     self.distributed_lock.display_status,
+            "membership_changed": self.peer_list.membership_changed,
+            "swim_ping":          self.peer_list.swim_ping,
+            "swim_ping_req":      self.peer_list.swim_ping_req
         }
         orb.Peer.start(self)
         self.peer_list.initialize()
@@ -65,8 +76,8 @@ class Client(orb.Peer):
             raise AttributeError(
                 "Client instance has no attribute '{}'".format(attr))
 
-    def register_peer(self, pid, paddr):
-        self.peer_list.register_peer(pid, paddr)
+    def register_peer(self, pid, paddr, local=None):
+        self.peer_list.register_peer(pid, paddr, local=local)
         self.distributed_lock.register_peer(pid)
 
     def unregister_peer(self, pid):
@@ -93,15 +104,37 @@ def main():
         "-t", "--type", metavar="TYPE", dest="type", default=object_type,
         help="Set the type of the client."
     )
+    parser.add_argument(
+        "-T", "--trace", metavar="FILE", dest="trace", default=None,
+        help="Append the spans of traced calls to FILE (JSON lines). "
+             "Merge the files of all processes with traceMerge.py."
+    )
+    parser.add_argument(
+        "-z", "--compress", action="store_true", dest="compress",
+        default=False,
+        help="Compress large messages exchanged with peers that support it."
+    )
+    parser.add_argument(
+        "-g", "--gossip", action="store_true", dest="gossip", default=False,
+        help="Detect failures and spread membership changes by gossip (SWIM) "
+             "instead of probing every peer."
+    )
     opts = parser.parse_args()
 
     local_port = opts.port
     client_type = opts.type
     assert client_type != "object", "Change the object type to something unique!"
+    if opts.compress:
+        wireCodec.use_compression()
+    if opts.trace:
+        tracing.configure(opts.trace, "{}@{}:{}".format(client_type,
+                                                        socket.gethostname(),
+                                                        local_port))
 
     # Initialize the client object.
     local_address = (socket.gethostname(), local_port)
-    p = Client(local_address, name_service_address, client_type)
+    p = Client(local_address, name_service_addresses, client_type,
+               opts.gossip)
 
 
 # -----------------------------------------------------------------------------
@@ -120,6 +153,9 @@ def main():
                 p.display_peers()
             elif command == "s":
                 p.display_status()
+                p.display_stats()
+            elif command == "c":
+                p.reset_stats()
             elif command == "a":
                 p.acquire()
             elif command == "r":
@@ -153,7 +189,8 @@ def menu():
     print("""\
 Choose one of the following commands:
     l  ::  list peers,
-    s  ::  display status,
+    s  ::  display status and RMI statistics,
+    c  ::  display and clear RMI statistics,
     a  ::  acquire the lock,
     r  ::  release the lock,
     h  ::  print this menu,
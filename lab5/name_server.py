@@ -4,19 +4,27 @@ Created on Sep 28, 2015
 @author: jackie
 '''
 
-import multiprocessing.dummy as multiprocessing
-import copy
-import socket
+import argparse
 import logging
 import sys
 sys.path.append("../modules")
 from Common import nameServiceLocation
-from Common.orb import Request
-from Common.orb import Stub
+from Common import tracing
+from Common import leaseTable
+from Common import journal
+from Common.orb import Skeleton
+from Common.orb import PooledSkeleton
+from Common.asyncOrb import AsyncSkeleton
 from Common.orb import ProtocolError
+from Common.orb import Stub
+from Common.orb import PEER_TIMEOUT
 from Common.readWriteLock import ReadWriteLock
 
 import random
+import time
+import threading
+import collections
+import queue
 
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
@@ -26,6 +34,71 @@ description = """\
 Name server for a group of peers. It allows peers to find each other by object_id.\
 """
 
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument(
+    "-w", "--workers", metavar="WORKERS", dest="workers", type=int,
+    default=None,
+    help="Serve requests with a pool of WORKERS threads instead of one "
+         "thread per connection."
+)
+parser.add_argument(
+    "-b", "--backlog", metavar="BACKLOG", dest="backlog", type=int,
+    default=128, help="Size of the accept backlog. Default: 128."
+)
+parser.add_argument(
+    "-q", "--queue", metavar="SIZE", dest="max_queue", type=int,
+    default=256,
+    help="Maximum number of requests waiting for a worker. Default: 256."
+)
+parser.add_argument(
+    "-a", "--asyncio", action="store_true", dest="use_asyncio",
+    default=False,
+    help="Serve all connections from an asyncio event loop."
+)
+parser.add_argument(
+    "-l", "--lease", metavar="SECONDS", dest="lease", type=float,
+    default=10.0,
+    help="Forget peers that have not renewed their registration for "
+         "SECONDS. Default: 10."
+)
+parser.add_argument(
+    "-s", "--select", metavar="POLICY", dest="select", default="p2c",
+    choices=["random", "p2c", "weighted"],
+    help="How require_any picks a peer: random, p2c (the less loaded of "
+         "two random peers) or weighted (at random, weighted by the "
+         "inverse of the load). Default: p2c."
+)
+parser.add_argument(
+    "-p", "--port", metavar="PORT", dest="port", type=int,
+    default=nameServiceLocation.name_service_address[1],
+    help="Set the port to listen to. Default: the port of "
+         "nameServiceLocation.name_service_address."
+)
+parser.add_argument(
+    "-f", "--follow", metavar="HOST:PORT", dest="follow", default=None,
+    help="Run as a follower of the primary name server at HOST:PORT: "
+         "serve lookups from a copy of its registry and forward "
+         "registrations to it."
+)
+parser.add_argument(
+    "-S", "--staleness", metavar="SECONDS", dest="staleness", type=float,
+    default=5.0,
+    help="A follower refuses lookups once it has not heard from the "
+         "primary for SECONDS, so that clients ask another name server. "
+         "Default: 5."
+)
+parser.add_argument(
+    "-j", "--journal", metavar="PREFIX", dest="journal", default=None,
+    help="Keep the registered peers in PREFIX.snapshot and PREFIX.journal "
+         "and load them again at startup. By default they are only kept "
+         "in memory."
+)
+parser.add_argument(
+    "-T", "--trace", metavar="FILE", dest="trace", default=None,
+    help="Append the spans of traced calls to FILE (JSON lines). "
+         "Merge the files of all processes with traceMerge.py."
+)
+
 server_address = nameServiceLocation.name_service_address
 
 # -----------------------------------------------------------------------------
@@ -34,34 +107,216 @@ server_address = nameServiceLocation.name_service_address
 
 logging.basicConfig(format="%(levelname)s:%(filename)s: %(message)s", level=logging.INFO)
 
-class NameServer(object):
-    """Class that handles peers."""
+# Number of membership changes kept per group for watch().
+CHANGE_LOG = 256
+
+# Number of journal records after which a snapshot is written.
+SNAPSHOT_EVERY = 1000
+
+# Number of changes the primary keeps for its followers.
+REPLICATION_LOG = 1024
+
+# Seconds a follower waits for changes in one call to replicate().
+FOLLOW_WAIT = 1.0
+
+# Seconds a push may take to reach a watcher before it is dropped.
+PUSH_TIMEOUT = 1.0
+
+
+class _Group(object):
+
+    """The peers registered with one object type.
 
-    # The dictionary self.peers assigns a set to each object type
-    # This set contains tuples that represent the peers of that type
-    # The tuple is of the id of that peer and their address (id, addr)
+    addresses maps the id of every peer to its address, and members
+    holds the same ids in an array, with index giving the position of
+    each id in it. Looking a peer up by id and picking a random peer
+    both take constant time; a peer is removed by moving the last
+    member into its slot.
+
+    Every change of the group gets the next version number and is kept
+    in a log of the last CHANGE_LOG changes, as a delta
+    [version, "join" or "leave", id, address, local]. Versions start
+    at the time the group is created, in milliseconds, so that they
+    keep growing across restarts of the name server.
+    """
+
+    def __init__(self):
+        self.addresses = {}     # id -> address
+        self.members = []       # ids, in no particular order
+        self.index = {}         # id -> position in members
+        self.version = int(time.time() * 1000)
+        self.base = self.version    # the log holds the changes after base
+        self.log = collections.deque()
+        self.watchers = set()   # addresses changes are pushed to
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, t):
+        obj_id, address = t
+        return self.addresses.get(obj_id) == address
+
+    def add(self, t):
+        obj_id, address = t
+        if obj_id not in self.addresses:
+            self.index[obj_id] = len(self.members)
+            self.members.append(obj_id)
+        self.addresses[obj_id] = address
+
+    def remove(self, t):
+        obj_id, _ = t
+        del self.addresses[obj_id]
+        position = self.index.pop(obj_id)
+        last = self.members.pop()
+        if last != obj_id:
+            self.members[position] = last
+            self.index[last] = position
+
+    def get(self, obj_id):
+        return self.addresses.get(obj_id)
+
+    def choice(self, rand):
+        """Return the (id, address) of a peer chosen at random."""
+        obj_id = self.members[rand.randrange(len(self.members))]
+        return obj_id, self.addresses[obj_id]
+
+    def pair(self, rand):
+        """Return the (id, address) of two different random peers."""
+        i = rand.randrange(len(self.members))
+        j = rand.randrange(len(self.members) - 1)
+        if j >= i:
+            j += 1
+        return [(obj_id, self.addresses[obj_id])
+                for obj_id in (self.members[i], self.members[j])]
+
+    def items(self):
+        return self.addresses.items()
+
+    def restore(self, version):
+        """Continue the numbering of changes after version."""
+        self.version = self.base = version
+        self.log.clear()
+
+    def record(self, kind, obj_id, address, local):
+        """Log a change of the group and return its delta."""
+        self.version += 1
+        delta = [self.version, kind, obj_id, address, local]
+        self.log.append(delta)
+        if len(self.log) > CHANGE_LOG:
+            self.base = self.log.popleft()[0]
+        return delta
+
+    def changes(self, since, local):
+        """Return (version, snapshot, deltas) for a watcher at since.
+
+        If the log does not reach back to since, the deltas are joins of
+        all the current members and snapshot is True.
+        """
+        if since is not None and self.base <= since <= self.version:
+            return self.version, False, [d for d in self.log if d[0] > since]
+        return self.version, True, [
+            [self.version, "join", obj_id, address, local.get(address)]
+            for obj_id, address in self.addresses.items()]
+
+
+class NameServer(object):
+    """Class that handles peers.
+
+    Every registration comes with a lease of lease_ttl seconds, which
+    the peer renews periodically. Peers whose lease runs out are removed
+    in the background, so requests never wait for liveness probes.
+
+    Renewals carry a load report of the peer, which require_any() uses
+    to steer clients away from busy peers, following the policy given
+    by select:
+
+    --  random ::
+            any peer, uniformly at random.
+    --  p2c ::
+            the less loaded of two peers picked at random (power of two
+            choices); the choice stays O(1) and clients do not all rush
+            to the peer that happened to report the lowest load.
+    --  weighted ::
+            a peer at random, with probabilities inversely proportional
+            to the loads. Looks at every peer of the type.
+
+    With a journal prefix, every join and leave is written to a
+    journal.Journal before it is answered, and the peers are loaded
+    again at startup, each with a new lease. A restarted name server so
+    keeps its ids, versions and members; the peers that died in the
+    meantime expire like any other.
+
+    A name server given the address of a primary is a follower of it.
+    It copies the registry of the primary with replicate(), a long poll
+    returning the changes since the last one, and serves lookups and
+    watches from its copy. Registrations are forwarded to the primary,
+    which alone keeps the leases. A follower that has not heard from the
+    primary for staleness seconds refuses lookups, so its answers are
+    never older than that.
+
+    Peers follow the changes of their group with watch(): it returns
+    the changes since a version and, given a callback address, also
+    pushes every later change there with a one-way call to
+    membership_changed(obj_type, deltas). Pushes are sent in order by a
+    background thread, so a watcher that does not answer never holds up
+    a registration, a renewal or an expiry.
+    """
+
+    # The dictionary self.peers assigns a _Group to each object type,
+    # which holds the ids of the peers of that type and their addresses.
 
     # So for example, self.peers could look like this:
 
     # obj_type (key)    | peers (entry)
     # ------------------+------------------------------------------------------
-    # [obj0]            | [ (0, addr0), (3, addr3) ]
-    # [obj1]            | [ (1, addr1), (4, addr4), (5, addr5) ]
-    # [obj2]            | [ (2, addr2) ]
+    # [obj0]            | { 0: addr0, 3: addr3 }
+    # [obj1]            | { 1: addr1, 4: addr4, 5: addr5 }
+    # [obj2]            | { 2: addr2 }
 
-    def __init__(self):
+    def __init__(self, lease_ttl=10.0, select="p2c", journal_prefix=None,
+                 primary=None, staleness=5.0):
         self.lock = ReadWriteLock()
-        self.peers = dict()         # Contains a set of peers for each object type
+        self.peers = dict()         # Contains a _Group for each object type
+        self.local = dict()         # address -> [host, path] of its Unix socket
+        self.loads = dict()         # address -> last load report
+        self.select = select
         self.responses = dict()
         self.next_id = 0
         self.rand = random.Random()
         self.rand.seed()
+        self.pushes = queue.Queue()     # (obj_type, delta, watchers)
+        pusher = threading.Thread(target=self._send_pushes, name="pusher")
+        pusher.daemon = True
+        pusher.start()
+        self.leases = leaseTable.LeaseTable(lease_ttl, self._expire)
+        self.leases.start()
+        self.journal = None
+        if journal_prefix is not None:
+            self._load(journal_prefix)
+        # Changes for the followers, numbered from the startup time (in
+        # ms) so that the numbers keep growing across restarts.
+        self.replicated = threading.Condition()
+        self.seq = int(time.time() * 1000)
+        self.changes = collections.deque()  # [seq, record]
+        self.primary = None
+        if primary is not None:
+            self.primary = Stub(primary, timeout=PEER_TIMEOUT)
+            self.staleness = staleness
+            self.heard = None   # time.monotonic() of the last reply
+            follower = threading.Thread(target=self._follow, name="follower")
+            follower.daemon = True
+            follower.start()
 
     # Public methods
 
-    def register(self, obj_type, address):
-        self._check_all_alive(obj_type) # Make sure everyone in our group is still alive
+    def register(self, obj_type, address, local=None):
+        """Register a peer; local is the [host, path] of its Unix socket.
 
+        Return (id, hash, ttl): the peer must call renew() more often
+        than every ttl seconds to stay registered.
+        """
+        if self.primary is not None:
+            return self.primary.call("register", obj_type, address, local)
         address = tuple(address)    # The address might come in as a list.
         logging.debug("NameServer registering peer at {}".format(address))
 
@@ -71,155 +326,433 @@ class NameServer(object):
         obj_id = self.next_id
         self.next_id += 1
         t = (obj_id, obj_hash)
+        if local is not None:
+            self.local[address] = local
+        group = self._get_group(obj_type)
+        group.add(t)
+        delta = self._record(obj_type, group, "join", obj_id, address, local)
         self.lock.write_release()
+        self._sync()
 
-        # We're adding the address to the group
-        group = self._get_group(obj_type)
-        self.lock.write_acquire() # Acquire the lock before we add ourselves to the group
-        group.add(t)              # Add ourselves
-        self.lock.write_release() # Release the lock
+        ttl = self.leases.grant((obj_type, t))
+        self._push(obj_type, delta)
 
         logging.info("NameServer done registering peer at {}".format(address))
-        return t
+        return t + (ttl,)
+
+    def renew(self, obj_id, obj_type, obj_hash, local=None, load=None):
+        """Renew the lease of a registered peer.
+
+        load is the report of orb.load_report(), if the peer sent one. A
+        peer whose lease has already expired, or that registered with
+        an earlier run of the name server, is registered again under its
+        old id, unless another peer holds that id by now. Return False in
+        that case: the peer must register() again to get a new id.
+        """
+        if self.primary is not None:
+            return self.primary.call("renew", obj_id, obj_type, obj_hash,
+                                     local, load)
+        t = (obj_id, tuple(obj_hash))
+        if load is not None:
+            self.lock.write_acquire()
+            self.loads[t[1]] = load
+            self.lock.write_release()
+        if self.leases.renew((obj_type, t)):
+            return True
+
+        self.lock.write_acquire()
+        for group in self.peers.values():
+            holder = group.get(obj_id)
+            if holder is not None and holder != t[1]:
+                self.lock.write_release()
+                logging.info("NameServer refusing the renewal of {}: id taken "
+                             "by {}".format(t, holder))
+                return False
+        logging.info("NameServer registering peer {} again".format(t))
+        self.next_id = max(self.next_id, obj_id + 1)
+        group = self._get_group(obj_type)
+        group.add(t)
+        if local is not None:
+            self.local[t[1]] = local
+        delta = self._record(obj_type, group, "join", obj_id, t[1], local)
+        self.lock.write_release()
+        self._sync()
+        self.leases.grant((obj_type, t))
+        self._push(obj_type, delta)
+        return True
 
     def unregister(self, obj_id, obj_type, obj_hash):
+        if self.primary is not None:
+            return self.primary.call("unregister", obj_id, obj_type, obj_hash)
         logging.debug("NameServer unregistering peer at {}".format(tuple(obj_hash)))
 
-        # Get the data necessary
-        group = self._get_group(obj_type)
         t = (obj_id, tuple(obj_hash))
 
         # Remove from the group (if it exists)
         self.lock.write_acquire()
-        if t in group:
-            group.remove(t)
-        else:
+        delta = self._remove(obj_type, t)
+        if delta is None:
             logging.debug("\nERR: Unregistering peer not registered!\n{}"
                           .format((obj_id,obj_type,obj_hash)))
         self.lock.write_release()
+        self._sync()
+        self.leases.revoke((obj_type, t))
+        if delta is not None:
+            self._push(obj_type, delta)
         logging.info("NameServer done unregistering peer at {}".format(tuple(obj_hash)))
-	# This function doesn't stop until every peer has been checked.
-        # BUT there's a peer out there waiting for this function to return
-        # Before it can be unregistered.
-        # This is very obnoxious.
-        self._check_all_alive(obj_type) # Make sure everyone in our group is still alive
         return "null"
 
     def get_peers(self, obj_type):
-        return list(self._get_group(obj_type))
+        """Return (id, address, local) for all the peers of obj_type."""
+        self._check_fresh()
+        self.lock.read_acquire()
+        try:
+            group = self.peers.get(obj_type)
+            if group is None:
+                return []
+            return [(obj_id, addr, self.local.get(addr))
+                    for obj_id, addr in group.items()]
+        finally:
+            self.lock.read_release()
 
-    def require_any(self, obj_type):
-        
+    def watch(self, obj_type, since_version=None, callback=None):
+        """Return the changes of the group of obj_type after since_version.
 
-        all_matching_peers = self.get_peers(obj_type)
-        idx = self.rand.randint(0,len(all_matching_peers)-1)
-        print("require_any returning {} of {}".format(idx,len(all_matching_peers)))
-        return all_matching_peers[idx][1] # Return only the address
+        Return (version, snapshot, deltas), each delta being
+        [version, "join" or "leave", id, address, local]. When the
+        changes since since_version are no longer known (or it is None),
+        snapshot is True and deltas holds a join for every member.
 
-    def require_object(self, server_type, server_id):
-        server_type_list = self.get_peers(server_type)
-        return server_type_list[server_id]
-        
-    def _get_group(self, obj_type):
-        # Create our group if it doesn't already exist
+        With a callback address, later changes are also pushed to it
+        until the peer at that address leaves or cannot be reached.
+        """
+        self._check_fresh()
         self.lock.write_acquire()
-        if obj_type not in self.peers.keys():
-            self.peers[obj_type] = set()
-        self.lock.write_release()
-
-        # Fetch and return the group
-        self.lock.read_acquire()
-        group = self.peers.get(obj_type)
-        self.lock.read_release()
-        return group
-
-    def _check_all_alive(self, obj_type):
-        logging.info("NameServer confirming connections to all peers" \
-                 + " of type {}.".format(obj_type))
-        group = copy.deepcopy(self._get_group(obj_type))
-        for peer in group:
-            self._check_alive(obj_type, peer)
-
-    def _check_alive(self, obj_type, peer):
-        logging.debug("NameServer confirming connection to peer {}.".format(peer[0]))
-        if not self._is_alive(obj_type, peer, 5):
-            t = peer
+        try:
             group = self._get_group(obj_type)
-            self.lock.write_acquire()
-            logging.info("Removing peer {}.".format(t))
-            group.remove(t)
+            if callback is not None:
+                group.watchers.add(tuple(callback))
+            return group.changes(since_version, self.local)
+        finally:
             self.lock.write_release()
 
-    def _is_alive(self, obj_type, peer, timeout=5):
+    def replicate(self, since=None, wait=0.0):
+        """Return the changes after since, for a follower.
+
+        Wait up to wait seconds for a change if there is none yet.
+        Return (seq, snapshot, records, loads): seq numbers the last
+        change, records holds [seq, record] for the changes after since
+        (journal records), loads the [address, load] of all the peers.
+        If the changes after since are no longer kept (or since is
+        None), snapshot is the whole registry instead, and records is
+        empty.
+        """
+        if self.primary is not None:
+            raise Exception("Not the primary; follow {}"
+                            .format(self.primary.address))
+        deadline = time.monotonic() + wait
+        with self.replicated:
+            while since == self.seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.replicated.wait(remaining)
+            oldest = self.changes[0][0] - 1 if self.changes else self.seq
+            records = None
+            if since is not None and oldest <= since <= self.seq:
+                records = [c for c in self.changes if c[0] > since]
+                seq = self.seq
+        self.lock.read_acquire()
         try:
-            parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
-            p = multiprocessing.Process(
-                target=self._get_line,
-                args=(child_conn, peer, obj_type)
-            )
-            p.daemon = True
-            p.start()
-            it_did_timeout = (not parent_conn.poll(timeout))
-            if it_did_timeout:
-                logging.info("Connection to peer {} timed out.".format(peer))
-                return False
-            else:
-                parent_said_yes = parent_conn.recv()
-                if not parent_said_yes:
-                    logging.info("No connection to peer {} established.".format(peer))
-                return parent_said_yes
-        except:
-            err = sys.exc_info()
-            logging.debug("NameServer encountered an error while spawning a process to check if peer {} is still alive:\n{}: {}"
-                          .format(peer, err[0], err[1]))
-            return False
-
-    def _get_line(self, conn, peer, obj_type):
-        result = False
+            snapshot = None
+            if records is None:
+                # The lock keeps self.seq in step with the registry.
+                snapshot, seq, records = self._snapshot(), self.seq, []
+            loads = [[address, load] for address, load in self.loads.items()]
+        finally:
+            self.lock.read_release()
+        return seq, snapshot, records, loads
+
+    def require_any(self, obj_type):
+        """Return the address of a peer of obj_type chosen at random."""
+        self._check_fresh()
+        self.lock.read_acquire()
         try:
-            expected = [peer[0], obj_type]
-            response = Stub(peer[1]).isAlive()
-            result = (response == expected)
-            logging.debug("NameServer received response {} from peer {}".format(response, peer))
-            if result is True:
-                logging.debug("This was the expected response.")
+            group = self.peers.get(obj_type)
+            if not group:
+                raise Exception("No peer of type: '{}'".format(obj_type))
+            if self.select == "p2c" and len(group) > 1:
+                obj_id, addr = min(group.pair(self.rand),
+                                   key=lambda peer: self._cost(peer[1]))
+            elif self.select == "weighted" and len(group) > 1:
+                peers = list(group.items())
+                weights = [1.0 / self._cost(addr) for _, addr in peers]
+                obj_id, addr = self.rand.choices(peers, weights)[0]
             else:
-                logging.debug("This was not the expected response.\n Expected response: {}"
-                              .format(expected))
-        except ConnectionRefusedError:
-            logging.info("Peer {} refused connection".format(peer))
-            result = False
-        except:
-            err = sys.exc_info()
-            logging.debug("NameServer encountered an error trying to check if peer {} is still alive:\n{}: {}"
-                         .format(peer, err[0], err[1]))
+                obj_id, addr = group.choice(self.rand)
         finally:
-            conn.send(result)
+            self.lock.read_release()
+        logging.debug("require_any returning peer {}".format(obj_id))
+        return addr
 
-# -----------------------------------------------------------------------------
-# The main program
-# -----------------------------------------------------------------------------
+    def require_object(self, server_type, server_id):
+        """Return the address of the peer of server_type with id server_id."""
+        self._check_fresh()
+        self.lock.read_acquire()
+        try:
+            group = self.peers.get(server_type)
+            addr = None if group is None else group.get(server_id)
+        finally:
+            self.lock.read_release()
+        if addr is None:
+            raise Exception("No peer of type '{}' with id: '{}'"
+                            .format(server_type, server_id))
+        return addr
 
-if __name__ == "__main__":
-    logging.info("NameServer listening to: {}:{}".format(server_address[0], server_address[1]))
+    # Private methods
 
-    nameserver = NameServer()
+    def _get_group(self, obj_type):
+        """Return the group of obj_type, creating it. Needs the write lock."""
+        group = self.peers.get(obj_type)
+        if group is None:
+            group = self.peers[obj_type] = _Group()
+        return group
 
-    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listener.bind(("", server_address[1]))
-    listener.listen(1)
+    def _remove(self, obj_type, t):
+        """Remove t from the group of obj_type and stop pushing to it.
 
-    logging.info("Press Ctrl-C to stop the name server...")
+        Return the delta of the change, or None if t was not in the
+        group. Needs the write lock.
+        """
+        group = self.peers.get(obj_type)
+        if group is None or t not in group:
+            return None
+        group.remove(t)
+        group.watchers.discard(t[1])
+        self.loads.pop(t[1], None)
+        local = self.local.pop(t[1], None)
+        return self._record(obj_type, group, "leave", t[0], t[1], local)
+
+    def close(self):
+        """Stop expiring leases and write what is left of the journal."""
+        self.leases.stop()
+        self.pushes.put(None)
+        if self.journal is not None:
+            self.journal.close()
+
+    def _record(self, obj_type, group, kind, obj_id, address, local):
+        """Log a change of group and journal it. Needs the write lock."""
+        delta = group.record(kind, obj_id, address, local)
+        record = {"type": obj_type, "delta": delta}
+        if self.journal is not None:
+            self.journal.append(record)
+            if self.journal.records >= SNAPSHOT_EVERY:
+                self.journal.compact(self._snapshot())
+        with self.replicated:
+            self.seq += 1
+            self.changes.append([self.seq, record])
+            if len(self.changes) > REPLICATION_LOG:
+                self.changes.popleft()
+            self.replicated.notify_all()
+        return delta
+
+    def _sync(self):
+        """Wait until the changes made so far are in the journal."""
+        if self.journal is not None:
+            self.journal.sync(self.journal.appended)
+
+    def _snapshot(self):
+        """Return the registry as JSON data. Needs the lock."""
+        return {
+            "next_id": self.next_id,
+            "groups": {
+                obj_type: {
+                    "version": group.version,
+                    "members": [[obj_id, address, self.local.get(address)]
+                                for obj_id, address in group.items()],
+                } for obj_type, group in self.peers.items()},
+        }
+
+    def _load(self, prefix):
+        """Load the registry from the journal at prefix, then compact it."""
+        self.journal = journal.Journal(prefix)
+        snapshot, records = self.journal.load()
+        self.lock.write_acquire()
+        try:
+            if snapshot is not None:
+                self._restore(snapshot)
+            for record in records:
+                self._replay(record["type"], record["delta"])
+            members = [(obj_type, t) for obj_type, group in self.peers.items()
+                       for t in group.items()]
+            self.journal.compact(self._snapshot())
+        finally:
+            self.lock.write_release()
+        for key in members:
+            self.leases.grant(key)
+        logging.info("NameServer loaded {} peers from {}".format(len(members),
+                                                                prefix))
+
+    def _restore(self, snapshot):
+        """Add the registry in snapshot. Needs the write lock."""
+        self.next_id = max(self.next_id, snapshot["next_id"])
+        for obj_type, state in snapshot["groups"].items():
+            group = self._get_group(obj_type)
+            group.restore(state["version"])
+            for obj_id, address, local in state["members"]:
+                group.add((obj_id, tuple(address)))
+                if local is not None:
+                    self.local[tuple(address)] = local
+
+    def _follow(self):
+        """Copy the changes of the primary, as long as this server runs."""
+        since = None
+        while True:
+            try:
+                seq, snapshot, records, loads = self.primary.call(
+                    "replicate", since, FOLLOW_WAIT, timeout=FOLLOW_WAIT + 5)
+            except Exception as err:
+                logging.info("Could not replicate {}: {}"
+                             .format(self.primary.address, err))
+                time.sleep(FOLLOW_WAIT / 2)
+                continue
+            changed = []
+            self.lock.write_acquire()
+            try:
+                if snapshot is not None:
+                    # Start over, keeping the watchers of every group.
+                    watchers = {obj_type: group.watchers
+                                for obj_type, group in self.peers.items()}
+                    self.peers, self.local = dict(), dict()
+                    self._restore(snapshot)
+                    for obj_type, addresses in watchers.items():
+                        self._get_group(obj_type).watchers = addresses
+                for _, record in records:
+                    delta = self._replay(record["type"], record["delta"])
+                    if delta is not None:
+                        changed.append((record["type"], delta))
+                self.loads = {tuple(address): load for address, load in loads}
+            finally:
+                self.lock.write_release()
+            since = seq
+            self.heard = time.monotonic()
+            for obj_type, delta in changed:
+                self._push(obj_type, delta)
+
+    def _check_fresh(self):
+        """Refuse to answer from a copy older than staleness seconds."""
+        if self.primary is None:
+            return
+        if self.heard is None:
+            raise Exception("No copy of the registry yet")
+        behind = time.monotonic() - self.heard
+        if behind > self.staleness:
+            raise Exception("Not heard from the primary for {:.1f} s"
+                            .format(behind))
+
+    def _replay(self, obj_type, delta):
+        """Apply a journaled change again, unless it is already applied.
+
+        Return the delta logged for the change, or None.
+        """
+        version, kind, obj_id, address, local = delta
+        address = tuple(address)
+        group = self.peers.get(obj_type)
+        if group is None:
+            group = self._get_group(obj_type)
+            group.restore(version - 1)
+        if version <= group.version:
+            return None
+        if kind == "join":
+            group.add((obj_id, address))
+            if local is not None:
+                self.local[address] = local
+            self.next_id = max(self.next_id, obj_id + 1)
+        elif (obj_id, address) in group:
+            group.remove((obj_id, address))
+            self.local.pop(address, None)
+        group.version = version - 1
+        return group.record(kind, obj_id, address, local)
+
+    def _cost(self, address):
+        """Expected time a new call would take at address, in seconds.
+
+        Every call in flight or waiting at the peer is assumed to take as
+        long as its recent p99. Peers that have not reported yet cost
+        the least, so that new peers get some work.
+        """
+        load = self.loads.get(address)
+        if load is None:
+            return 0.001
+        calls = 1 + load.get("in_flight", 0) + load.get("queue", 0)
+        return calls * max(load.get("p99", 0.0), 0.001)
+
+    def _push(self, obj_type, delta):
+        """Queue delta for the current watchers of obj_type."""
+        self.lock.read_acquire()
+        watchers = list(self.peers[obj_type].watchers)
+        self.lock.read_release()
+        if watchers:
+            self.pushes.put((obj_type, delta, watchers))
 
-    try:
+    def _send_pushes(self):
+        """Send the queued pushes, until close() is called."""
         while True:
-            conn, addr = listener.accept()
-            req = Request(nameserver, conn, addr)
-            logging.debug("NameServer serving a request from {}".format(addr))
-            req.start()
-            logging.debug("NameServer served the request from {}".format(addr))
-    except KeyboardInterrupt:
-        pass
-    finally:
-        listener.close()
-        logging.info("NameServer has been unbound")
+            push = self.pushes.get()
+            if push is None:
+                return
+            obj_type, delta, watchers = push
+            for address in watchers:
+                def failed(err, address=address):
+                    logging.info("Not pushing to {} any more: {}"
+                                 .format(address, err))
+                    self.lock.write_acquire()
+                    self.peers[obj_type].watchers.discard(address)
+                    self.lock.write_release()
+                stub = Stub(address, timeout=PUSH_TIMEOUT)
+                stub.call_oneway("membership_changed", obj_type, [delta],
+                                 on_failure=failed)
+
+    def _expire(self, key):
+        """Called by the lease table for a peer that stopped renewing."""
+        obj_type, t = key
+        self.lock.write_acquire()
+        delta = self._remove(obj_type, t)
+        self.lock.write_release()
+        if delta is not None:
+            logging.info("Removing peer {}.".format(t))
+            self._push(obj_type, delta)
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    opts = parser.parse_args()
+    primary = None
+    if opts.follow is not None:
+        if opts.journal is not None:
+            parser.error("a follower keeps no journal; it copies the primary")
+        host, _, port = opts.follow.rpartition(":")
+        primary = (host or server_address[0], int(port))
+    if opts.trace:
+        tracing.configure(opts.trace, "name_server")
+    logging.info("NameServer listening to: {}:{}".format(server_address[0], opts.port))
+
+    nameserver = NameServer(opts.lease, opts.select, opts.journal, primary,
+                            opts.staleness)
+
+    listen_address = ("", opts.port)
+    if opts.use_asyncio:
+        skeleton = AsyncSkeleton(nameserver, listen_address, opts.backlog,
+                                 opts.workers or 32)
+    elif opts.workers:
+        skeleton = PooledSkeleton(nameserver, listen_address, opts.workers,
+                                  opts.backlog, opts.max_queue)
+    else:
+        skeleton = Skeleton(nameserver, listen_address, opts.backlog)
+
+    # Serve from the main thread; Skeleton.run() returns on Ctrl-C.
+    skeleton.run()
+    nameserver.close()
+    logging.info("NameServer has been unbound")
@@ -24,11 +24,14 @@ import argparse
 
 sys.path.append("../modules")
 from Common import orb
-from Common.nameServiceLocation import name_service_address
+from Common import tracing
+from Common import wireCodec
+from Common.nameServiceLocation import name_service_addresses
 from Common.objectType import object_type
 
 from Server import database
 from Server.peerList import PeerList
+from Server import readWorker
 from Server.Lock.distributedLock import DistributedLock
 from Server.Lock.distributedReadWriteLock import DistributedReadWriteLock
 
@@ -54,12 +57,53 @@ parser.add_argument(
     "-f", "--file", metavar="FILE", dest="file", default="dbs/fortune.db",
     help="Set the database file. Default: dbs/fortune.db."
 )
+parser.add_argument(
+    "-w", "--workers", metavar="WORKERS", dest="workers", type=int,
+    default=None,
+    help="Serve requests with a pool of WORKERS threads instead of one "
+         "thread per connection."
+)
+parser.add_argument(
+    "-a", "--asyncio", action="store_true", dest="use_asyncio",
+    default=False,
+    help="Serve all connections from an asyncio event loop. With -w, "
+         "WORKERS bounds the threads running blocking requests."
+)
+parser.add_argument(
+    "-T", "--trace", metavar="FILE", dest="trace", default=None,
+    help="Append the spans of traced calls to FILE (JSON lines). "
+         "Merge the files of all processes with traceMerge.py."
+)
+parser.add_argument(
+    "-z", "--compress", action="store_true", dest="compress", default=False,
+    help="Compress large messages exchanged with peers that support it."
+)
+parser.add_argument(
+    "-P", "--processes", metavar="COUNT", dest="processes", type=int,
+    default=0,
+    help="Fork COUNT extra processes listening to the same port, which "
+         "serve reads from their own copy of the database and forward "
+         "everything else to this one."
+)
+parser.add_argument(
+    "-g", "--gossip", action="store_true", dest="gossip", default=False,
+    help="Detect failures and spread membership changes by gossip (SWIM) "
+         "instead of probing every peer."
+)
 opts = parser.parse_args()
 
 local_port = opts.port
 db_file = opts.file
 server_type = opts.type
+workers = opts.workers
+use_asyncio = opts.use_asyncio
 assert server_type != "object", "Change the object type to something unique!"
+if opts.compress:
+    wireCodec.use_compression()
+if opts.trace:
+    tracing.configure(opts.trace, "{}@{}:{}".format(server_type,
+                                                    socket.gethostname(),
+                                                    local_port))
 
 
 # -----------------------------------------------------------------------------
@@ -71,11 +115,20 @@ class Server(orb.Peer):
 
     """Distributed mutual exclusion client class."""
 
-    def __init__(self, local_address, ns_address, server_type, db_file):
+    # Calls that must be served while writes wait for the token.
+    priority_methods = orb.Peer.priority_methods | {
+        "request_token", "obtain_token", "membership_changed",
+        "swim_ping", "swim_ping_req", "write_local"
+    }
+
+    def __init__(self, local_address, ns_address, server_type, db_file,
+                 workers=None, use_asyncio=False, reuse_port=False,
+                 gossip=False):
         """Initialize the client."""
 
-        orb.Peer.__init__(self, local_address, ns_address, server_type)
-        self.peer_list = PeerList(self)
+        orb.Peer.__init__(self, local_address, ns_address, server_type,
+                          workers, use_asyncio, reuse_port=reuse_port)
+        self.peer_list = PeerList(self, gossip)
         self.distributed_lock = DistributedLock(self, self.peer_list)
         self.drwlock = DistributedReadWriteLock(self.distributed_lock)
         self.db = database.Database(db_file)
@@ -85,7 +138,10 @@ class Server(orb.Peer):
             "release":            self.distributed_lock.release,
             "request_token":      self.distributed_lock.request_token,
             "obtain_token":       self.distributed_lock.obtain_token,
-            "display_status":     self.distributed_lock.display_status
+            "display_status":     self.distributed_lock.display_status,
+            "membership_changed": self.peer_list.membership_changed,
+            "swim_ping":          self.peer_list.swim_ping,
+            "swim_ping_req":      self.peer_list.swim_ping_req
         }
         orb.Peer.start(self)
         self.peer_list.initialize()
@@ -129,13 +185,15 @@ class Server(orb.Peer):
 
         """
 
-        self.drwlock.write_acquire()
-        self.db.write(fortune)
-
-        peers = self.peer_list.get_peers().values()
-        for peer in peers:
-            peer.write_local(fortune)
-        self.drwlock.write_release()
+        with tracing.span("write_acquire"):
+            self.drwlock.write_acquire()
+        try:
+            self.db.write(fortune)
+            with tracing.span("replicate"):
+                outcome = self.peer_list.broadcast("write_local", fortune)
+        finally:
+            self.drwlock.write_release()
+        outcome.raise_error()
 
         return(True)
 
@@ -155,10 +213,10 @@ class Server(orb.Peer):
 
         return(True)
 
-    def register_peer(self, pid, paddr):
+    def register_peer(self, pid, paddr, local=None):
         """Register a server peer in this server's peer list."""
 
-        self.peer_list.register_peer(pid, paddr)
+        self.peer_list.register_peer(pid, paddr, local=local)
         self.distributed_lock.register_peer(pid)
 
     def unregister_peer(self, pid):
@@ -173,14 +231,22 @@ class Server(orb.Peer):
 
 # Initialize the client object.
 local_address = (socket.gethostname(), local_port)
-p = Server(local_address, name_service_address, server_type, db_file)
+if opts.processes > 0:
+    # Fork before any thread is started.
+    readWorker.start_workers(opts.processes,
+                             orb.external_interface(local_address), db_file,
+                             workers, use_asyncio)
+p = Server(local_address, name_service_addresses, server_type, db_file,
+           workers, use_asyncio, reuse_port=opts.processes > 0,
+           gossip=opts.gossip)
 
 
 def menu():
     print("""\
 Choose one of the following commands:
     l  ::  list peers,
-    s  ::  display status,
+    s  ::  display status and RMI statistics,
+    c  ::  display and clear RMI statistics,
     h  ::  print this menu,
     q  ::  exit.\
 """)
@@ -196,6 +262,9 @@ while command != "q":
             p.display_peers()
         elif command == "s":
             p.display_status()
+            p.display_stats()
+        elif command == "c":
+            p.reset_stats()
         elif command == "h":
             menu()
     except KeyboardInterrupt:
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Unit tests of the snapshot and journal files of journal.Journal.
+
+Run from this directory with: python3 -m unittest testJournal
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "modules"))
+from Common import journal
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.directory, "ns")
+        self.journals = []
+
+    def tearDown(self):
+        for j in self.journals:
+            j.close()
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        """Return a new Journal on prefix and what it loaded."""
+        j = journal.Journal(self.prefix)
+        self.journals.append(j)
+        snapshot, records = j.load()
+        return j, snapshot, records
+
+    def reopen(self, j):
+        j.close()
+        self.journals.remove(j)
+        return self.open()
+
+    def test_empty(self):
+        j, snapshot, records = self.open()
+        self.assertIsNone(snapshot)
+        self.assertEqual(records, [])
+
+    def test_replay(self):
+        j, _, _ = self.open()
+        written = [{"type": "server", "delta": [i, "join", i, ["h", i]]}
+                   for i in range(10)]
+        for record in written:
+            seq = j.append(record)
+        j.sync(seq)
+        j, snapshot, records = self.reopen(j)
+        self.assertIsNone(snapshot)
+        self.assertEqual(records, written)
+
+    def test_concurrent_appends_are_all_durable(self):
+        j, _, _ = self.open()
+
+        def writer(n):
+            for i in range(50):
+                j.sync(j.append([n, i]))
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        j, _, records = self.reopen(j)
+        self.assertEqual(sorted(records),
+                         sorted([n, i] for n in range(4) for i in range(50)))
+
+    def test_torn_last_record(self):
+        j, _, _ = self.open()
+        j.sync(j.append({"n": 1}))
+        j.sync(j.append({"n": 2}))
+        j.close()
+        self.journals.remove(j)
+        with open(self.prefix + ".journal", "ab") as f:
+            f.write(b'{"n":3,"de')
+        j, _, records = self.open()
+        self.assertEqual(records, [{"n": 1}, {"n": 2}])
+
+    def test_snapshot(self):
+        j, _, _ = self.open()
+        j.sync(j.append({"n": 1}))
+        j.compact({"state": [1]})
+        j.sync(j.append({"n": 2}))
+        j, snapshot, records = self.reopen(j)
+        self.assertEqual(snapshot, {"state": [1]})
+        self.assertEqual(records, [{"n": 2}])
+
+    def test_snapshot_replaces_the_previous_one(self):
+        j, _, _ = self.open()
+        j.compact({"state": [1]})
+        j.compact({"state": [1, 2]})
+        j, snapshot, records = self.reopen(j)
+        self.assertEqual(snapshot, {"state": [1, 2]})
+        self.assertEqual(records, [])
+        self.assertFalse(os.path.exists(self.prefix + ".snapshot.tmp"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Unit tests of the message framing of wireCodec.
+
+Run from this directory with: python3 -m unittest testWireCodec
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "modules"))
+from Common import wireCodec
+
+
+MESSAGES = [
+    {"method": "write", "args": ["A fortune.\n%\n"], "id": 3},
+    {"result": [1, -2, 2 ** 70, 0.5, None, True, False]},
+    {"result": {"ids": [1, 2, 3], "names": ["a", "b"], "blob": "x" * 5000}},
+    {"method": "obtain_token", "args": [[[0, 4], [1, 7]]], "oneway": True},
+]
+
+
+class ChunkedSocket(object):
+
+    """Socket stand-in whose recv_into() returns data in given chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        n = min(len(chunk), len(view))
+        view[:n] = chunk[:n]
+        if n < len(chunk):
+            self.chunks.insert(0, chunk[n:])
+        return n
+
+
+def chunks_of(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def read_all(reader):
+    messages = []
+    while True:
+        codec, payload = reader.read_frame()
+        if codec is None:
+            return messages
+        messages.append(codec.decode(payload))
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for codec in (wireCodec.JSON, wireCodec.BINARY, wireCodec.ZLIB):
+            for message in MESSAGES:
+                frames, used = wireCodec.split_frames(codec.encode(message))
+                self.assertEqual(len(frames), 1)
+                frame_codec, payload = frames[0]
+                self.assertEqual(frame_codec.decode(payload), message)
+
+    def test_large_message_is_compressed(self):
+        message = {"result": "fortune " * 1000}
+        data = wireCodec.ZLIB.encode(message)
+        self.assertLess(len(data), len(wireCodec.BINARY.encode(message)))
+        [(codec, payload)], _ = wireCodec.split_frames(data)
+        self.assertEqual(codec.decode(payload), message)
+
+    def test_bad_payload(self):
+        with self.assertRaises(wireCodec.CodecError):
+            wireCodec.decode_value(b"\xff")
+        with self.assertRaises(wireCodec.CodecError):
+            wireCodec.decode_value(wireCodec.encode_value("truncated")[:-2])
+
+
+class SplitFramesTest(unittest.TestCase):
+
+    def test_mixed_codecs(self):
+        data = b"".join(codec.encode(message) for message, codec in
+                        zip(MESSAGES, (wireCodec.JSON, wireCodec.BINARY,
+                                       wireCodec.ZLIB, wireCodec.JSON)))
+        frames, used = wireCodec.split_frames(bytearray(data))
+        self.assertEqual(used, len(data))
+        self.assertEqual([codec.decode(payload) for codec, payload in frames],
+                         MESSAGES)
+
+    def test_incomplete_frames_are_left(self):
+        first = wireCodec.BINARY.encode(MESSAGES[0])
+        for data in (first, wireCodec.JSON.encode(MESSAGES[1])):
+            for cut in (1, wireCodec.HEADER.size - 1, len(data) - 1):
+                frames, used = wireCodec.split_frames(first + data[:cut])
+                self.assertEqual(len(frames), 1)
+                self.assertEqual(used, len(first))
+
+    def test_unknown_flags(self):
+        data = wireCodec.HEADER.pack(wireCodec.MAGIC, 0x80, 0)
+        with self.assertRaises(wireCodec.CodecError):
+            wireCodec.split_frames(data)
+
+
+class FrameReaderTest(unittest.TestCase):
+
+    def encoded(self):
+        return b"".join(codec.encode(message)
+                        for codec in (wireCodec.BINARY, wireCodec.JSON)
+                        for message in MESSAGES)
+
+    def test_partial_reads(self):
+        data = self.encoded()
+        for size in (1, 3, 7, 64, len(data)):
+            reader = wireCodec.FrameReader(ChunkedSocket(chunks_of(data, size)),
+                                           size=256)
+            self.assertEqual(read_all(reader), MESSAGES * 2)
+
+    def test_frame_larger_than_buffer(self):
+        message = {"result": ["fortune %d" % i for i in range(2000)]}
+        data = wireCodec.BINARY.encode(message) + wireCodec.JSON.encode(message)
+        reader = wireCodec.FrameReader(ChunkedSocket(chunks_of(data, 1000)),
+                                       size=128)
+        self.assertEqual(read_all(reader), [message, message])
+
+    def test_closed_in_the_middle_of_a_frame(self):
+        data = wireCodec.BINARY.encode(MESSAGES[0])
+        reader = wireCodec.FrameReader(ChunkedSocket([data[:-1]]))
+        with self.assertRaises(wireCodec.CodecError):
+            reader.read_frame()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Merge the trace files written by the peers into per-trace timelines.
+
+Every process started with -T/--trace appends its spans to its own
+file. This tool reads any number of them and prints, for each trace,
+the tree of its spans ordered by start time: the offset from the start
+of the trace, the duration, the time not covered by child spans (where
+a slow hop shows up), and the process that recorded it.
+"""
+
+import sys
+import json
+import argparse
+
+# -----------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# -----------------------------------------------------------------------------
+
+description = """\
+Merge span files written with -T/--trace into one timeline per trace.\
+"""
+
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument(
+    "files", metavar="FILE", nargs="+",
+    help="Trace files written by the peers, clients and name server."
+)
+parser.add_argument(
+    "-t", "--trace", metavar="TRACE_ID", dest="trace", default=None,
+    help="Only show the trace with this id (a prefix is enough)."
+)
+parser.add_argument(
+    "-n", "--last", metavar="COUNT", dest="last", type=int, default=None,
+    help="Only show the COUNT most recent traces."
+)
+parser.add_argument(
+    "-s", "--slowest", metavar="COUNT", dest="slowest", type=int,
+    default=None, help="Only show the COUNT longest traces."
+)
+
+# -----------------------------------------------------------------------------
+# Auxiliary functions
+# -----------------------------------------------------------------------------
+
+
+def load(paths):
+    """Return {trace id: [span, ...]} for all the spans in paths."""
+    traces = {}
+    for path in paths:
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    print("{}:{}: skipping a malformed span".format(path, number),
+                          file=sys.stderr)
+                    continue
+                traces.setdefault(span["trace"], []).append(span)
+    return traces
+
+
+def trace_bounds(spans):
+    start = min(s["start"] for s in spans)
+    end = max(s["start"] + s["duration"] for s in spans)
+    return start, end
+
+
+def print_trace(trace_id, spans):
+    start, end = trace_bounds(spans)
+    ids = set(s["span"] for s in spans)
+    children = {}
+    roots = []
+    for s in spans:
+        if s["parent"] in ids:
+            children.setdefault(s["parent"], []).append(s)
+        else:
+            # Root, or a child of a span from a file we were not given.
+            roots.append(s)
+
+    print("Trace {} ({} spans, {:.3f} ms)".format(
+        trace_id, len(spans), (end - start) * 1000))
+    print("  {:>10} {:>10} {:>10}  {:<24} {}".format(
+        "offset ms", "took ms", "self ms", "service", "span"))
+
+    def show(s, depth):
+        kids = sorted(children.get(s["span"], []), key=lambda c: c["start"])
+        covered = sum(c["duration"] for c in kids)
+        self_time = max(s["duration"] - covered, 0.0)
+        name = "{}{} {}{}".format("  " * depth, s["kind"], s["name"],
+                                  "  !{}".format(s["error"]) if s.get("error") else "")
+        print("  {:>10.3f} {:>10.3f} {:>10.3f}  {:<24} {}".format(
+            (s["start"] - start) * 1000, s["duration"] * 1000,
+            self_time * 1000, str(s.get("service")), name))
+        for c in kids:
+            show(c, depth + 1)
+
+    for root in sorted(roots, key=lambda s: s["start"]):
+        show(root, 0)
+    print()
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    opts = parser.parse_args()
+    traces = load(opts.files)
+
+    selected = sorted(traces.items(), key=lambda t: trace_bounds(t[1])[0])
+    if opts.trace is not None:
+        selected = [t for t in selected if t[0].startswith(opts.trace)]
+    if opts.slowest is not None:
+        selected.sort(key=lambda t: -(trace_bounds(t[1])[1] - trace_bounds(t[1])[0]))
+        selected = selected[:opts.slowest]
+    if opts.last is not None:
+        selected = selected[-opts.last:]
+
+    for trace_id, spans in selected:
+        print_trace(trace_id, spans)
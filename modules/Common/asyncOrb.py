@@ -0,0 +1,347 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Object Request Broker running on an asyncio event loop.
+
+This module provides the same contract as orb, and speaks the same
+newline-separated JSON protocol, so asyncio and thread based peers can
+talk to each other freely. A single event loop serves every connection,
+which lets one process hold thousands of idle or slow connections
+without an OS thread for each of them. AsyncSkeleton also accepts the
+binary frames of wireCodec; AsyncStub always sends JSON.
+
+--  AsyncSkeleton ::
+        Listens to an address and forwards incoming calls to the owner.
+        Coroutine methods of the owner are awaited on the loop, plain
+        (blocking) methods are run on a bounded thread pool so they
+        cannot stall the loop. Priority calls (see orb.is_priority())
+        get a small pool of their own.
+--  AsyncStub ::
+        Image of a remote object for coroutines: every remote method is
+        awaitable, and many calls can be in flight at once, e.g.
+        await asyncio.gather(*[s.isAlive() for s in stubs]).
+"""
+
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from json import JSONDecodeError
+
+from . import orb
+from . import rmiMetrics
+from . import tracing
+from . import wireCodec
+
+# Longest line accepted by the stream readers (the asyncio default is
+# only 64 KiB, too small for bulk fortune transfers).
+LINE_LIMIT = 2 ** 24
+
+
+class AsyncSkeleton(threading.Thread):
+    """ Skeleton serving all its connections from one event loop.
+
+    Like orb.Skeleton it is a thread, so an orb.Peer can start it the
+    same way; run() may also be called directly to serve from the
+    current thread. Requests without a call id are answered in order,
+    multiplexed calls run concurrently. If local_path is given,
+    connections are also accepted on a Unix domain socket at that path.
+    reuse_port lets several processes listen to address.
+    """
+
+    def __init__(self, owner, address, backlog=128, workers=32,
+                 idle_timeout=60.0, local_path=None, reuse_port=False,
+                 reserved_workers=4):
+        logging.debug("AsyncSkeleton.__init__()")
+        threading.Thread.__init__(self)
+        self.owner = owner
+        self.address = address
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.local_path = local_path
+        self.reuse_port = reuse_port
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.reserved = ThreadPoolExecutor(max_workers=reserved_workers)
+        self.connections = 0
+        self.blocking = 0   # blocking calls handed to the executor
+        self.daemon = True
+
+    def run(self):
+        logging.debug("AsyncSkeleton.run()")
+        logging.info("Press Ctrl-C to stop the peer...")
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self):
+        """Accept connections until the task is cancelled."""
+        server = await asyncio.start_server(
+            self._serve_connection, self.address[0], self.address[1],
+            backlog=self.backlog, reuse_address=True,
+            reuse_port=self.reuse_port or None, limit=LINE_LIMIT)
+        logging.debug("AsyncSkeleton running at: {}".format(self.address))
+        local = await self._serve_local()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if local is not None:
+                local.close()
+
+    def stats(self):
+        return {"connections": self.connections}
+
+    def queue_depth(self):
+        """Number of blocking calls waiting for a thread of the pool."""
+        return max(0, self.blocking - self.workers)
+
+    # Private methods
+
+    async def _serve_local(self):
+        """Start accepting connections on local_path; return the server."""
+        if self.local_path is None:
+            return None
+        orb.remove_socket_file(self.local_path)
+        try:
+            server = await asyncio.start_unix_server(
+                self._serve_connection, self.local_path,
+                backlog=self.backlog, limit=LINE_LIMIT)
+        except OSError as detail:
+            logging.info("Not listening to {}: {}".format(self.local_path, detail))
+            self.local_path = None
+            return None
+        logging.debug("AsyncSkeleton running at: {}".format(self.local_path))
+        return server
+
+    async def _serve_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        logging.debug("Serving requests from {0}".format(addr))
+        self.connections += 1
+        calls = set()
+        try:
+            while True:
+                try:
+                    codec, request = await asyncio.wait_for(
+                        read_frame(reader), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    logging.debug("Closing idle connection from {}".format(addr))
+                    break
+                if codec is None:
+                    # The client has closed the connection.
+                    break
+                logging.debug("Request received: {}".format(request))
+                received = time.monotonic()
+                try:
+                    r = orb.decode_request(request, codec)
+                except orb.ProtocolError as err:
+                    await self._send(writer, codec, orb.make_error(err))
+                    break
+                call = rmiMetrics.served.start(r["method"], received)
+                call.bytes_in = len(request)
+                if "id" in r:
+                    task = asyncio.ensure_future(
+                        self._answer(writer, codec, r, call))
+                    calls.add(task)
+                    task.add_done_callback(calls.discard)
+                else:
+                    await self._answer(writer, codec, r, call)
+            if calls:
+                await asyncio.wait(calls)
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, wireCodec.CodecError) as detail:
+            logging.debug("Connection from {} failed: {}".format(addr, detail))
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _answer(self, writer, codec, r, call):
+        result = await self._execute(r)
+        if not r.get("oneway"):
+            logging.debug("Request processed. Sending result {}\n".format(result))
+            try:
+                call.bytes_out = await self._send(writer, codec, result)
+            except ConnectionError as detail:
+                logging.debug("Could not answer: {}".format(detail))
+        call.finish("error" in result)
+
+    async def _execute(self, r):
+        call_id = r.get("id")
+        try:
+            orb.check_deadline(r)
+            method = orb.reserved_methods.get(r["method"])
+            if method is None:
+                method = getattr(self.owner, r["method"])
+            if asyncio.iscoroutinefunction(method):
+                with tracing.server_span(r):
+                    result = await method(*r["args"])
+                return orb.make_result(result, call_id)
+            priority = orb.is_priority(self.owner, r)
+        except Exception as detail:
+            logging.info(traceback.format_exc())
+            return orb.make_error(detail, call_id)
+        # Blocking methods must not run on the loop.
+        loop = asyncio.get_running_loop()
+        if priority:
+            return await loop.run_in_executor(self.reserved,
+                                              orb.execute_request,
+                                              self.owner, r)
+        self.blocking += 1
+        try:
+            return await loop.run_in_executor(self.executor,
+                                              orb.execute_request,
+                                              self.owner, r)
+        finally:
+            self.blocking -= 1
+
+    async def _send(self, writer, codec, result):
+        data = orb.encode_answer(codec, result)
+        writer.write(data)
+        await writer.drain()
+        return len(data)
+
+
+async def read_frame(reader):
+    """Read one message from a stream, like wireCodec.read_frame().
+
+    Return (codec, payload), or (None, b"") when the stream is closed.
+    """
+    try:
+        first = await reader.readexactly(1)
+    except asyncio.IncompleteReadError:
+        return None, b""
+    if first[0] != wireCodec.MAGIC:
+        return wireCodec.JSON, first + await reader.readline()
+    header = first + await reader.readexactly(wireCodec.HEADER.size - 1)
+    magic, flags, length = wireCodec.HEADER.unpack(header)
+    codec = wireCodec.frame_codec(flags)
+    return codec, await reader.readexactly(length)
+
+
+class _AsyncConnection(object):
+    """Connection of an AsyncStub, carrying many calls matched by id."""
+
+    def __init__(self, address, reader, writer):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.pending = collections.OrderedDict()   # call id -> Future
+        self.ids = itertools.count()
+        self.closed = False
+        self.listener = asyncio.ensure_future(self._read_answers())
+
+    async def call(self, method, args):
+        if self.closed:
+            raise orb.ComunicationError(
+                "Connection to {} is closed".format(self.address))
+        call_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[call_id] = future
+        msg = orb.json_dumps_method(method, list(args), call_id)
+        logging.debug("AsyncStub sending JSON message: {}".format(msg))
+        try:
+            self.writer.write((msg + '\n').encode("utf-8"))
+            await self.writer.drain()
+        except ConnectionError:
+            self.pending.pop(call_id, None)
+            self.close()
+            raise
+        return orb.check_response(await future)
+
+    def close(self, reason=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        if reason is None:
+            reason = orb.ComunicationError(
+                "Connection to {} was closed".format(self.address))
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(reason)
+        self.pending.clear()
+
+    async def _read_answers(self):
+        reason = None
+        try:
+            while True:
+                answer = await self.reader.readline()
+                if not answer:
+                    break
+                try:
+                    response = json.loads(answer.decode("utf-8"))
+                except JSONDecodeError as err:
+                    reason = orb.ProtocolError(
+                        "Undecodable answer from {}: {}".format(self.address, err))
+                    break
+                call_id = response.get("id")
+                if call_id is None:
+                    # Peers that do not multiplex answer in order.
+                    future = (self.pending.popitem(last=False)[1]
+                              if self.pending else None)
+                else:
+                    future = self.pending.pop(call_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (ConnectionError, asyncio.IncompleteReadError) as err:
+            reason = orb.ComunicationError(
+                "Connection to {} failed: {}".format(self.address, err))
+        finally:
+            self.close(reason)
+
+
+class AsyncStub(object):
+    """ Stub for coroutines.
+
+    Every remote method returns an awaitable. All the calls of a stub
+    share one connection, opened on first use and reopened if it breaks.
+    A stub must only be used from the event loop that first used it.
+    """
+
+    def __init__(self, address):
+        logging.debug("AsyncStub.__init__()")
+        self.address = tuple(address)
+        self._conn = None
+        self._connecting = None
+
+    async def call(self, method, *args):
+        """Call method on the remote object and return its result."""
+        logging.debug("AsyncStub.call({}, {})".format(method, args))
+        conn = await self._connection()
+        return await conn.call(method, args)
+
+    async def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _connection(self):
+        if self._conn is not None and not self._conn.closed:
+            return self._conn
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open())
+        try:
+            self._conn = await asyncio.shield(self._connecting)
+        finally:
+            self._connecting = None
+        return self._conn
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(
+            self.address[0], self.address[1], limit=LINE_LIMIT)
+        return _AsyncConnection(self.address, reader, writer)
+
+    def __getattr__(self, attr):
+        """Forward call to name over the network at the given address."""
+        logging.debug("AsyncStub.__getattr__({})".format(attr))
+
+        async def rmi_call(*args):
+            return await self.call(attr, *args)
+        return rmi_call
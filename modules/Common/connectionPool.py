@@ -0,0 +1,316 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Pool of persistent connections used by the object request broker.
+
+Opening a new TCP connection for every remote call means that every
+token handoff, every replicated write and every liveness check pays a
+full handshake and leaves a socket behind in TIME_WAIT. Instead, a Stub
+borrows a connection to its peer from a ConnectionPool and gives it back
+once the answer has been read, so consecutive calls to the same address
+travel over the same socket.
+
+Rules:
+    --  at most max_per_peer idle connections are kept for an address.
+        When all of them are busy, the caller gets an extra connection
+        which is closed after use instead of blocking, so nested calls
+        between peers can never deadlock on the pool.
+    --  connections that have been idle for more than idle_timeout
+        seconds are evicted.
+    --  connections closed by the remote end while idle are detected
+        when they are taken out of the pool and silently replaced.
+
+Besides the connections lent to one call at a time, the pool keeps at
+most one shared connection per address for calls that are multiplexed
+over a single socket (see orb.MultiplexedConnection).
+
+Peers on the same host also listen on a Unix domain socket. Once a peer
+has advertised it (see advertise()), connections to its TCP address are
+opened on the Unix socket instead, which skips the loopback TCP stack.
+If that fails the pool forgets the route and falls back to TCP.
+"""
+
+import os
+import socket
+import select
+import threading
+import time
+import logging
+import tempfile
+
+from . import wireCodec
+
+# Identifies this host in advertised Unix socket addresses.
+HOST = socket.gethostname()
+
+
+def local_socket_path(address):
+    """Return the Unix socket path of a peer listening to address."""
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    return os.path.join(tempfile.gettempdir(), "tddd25-{}-{}.sock".format(*address))
+
+
+def open_socket(address, timeout=None, path=None):
+    """Connect to address, or to the Unix socket at path if given.
+
+    timeout bounds the time spent connecting.
+    """
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(path)
+        except:
+            sock.close()
+            raise
+        return sock
+    sock = socket.create_connection(address, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class Connection(object):
+
+    """A socket to a remote address together with its frame reader.
+
+    codec is the wire codec agreed on for the connection; it is None
+    until the Stub using the connection has negotiated it. sock is the
+    connected socket, TCP or Unix.
+    """
+
+    def __init__(self, address, sock):
+        self.address = address
+        self.sock = sock
+        self.reader = wireCodec.FrameReader(self.sock)
+        self.codec = None
+        self.last_used = time.monotonic()
+        self.reused = False
+        self.pooled = True
+
+    def is_stale(self):
+        """Check whether the remote end has closed the idle connection.
+
+        An idle connection should never be readable: if it is, the peer
+        has either closed it or sent garbage, and it cannot be reused.
+        """
+        if self.reader.buffered():
+            return True
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return len(readable) > 0
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool(object):
+
+    """Keep idle connections to remote addresses for later reuse."""
+
+    def __init__(self, max_per_peer=8, idle_timeout=30.0):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}      # address -> list of idle connections
+        self.busy = {}      # address -> number of pooled connections in use
+        self.shared_conns = {}  # address -> shared (multiplexed) connection
+        self.codecs = {}        # address -> name of the codec agreed on
+        self.sequential = set() # addresses answering one call per connection
+        self.local_paths = {}   # address -> Unix socket of a peer on this host
+        self.last_sweep = time.monotonic()
+
+    # Public methods
+
+    def acquire(self, address, timeout=None):
+        """Return a connection to address, reusing an idle one if possible.
+
+        timeout bounds the time spent opening a new connection.
+        """
+        address = tuple(address)
+        self._maybe_sweep()
+
+        conn = None
+        pooled = True
+        with self.lock:
+            idle = self.idle.get(address, [])
+            now = time.monotonic()
+            while idle:
+                candidate = idle.pop()
+                if now - candidate.last_used > self.idle_timeout:
+                    candidate.close()
+                    continue
+                conn = candidate
+                break
+            busy = self.busy.get(address, 0)
+            if conn is None and busy + len(idle) >= self.max_per_peer:
+                pooled = False
+            if pooled:
+                self.busy[address] = busy + 1
+
+        if conn is not None and conn.is_stale():
+            logging.debug("Dropping stale connection to {}".format(address))
+            conn.close()
+            conn = None
+
+        if conn is None:
+            try:
+                conn = Connection(address, self.connect(address, timeout))
+            except:
+                if pooled:
+                    self._unmark_busy(address)
+                raise
+            conn.pooled = pooled
+        else:
+            conn.reused = True
+        return conn
+
+    def advertise(self, address, local):
+        """Remember the Unix socket a peer advertised with its address.
+
+        local is the [host, path] pair the peer registered with, or None.
+        It is only used if the peer runs on this host.
+        """
+        if local is None or not hasattr(socket, "AF_UNIX"):
+            return
+        host, path = local
+        if host == HOST:
+            self.local_paths[tuple(address)] = path
+
+    def connect(self, address, timeout=None):
+        """Open a socket to address, preferring its Unix socket if known."""
+        address = tuple(address)
+        path = self.local_paths.get(address)
+        if path is not None:
+            try:
+                return open_socket(address, timeout, path)
+            except socket.timeout:
+                raise
+            except OSError as detail:
+                logging.debug("Falling back to TCP for {}: {}"
+                              .format(address, detail))
+                self.local_paths.pop(address, None)
+        return open_socket(address, timeout)
+
+    def release(self, conn):
+        """Give a connection back to the pool after a successful call."""
+        conn.last_used = time.monotonic()
+        if not conn.pooled:
+            conn.close()
+            return
+        with self.lock:
+            self._unmark_busy_locked(conn.address)
+            self.idle.setdefault(conn.address, []).append(conn)
+
+    def discard(self, conn):
+        """Close a connection that is broken or in an unknown state."""
+        conn.close()
+        if conn.pooled:
+            self._unmark_busy(conn.address)
+
+    def shared(self, address, factory):
+        """Return the connection shared by all multiplexed calls to address.
+
+        factory(address) is used to open a new one when there is none yet,
+        or when the current one is closed or has been idle for too long.
+        The objects it returns must provide close(), and the closed,
+        pending and last_used attributes.
+        """
+        address = tuple(address)
+        self._maybe_sweep()
+        with self.lock:
+            conn = self.shared_conns.get(address)
+        if conn is not None and not self._shared_expired(conn):
+            return conn
+
+        fresh = factory(address)
+        with self.lock:
+            current = self.shared_conns.get(address)
+            if current is not None and current is not conn:
+                # Somebody else replaced it in the meantime.
+                winner = current
+            else:
+                self.shared_conns[address] = fresh
+                winner = fresh
+        if conn is not None:
+            conn.close()
+        if winner is not fresh:
+            fresh.close()
+        return winner
+
+    def has_shared(self, address):
+        """True if the shared connection to address is open."""
+        with self.lock:
+            conn = self.shared_conns.get(tuple(address))
+        return conn is not None and not self._shared_expired(conn)
+
+    def evict_idle(self):
+        """Close every connection idle for longer than idle_timeout."""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            self.last_sweep = now
+            for address in list(self.idle.keys()):
+                keep = []
+                for conn in self.idle[address]:
+                    if now - conn.last_used > self.idle_timeout:
+                        expired.append(conn)
+                    else:
+                        keep.append(conn)
+                if keep:
+                    self.idle[address] = keep
+                else:
+                    del self.idle[address]
+            for address in list(self.shared_conns.keys()):
+                conn = self.shared_conns[address]
+                if self._shared_expired(conn):
+                    expired.append(conn)
+                    del self.shared_conns[address]
+        for conn in expired:
+            conn.close()
+
+    def close_all(self):
+        """Close all the idle and shared connections kept by the pool."""
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+            shared = self.shared_conns
+            self.shared_conns = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+        for conn in shared.values():
+            conn.close()
+
+    # Private methods
+
+    def _maybe_sweep(self):
+        if time.monotonic() - self.last_sweep > self.idle_timeout / 2:
+            self.evict_idle()
+
+    def _shared_expired(self, conn):
+        if conn.closed:
+            return True
+        idle_for = time.monotonic() - conn.last_used
+        return not conn.pending and idle_for > self.idle_timeout
+
+    def _unmark_busy(self, address):
+        with self.lock:
+            self._unmark_busy_locked(address)
+
+    def _unmark_busy_locked(self, address):
+        busy = self.busy.get(address, 0) - 1
+        if busy > 0:
+            self.busy[address] = busy
+        else:
+            self.busy.pop(address, None)
+
+
+# Pool shared by all the stubs of a process unless told otherwise.
+default_pool = ConnectionPool()
@@ -0,0 +1,198 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Background failure detector for the peers of a group.
+
+Instead of probing every peer whenever one joins or leaves, a
+FailureDetector probes all the peers it monitors once per interval from
+its own thread, all at once with orb.checkLivenessAll(). Every peer that
+answers in time counts as a heartbeat.
+
+The suspicion level of a peer is its phi, computed from the time since
+its last heartbeat and the mean time between heartbeats (phi accrual,
+with exponentially distributed arrivals):
+
+    phi = elapsed / mean * log10(e)
+
+A phi of 1 means a 10% chance that the peer is in fact alive, 2 a 1%
+chance, and so on. A peer is
+
+--  ALIVE ::
+        while its phi is below suspect_phi.
+--  SUSPECT ::
+        once its phi reaches suspect_phi. A later heartbeat makes it
+        ALIVE again.
+--  DEAD ::
+        once its phi reaches dead_phi. on_dead(key) is called from the
+        detector thread and the peer is no longer monitored.
+
+Membership changes only add or remove entries, so they never wait for
+the network.
+"""
+
+import math
+import threading
+import time
+import logging
+import traceback
+import collections
+
+from . import orb
+
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
+# Number of heartbeat intervals the mean is computed from.
+WINDOW = 100
+
+_LOG10_E = math.log10(math.e)
+
+
+class _Target(object):
+
+    """Heartbeat history of one monitored peer."""
+
+    def __init__(self, stub, pid, obj_type, now):
+        self.stub = stub
+        self.pid = pid
+        self.obj_type = obj_type
+        self.last = now
+        self.intervals = collections.deque(maxlen=WINDOW)
+        self.state = ALIVE
+
+
+class FailureDetector(object):
+
+    """Probe a set of peers periodically and keep a view of their state.
+
+    Public methods:
+        --  __init__(interval, suspect_phi, dead_phi, on_dead)
+        --  start()
+        --  stop()
+        --  monitor(key, stub, pid, obj_type)
+        --  forget(key)
+        --  heartbeat(key)
+        --  phi(key)
+        --  status(key)
+        --  view()
+
+    """
+
+    def __init__(self, interval=1.0, suspect_phi=2.0, dead_phi=4.0,
+                 on_dead=None):
+        self.interval = interval
+        self.suspect_phi = suspect_phi
+        self.dead_phi = dead_phi
+        self.on_dead = on_dead
+        self.lock = threading.Condition()
+        self.targets = {}   # key -> _Target
+        self.thread = None
+        self.stopped = False
+
+    # Public methods
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped = False
+            self.thread = threading.Thread(target=self._run,
+                                           name="failure-detector")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.thread = None
+            self.lock.notify_all()
+
+    def monitor(self, key, stub, pid, obj_type):
+        """Start probing the peer pid of type obj_type through stub."""
+        with self.lock:
+            self.targets[key] = _Target(stub, pid, obj_type, time.monotonic())
+
+    def forget(self, key):
+        with self.lock:
+            self.targets.pop(key, None)
+
+    def heartbeat(self, key):
+        """Record a sign of life from key."""
+        now = time.monotonic()
+        with self.lock:
+            target = self.targets.get(key)
+            if target is None:
+                return
+            target.intervals.append(now - target.last)
+            target.last = now
+            if target.state == SUSPECT:
+                logging.info("Peer {} is alive again.".format(key))
+            target.state = ALIVE
+
+    def phi(self, key):
+        with self.lock:
+            target = self.targets.get(key)
+            if target is None:
+                return float("inf")
+            return self._phi(target, time.monotonic())
+
+    def status(self, key):
+        """Return ALIVE, SUSPECT, or DEAD for keys not monitored (any more)."""
+        with self.lock:
+            target = self.targets.get(key)
+            return DEAD if target is None else target.state
+
+    def view(self):
+        """Return {key: state} for all the monitored peers."""
+        with self.lock:
+            return {key: target.state for key, target in self.targets.items()}
+
+    # Private methods
+
+    def _phi(self, target, now):
+        # Never expect heartbeats faster than they are asked for.
+        mean = self.interval
+        if target.intervals:
+            mean = max(mean, sum(target.intervals) / len(target.intervals))
+        return (now - target.last) / mean * _LOG10_E
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.stopped:
+                    return
+                targets = dict(self.targets)
+            started = time.monotonic()
+            dead = orb.checkLivenessAll(
+                [(t.pid, t.stub, t.obj_type) for t in targets.values()],
+                self.interval)
+            for key, target in targets.items():
+                if target.pid not in dead:
+                    self.heartbeat(key)
+            self._update()
+            with self.lock:
+                if self.stopped:
+                    return
+                self.lock.wait(max(0.0, started + self.interval - time.monotonic()))
+
+    def _update(self):
+        now = time.monotonic()
+        dead = []
+        with self.lock:
+            for key, target in list(self.targets.items()):
+                phi = self._phi(target, now)
+                if phi >= self.dead_phi:
+                    del self.targets[key]
+                    dead.append(key)
+                elif phi >= self.suspect_phi and target.state == ALIVE:
+                    target.state = SUSPECT
+                    logging.info("Suspecting peer {} (phi {:.1f}).".format(key, phi))
+        for key in dead:
+            logging.info("Peer {} is considered dead.".format(key))
+            if self.on_dead is not None:
+                try:
+                    self.on_dead(key)
+                except Exception:
+                    logging.info(traceback.format_exc())
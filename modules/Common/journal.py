@@ -0,0 +1,169 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Durable state kept as a snapshot plus an append-only journal.
+
+A Journal keeps two files next to each other:
+
+--  PREFIX.snapshot ::
+        The whole state at some point, as one JSON document. It is
+        written to a temporary file first and renamed over the old one,
+        so it is always complete.
+--  PREFIX.journal ::
+        The changes made since the snapshot, one JSON record per line.
+
+At startup load() returns both, and the owner replays the records on
+top of the snapshot. A record is only durable once it has been written
+and fsync'ed; sync(seq) waits for that. The records are written by a
+background thread, which takes all the records appended while it was
+busy and writes them with a single fsync (group commit), so the cost
+of an fsync is shared by all the concurrent writers.
+
+Once the journal holds many records, the owner writes its state with
+compact(), which replaces the snapshot and empties the journal. A
+record appended just before may still be written after the journal was
+emptied, so replaying must be idempotent.
+"""
+
+import os
+import json
+import threading
+import logging
+
+
+class Journal(object):
+
+    """Append-only journal of changes with compact snapshots.
+
+    Public methods:
+        --  __init__(prefix)
+        --  load()
+        --  append(record)
+        --  sync(seq)
+        --  compact(snapshot)
+        --  close()
+
+    """
+
+    def __init__(self, prefix):
+        self.snapshot_path = prefix + ".snapshot"
+        self.journal_path = prefix + ".journal"
+        self.lock = threading.Condition()
+        self.io_lock = threading.Lock()     # serializes the file operations
+        self.pending = []       # lines appended and not written yet
+        self.appended = 0       # sequence number of the last record
+        self.synced = 0         # last sequence number known to be durable
+        self.records = 0        # records in the journal since the snapshot
+        self.file = None
+        self.thread = None
+        self.closed = False
+
+    # Public methods
+
+    def load(self):
+        """Return (snapshot or None, [records]) and open the journal.
+
+        A last line cut short by a crash is ignored.
+        """
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        records = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line.decode("utf-8")))
+                    except ValueError:
+                        logging.info("Ignoring a damaged journal record.")
+                        break
+        self.records = len(records)
+        self.file = open(self.journal_path, "ab")
+        self.thread = threading.Thread(target=self._write, name="journal")
+        self.thread.daemon = True
+        self.thread.start()
+        return snapshot, records
+
+    def append(self, record):
+        """Queue record to be written; return its sequence number."""
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.pending.append(line.encode("utf-8"))
+            self.appended += 1
+            self.records += 1
+            self.lock.notify_all()
+            return self.appended
+
+    def sync(self, seq):
+        """Wait until the record with sequence number seq is durable."""
+        with self.lock:
+            while self.synced < seq and not self.closed:
+                self.lock.wait()
+
+    def compact(self, snapshot):
+        """Replace the snapshot with snapshot and empty the journal.
+
+        snapshot must include the effect of every record appended so far.
+        """
+        with self.lock:
+            self.pending = []
+            seq = self.appended
+        with self.io_lock:
+            temporary = self.snapshot_path + ".tmp"
+            with open(temporary, "w") as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.snapshot_path)
+            self._sync_directory()
+            self.file.truncate(0)
+            os.fsync(self.file.fileno())
+        with self.lock:
+            self.synced = max(self.synced, seq)
+            self.records = 0
+            self.lock.notify_all()
+
+    def close(self):
+        """Write the records still pending and close the journal."""
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        if self.file is not None:
+            self.file.close()
+
+    # Private methods
+
+    def _write(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.lock.wait()
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, []
+                seq = self.appended
+            with self.io_lock:
+                self.file.write(b"".join(batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            with self.lock:
+                self.synced = max(self.synced, seq)
+                self.lock.notify_all()
+
+    def _sync_directory(self):
+        """Make the rename of the snapshot durable."""
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
@@ -0,0 +1,121 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Leases that expire unless they are renewed in time.
+
+A LeaseTable grants a lease of ttl seconds to every key it is given and
+calls on_expire(key), from a sweeper thread, for leases that have not
+been renewed before they ran out. Expiry times are kept in a heap, so
+the sweeper sleeps until the next lease is due instead of scanning the
+table. Renewing only updates the table; the outdated heap entry is
+skipped when it comes up.
+"""
+
+import heapq
+import threading
+import time
+import logging
+import traceback
+
+
+class LeaseTable(object):
+
+    """Keep leases and expire them in the background.
+
+    Public methods:
+        --  __init__(ttl, on_expire)
+        --  start()
+        --  stop()
+        --  grant(key)
+        --  renew(key)
+        --  revoke(key)
+        --  remaining(key)
+
+    """
+
+    def __init__(self, ttl=10.0, on_expire=None):
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.lock = threading.Condition()
+        self.expires = {}   # key -> time.monotonic() at which it expires
+        self.heap = []      # (expiry, key), possibly outdated
+        self.thread = None
+        self.stopped = False
+
+    # Public methods
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped = False
+            self.thread = threading.Thread(target=self._sweep,
+                                           name="lease-sweeper")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.thread = None
+            self.lock.notify_all()
+
+    def grant(self, key):
+        """Give key a lease of ttl seconds, replacing any it had."""
+        with self.lock:
+            self._grant(key)
+        return self.ttl
+
+    def renew(self, key):
+        """Extend the lease of key. Return False if it has none (any more)."""
+        with self.lock:
+            if key not in self.expires:
+                return False
+            self._grant(key)
+        return True
+
+    def revoke(self, key):
+        with self.lock:
+            self.expires.pop(key, None)
+
+    def remaining(self, key):
+        """Return the seconds left on the lease of key, or None."""
+        with self.lock:
+            expiry = self.expires.get(key)
+        if expiry is None:
+            return None
+        return max(0.0, expiry - time.monotonic())
+
+    # Private methods
+
+    def _grant(self, key):
+        expiry = time.monotonic() + self.ttl
+        self.expires[key] = expiry
+        heapq.heappush(self.heap, (expiry, key))
+        if self.heap[0][1] == key:
+            self.lock.notify()
+
+    def _sweep(self):
+        while True:
+            expired = []
+            with self.lock:
+                if self.stopped:
+                    return
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    expiry, key = heapq.heappop(self.heap)
+                    if self.expires.get(key) == expiry:
+                        del self.expires[key]
+                        expired.append(key)
+                if not expired:
+                    timeout = self.heap[0][0] - now if self.heap else None
+                    self.lock.wait(timeout)
+                    continue
+            for key in expired:
+                logging.info("Lease of {} expired.".format(key))
+                if self.on_expire is not None:
+                    try:
+                        self.on_expire(key)
+                    except Exception:
+                        logging.info(traceback.format_exc())
@@ -15,3 +15,7 @@ structure if the name service changes address.
 """
 
 name_service_address = ("127.0.0.1", 40000)
+
+# All the name servers: the primary first, then its followers (started
+# with name_server.py -f), if any. Lookups are spread over all of them.
+name_service_addresses = [name_service_address]
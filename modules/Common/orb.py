@@ -7,15 +7,28 @@
 # Copyright 2012 Linkoping University
 # -----------------------------------------------------------------------------
 
-import multiprocessing.dummy as multiprocessing
+import os
 import sys
 import threading
 import socket
 import json
 import logging
 import traceback
+import collections
+import heapq
+import itertools
+import time
+import random
+import selectors
+from concurrent.futures import Future, wait
 from json import JSONDecodeError
 
+from . import connectionPool
+from . import workerPool
+from . import wireCodec
+from . import rmiMetrics
+from . import tracing
+
 """Object Request Broker
 
 This module implements the infrastructure needed to transparently create
@@ -27,10 +40,17 @@ objects that communicate via networks. This infrastructure consists of:
 --  Skeleton ::
         Used to listen to incoming connections and forward them to the
         main object.
+--  PooledSkeleton ::
+        Skeleton that serves all connections with a bounded pool of
+        worker threads instead of one thread per connection.
 --  Peer ::
         Class that implements basic bidirectional (Stub/Skeleton)
         communication. Any object wishing to transparently interact with
         remote objects should extend this class.
+
+Skeletons can listen to a Unix domain socket besides their TCP address.
+Peers advertise it when they register, and Stubs on the same host then
+connect through it (see connectionPool).
 """
 
 log = logging # Pretty sure I can remove this
@@ -38,6 +58,9 @@ log = logging # Pretty sure I can remove this
 class ComunicationError(Exception):
     pass
 
+class DeadlineExceeded(ComunicationError):
+    pass
+
 class ProtocolError(Exception):
     pass
 
@@ -49,8 +72,10 @@ def throw_ExternalError(error):
 
     errorFields = error["error"]
         
+    errorArgs = errorFields["args"]
     raise ExternalError("An error occured on a different machine in the network." +\
-                        "\n{}: {}".format(errorFields['name'],errorFields["args"][0]))
+                        "\n{}: {}".format(errorFields['name'],
+                                          errorArgs[0] if errorArgs else ""))
 
 def handle_JSONDecodeError(err):
     if err.doc == "":
@@ -64,93 +89,746 @@ def handle_JSONDecodeError(err):
         message.format(err.msg, err.lineno, err.colno, err.pos, err.doc))
     
 
-def json_dumps_method(method_name, args=[]):
-    return json.dumps({"method": method_name, "args": args})    
+def make_method(method_name, args=[], call_id=None, oneway=False,
+                timeout=None, trace=None):
+    message = {"method": method_name, "args": args}
+    if call_id is not None:
+        message["id"] = call_id
+    if oneway:
+        # The caller does not want an answer, not even an error.
+        message["oneway"] = True
+    if timeout is not None:
+        # Seconds the caller is still willing to wait for the answer.
+        message["timeout"] = timeout
+    if trace is not None:
+        # Trace id and id of the calling span.
+        message["trace"] = list(trace)
+    return message
+
+def make_result(result, call_id=None):
+    message = {"result": result}
+    if call_id is not None:
+        message["id"] = call_id
+    return message
+
+def make_error(error, call_id=None):
+    message = {"error": {"name": error.__class__.__name__, "args": error.args}}
+    if call_id is not None:
+        message["id"] = call_id
+    return message
+
+def json_dumps_method(method_name, args=[], call_id=None):
+    return json.dumps(make_method(method_name, args, call_id))
+
+def json_dumps_result(result, call_id=None):
+    return json.dumps(make_result(result, call_id))
+
+def json_dumps_error(error, call_id=None):
+    return json.dumps(make_error(error, call_id))
+
+def check_response(response):
+    """Return the result carried by a decoded answer or raise its error."""
+    keys = set(response.keys()) - set(["id"])
+    if (keys != set(["error"]) and keys != set(["result"])):
+        raise ProtocolError("Bad key(s):", response)
+    if ("error" in keys):
+        throw_ExternalError(response)
+    return response["result"]
+
+def decode_request(request, codec=wireCodec.JSON, received=None):
+    """Decode a serialized request into a dictionary.
+
+    received is the time.monotonic() at which the request arrived. If
+    the caller gave a timeout, the time after which nobody waits for the
+    answer any more is stored under "expires".
+    """
+    try:
+        r = codec.decode(request)
+    except JSONDecodeError as err:
+        handle_JSONDecodeError(err)
+    except wireCodec.CodecError as err:
+        raise ProtocolError(str(err))
+    if (not isinstance(r, dict) or
+            "method" not in r.keys() or "args" not in r.keys()):
+        raise ProtocolError("Bad stuff")
+    if isinstance(r.get("timeout"), (int, float)):
+        if received is None:
+            received = time.monotonic()
+        r["expires"] = received + r["timeout"]
+    return r
+
+def check_deadline(r):
+    """Raise DeadlineExceeded if the caller of request r has given up."""
+    expires = r.get("expires")
+    if expires is not None and time.monotonic() > expires:
+        raise DeadlineExceeded("Deadline of {} passed before it was run"
+                               .format(r["method"]))
+
+def decode_answer(answer, codec=wireCodec.JSON):
+    """Decode a serialized answer into a dictionary."""
+    try:
+        response = codec.decode(answer)
+    except JSONDecodeError as err:
+        handle_JSONDecodeError(err)
+    except wireCodec.CodecError as err:
+        raise ProtocolError(str(err))
+    if not isinstance(response, dict):
+        raise ProtocolError("Bad answer:", response)
+    return response
+
+MULTI_CALL_METHOD = "__multi_call__"
+
+def _multi_call(owner, calls):
+    """Run a list of [method, args] pairs on owner, in order.
+
+    Every call is answered separately, so one failing call does not
+    prevent the following ones from running.
+    """
+    answers = []
+    for method, args in calls:
+        answers.append(execute_request(owner, make_method(method, args)))
+    return answers
+
+STATS_METHOD = "__stats__"
+
+def collect_stats(owner):
+    """Return the RMI metrics of this process and the skeleton of owner.
+
+    This is the answer to STATS_METHOD; rmiMetrics.format_stats() turns
+    it into a table.
+    """
+    stats = {"calls": rmiMetrics.calls.snapshot(),
+             "served": rmiMetrics.served.snapshot(),
+             "compression": wireCodec.compression_stats()}
+    skeleton = getattr(owner, "skeleton", None)
+    if skeleton is not None:
+        stats["skeleton"] = skeleton.stats()
+    return stats
+
+RESET_STATS_METHOD = "__reset_stats__"
+
+def _reset_stats(owner):
+    """Return the RMI metrics like STATS_METHOD, then start them over."""
+    stats = collect_stats(owner)
+    rmiMetrics.calls.reset()
+    rmiMetrics.served.reset()
+    return stats
+
+def load_report(owner):
+    """Return the load of the process serving owner.
+
+    in_flight counts the calls being served, queue the requests waiting
+    for a worker, and p99 is the latency of the calls served since the
+    last report. Peers send it along with their lease renewals.
+    """
+    report = rmiMetrics.served.report()
+    skeleton = getattr(owner, "skeleton", None)
+    report["queue"] = skeleton.queue_depth() if skeleton is not None else 0
+    return report
+
+# Methods answered by the broker itself instead of the owner object.
+reserved_methods = {
+    wireCodec.CODEC_METHOD: lambda owner, offered: wireCodec.choose(offered),
+    MULTI_CALL_METHOD: _multi_call,
+    STATS_METHOD: collect_stats,
+    RESET_STATS_METHOD: _reset_stats,
+}
+
+# Default number of seconds a call between peers, or from a peer to the
+# name service, may take, connecting included. Stubs used by servers
+# are given it, so that a hung peer cannot block its callers forever.
+PEER_TIMEOUT = 10.0
 
-def json_dumps_result(result):
-    return json.dumps({"result": result})
+# Calls that may run twice without harm. Only these are sent again when
+# a reused connection fails after the call went out, as the peer may
+# have run it before the connection dropped.
+IDEMPOTENT_METHODS = {
+    STATS_METHOD, "isAlive", "read", "get_peers", "require_any",
+    "require_object", "replicate",
+}
 
-def json_dumps_error(error):
-    return json.dumps({"error": {"name": error.__class__.__name__, "args": error.args}})
+def is_priority(owner, r):
+    """True if request r only makes calls owner serves as a priority.
+
+    Such calls (see Peer.priority_methods) never wait for other calls to
+    finish, so skeletons with a bounded number of threads run them on
+    threads of their own: a call blocked until one of them arrives could
+    otherwise hold the thread it needs.
+    """
+    methods = getattr(owner, "priority_methods", None)
+    if not isinstance(methods, (set, frozenset)):
+        return False
+    if r["method"] == MULTI_CALL_METHOD:
+        calls = r["args"][0] if r["args"] else []
+        return bool(calls) and all(isinstance(c, list) and c and
+                                   c[0] in methods for c in calls)
+    return r["method"] in methods
+
+def execute_request(owner, r):
+    """Run a decoded request on owner and return the answer to send."""
+    call_id = r.get("id")
+    with tracing.server_span(r) as span:
+        try:
+            check_deadline(r)
+            method = r["method"]
+            args = r["args"]
+            if method in reserved_methods:
+                result = reserved_methods[method](owner, *args)
+            else:
+                result = getattr(owner, method).__call__(*args)
+            return make_result(result, call_id)
+        except Exception as detail:
+            # The connection outlives the request, so every failure has
+            # to be reported to the caller instead of killing the thread.
+            logging.info(traceback.format_exc())
+            span.fail(detail)
+            return make_error(detail, call_id)
+
+def encode_answer(codec, answer):
+    """Serialize an answer, turning encoding failures into error answers."""
+    try:
+        return codec.encode(answer)
+    except (wireCodec.CodecError, TypeError, ValueError) as detail:
+        logging.info(traceback.format_exc())
+        return codec.encode(make_error(detail, answer.get("id")))
 
 class Request(threading.Thread):
-    """Run the incoming requests on the owner object of the skeleton."""
+    """Run the incoming requests on the owner object of the skeleton.
+
+    The connection is kept open after a request has been answered so
+    that a pooled Stub can send the next request over it. It is closed
+    when the client closes its end or stays idle for idle_timeout
+    seconds.
 
-    def __init__(self, owner, conn, addr):
+    Requests carrying a call id are multiplexed: each one runs in its
+    own thread and its answer, tagged with the same id, is sent as soon
+    as it is ready, so several calls can be in flight on the connection
+    and answers may leave out of order. Requests without an id are
+    answered one at a time, in order.
+
+    Every request is answered with the codec it was sent in, except
+    one-way requests, which are run in order like requests without an
+    id and never answered.
+    """
+
+    def __init__(self, owner, conn, addr, idle_timeout=60.0):
         threading.Thread.__init__(self)
         self.addr = addr
         self.conn = conn
         self.owner = owner
+        self.idle_timeout = idle_timeout
+        self.write_lock = threading.Lock()
         self.daemon = True
-        
+
+    def decode_request(self, request, codec=wireCodec.JSON):
+        return decode_request(request, codec)
+
+    def execute(self, r):
+        return execute_request(self.owner, r)
+
     def process_request(self, request):
-        try:
-            r = json.loads(request)
-            if ("method" not in r.keys() or "args" not in r.keys()):
-                raise ProtocolError("Bad stuff")
-            method = r["method"]
-            args = r["args"]
-            result = getattr(self.owner, method).__call__(*args)
-            return json_dumps_result(result)
-        except OSError as detail:
-            logging.info(traceback.format_exc())
-            return json_dumps_error(detail)
-        except JSONDecodeError as err:
-            handle_JSONDecodeError(err)
+        return json.dumps(self.execute(self.decode_request(request)))
 
     def run(self):
         try:
-            # Treat the socket as a file stream.
-            worker = self.conn.makefile(mode="rw")
-            # Read the request in a serialized form (JSON).
-            request = worker.readline()
-            logging.debug("Request received: {}".format(request))
-            # Process the request.
-            result = self.process_request(request)
+            self.conn.settimeout(self.idle_timeout)
+            # Answers are written straight to the socket, so they can be
+            # sent while the next request is being read.
+            reader = wireCodec.FrameReader(self.conn)
+            while True:
+                # Read the request in a serialized form.
+                codec, request = reader.read_frame()
+                if codec is None:
+                    # The client has closed the connection.
+                    break
+                logging.debug("Request received: {}".format(request))
+                received = time.monotonic()
+                try:
+                    r = self.decode_request(request, codec)
+                except ProtocolError as err:
+                    self._send(codec, make_error(err))
+                    break
+                call = rmiMetrics.served.start(r["method"], received)
+                call.bytes_in = len(request)
+                if "id" in r:
+                    worker = threading.Thread(target=self._serve,
+                                              args=(codec, r, call))
+                    worker.daemon = True
+                    worker.start()
+                else:
+                    self._serve(codec, r, call)
+        except socket.timeout:
+            logging.debug("Closing idle connection from {}".format(self.addr))
+        except wireCodec.CodecError as detail:
+            logging.debug("Bad frame from {}: {}".format(self.addr, detail))
+        except OSError as detail:
+            logging.debug("Connection from {} failed: {}".format(self.addr, detail))
+        finally:
+            self.conn.close()
+
+    def _serve(self, codec, r, call):
+        # Process the request.
+        result = self.execute(r)
+        if not r.get("oneway"):
             logging.debug("Request processed. Sending result {}\n".format(result))
             # Send the result.
-            worker.write(str(result) + '\n')
-            worker.flush()
+            try:
+                call.bytes_out = self._send(codec, result)
+            except OSError as detail:
+                logging.debug("Could not answer {}: {}".format(self.addr, detail))
+        call.finish("error" in result)
+
+    def _send(self, codec, result):
+        data = encode_answer(codec, result)
+        with self.write_lock:
+            self.conn.sendall(data)
+        return len(data)
+
+
+class MultiplexedConnection(object):
+    """A connection carrying many concurrent calls, matched by call id.
+
+    Calls are written as soon as they are made and a reader thread hands
+    every answer to the future waiting for its call id. Answers without
+    an id come from peers that do not multiplex and are matched to the
+    oldest pending call, since such peers answer in order.
+
+    negotiate(conn), when given, is called before any call is sent and
+    returns the codec to use, or None if the peer closed the connection.
+    timeout bounds the time spent connecting and negotiating.
+    connect(address, timeout) opens the socket, by default over TCP.
+    """
+
+    def __init__(self, address, negotiate=None, timeout=None,
+                 connect=connectionPool.open_socket):
+        self.address = address
+        self.sock = connect(address, timeout)
+        self.reader = wireCodec.FrameReader(self.sock)
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()   # call id -> Future
+        self.ids = itertools.count()
+        self.closed = False
+        self.last_used = time.monotonic()
+        self.codec = wireCodec.JSON
+        if negotiate is not None:
+            try:
+                self.codec = negotiate(self)
+            except:
+                self.sock.close()
+                raise
+            if self.codec is None:
+                self.sock.close()
+                raise ComunicationError(
+                    "Connection to {} closed by the peer".format(address))
+        # Calls are given up on by the deadline watcher, not by the socket.
+        self.sock.settimeout(None)
+        listener = threading.Thread(target=self._read_answers)
+        listener.daemon = True
+        listener.start()
+
+    def submit(self, method, args, deadline=None, call=None, trace=None):
+        """Send a call and return a future for its decoded answer.
+
+        If the answer has not arrived by deadline (a time.monotonic()
+        value) the future fails with DeadlineExceeded. call, when given,
+        is the rmiMetrics.Call whose byte counters are to be filled in.
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ComunicationError(
+                    "Connection to {} is closed".format(self.address))
+            call_id = next(self.ids)
+            msg = make_method(method, list(args), call_id,
+                              timeout=_time_left(deadline, method),
+                              trace=trace)
+            logging.debug("Stub sending message: {}".format(msg))
+            data = self.codec.encode(msg)
+            self.pending[call_id] = future
+            self.last_used = time.monotonic()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                del self.pending[call_id]
+                raise
+        if call is not None:
+            call.bytes_out = len(data)
+            future.call = call
+        if deadline is not None:
+            _deadlines.watch(deadline, self._expire, call_id, method)
+        return future
+
+    def _expire(self, call_id, method):
+        with self.lock:
+            future = self.pending.pop(call_id, None)
+        if future is not None:
+            future.set_exception(DeadlineExceeded(
+                "No answer to {} from {} in time".format(method, self.address)))
+
+    def send_oneway(self, method, args, trace=None):
+        """Send a call that will not be answered. Return its size."""
+        with self.lock:
+            if self.closed:
+                raise ComunicationError(
+                    "Connection to {} is closed".format(self.address))
+            msg = make_method(method, list(args), oneway=True, trace=trace)
+            logging.debug("Stub sending one-way message: {}".format(msg))
+            self.last_used = time.monotonic()
+            data = self.codec.encode(msg)
+            self.sock.sendall(data)
+            return len(data)
+
+    def close(self, reason=None):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        if reason is None:
+            reason = ComunicationError(
+                "Connection to {} was closed".format(self.address))
+        for future in pending:
+            future.set_exception(reason)
+
+    def _read_answers(self):
+        reason = None
+        try:
+            while True:
+                codec, answer = self.reader.read_frame()
+                if codec is None:
+                    break
+                logging.debug(answer)
+                try:
+                    response = decode_answer(answer, codec)
+                except ProtocolError as err:
+                    reason = err
+                    break
+                with self.lock:
+                    self.last_used = time.monotonic()
+                    call_id = response.get("id")
+                    if call_id is None:
+                        future = (self.pending.popitem(last=False)[1]
+                                  if self.pending else None)
+                    else:
+                        future = self.pending.pop(call_id, None)
+                if future is not None:
+                    call = getattr(future, "call", None)
+                    if call is not None:
+                        call.bytes_in = len(answer)
+                    future.set_result(response)
+        except wireCodec.CodecError as err:
+            reason = ProtocolError(
+                "Bad frame from {}: {}".format(self.address, err))
+        except OSError as err:
+            reason = ComunicationError(
+                "Connection to {} failed: {}".format(self.address, err))
         finally:
-            self.conn.close()
+            self.close(reason)
 
 
 class Stub(object):
     """ Stub for generic objects distributed over the network.
 
-    This is a wrapper object for a socket.
+    This is a wrapper object for a socket. The socket itself is borrowed
+    from a connection pool for the duration of each call, so a Stub can
+    be shared between threads.
+
+    codecs lists the wire codecs the stub may use, in order of
+    preference. The first time the stub talks to an address it asks
+    which of them the peer understands and falls back to JSON if the
+    peer does not know the question.
+
+    timeout is the default number of seconds a call may take, None for
+    no limit; call(), call_async() and call_oneway() can override it
+    for a single call. The time left is sent along with the call, so that the peer
+    does not start work nobody waits for any more. A call that runs out
+    of time raises DeadlineExceeded.
+
+    A call that fails on a pooled connection the peer has closed is sent
+    again on a new one, unless it had already gone out: then it is only
+    sent again if it is in IDEMPOTENT_METHODS.
     """
 
-    def __init__(self, address):
+    def __init__(self, address, pool=None, codecs=None, timeout=None):
         logging.debug("Stub.__init__()")
         self.address = tuple(address)
+        self.pool = pool if pool is not None else connectionPool.default_pool
+        self.codecs = tuple(codecs) if codecs else wireCodec.DEFAULT_CODECS
+        self.timeout = timeout
+
+    def _deadline(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout
+
+    def _negotiate(self, conn):
+        """Return the codec to use on conn, asking the peer if needed.
 
-    def _rmi(self, method, *args):
+        Return None if the peer closed the connection instead of
+        answering; it only serves one call per connection and is now
+        remembered as a JSON peer.
+        """
+        if self.codecs[0] == wireCodec.JSON.name:
+            return wireCodec.JSON
+        known = self.pool.codecs.get(self.address)
+        if known is not None:
+            return wireCodec.get(known)
+
+        hello = make_method(wireCodec.CODEC_METHOD, [list(self.codecs)],
+                            trace=tracing.current())
+        conn.sock.sendall(wireCodec.JSON.encode(hello))
+        codec, answer = conn.reader.read_frame()
+        name = wireCodec.JSON.name
+        try:
+            if codec is not None:
+                chosen = check_response(decode_answer(answer, codec))
+                if chosen in self.codecs and chosen in wireCodec.CODECS:
+                    name = chosen
+        except (ProtocolError, ExternalError):
+            # Peers that predate codecs answer with an error.
+            pass
+        self.pool.codecs[self.address] = name
+        logging.debug("Using the {} codec with {}".format(name, self.address))
+        if codec is None:
+            return None
+        return wireCodec.get(name)
+
+    def _rmi(self, method, *args, timeout=None):
         logging.debug("Stub._rmi({}, {})".format(method, args))
+        with rmiMetrics.calls.start(method) as call, \
+                tracing.client_span(method, self.address) as span:
+            return self._exchange(method, args, timeout, call, span.context)
+
+    def _exchange(self, method, args, timeout, call, trace):
+        deadline = self._deadline(timeout)
+        retry = method in IDEMPOTENT_METHODS
+        while True:
+            sent = False
+            try:
+                conn = self.pool.acquire(self.address,
+                                         _time_left(deadline, method))
+            except socket.timeout:
+                raise DeadlineExceeded("Could not connect to {} in time"
+                                       .format(self.address))
+            try:
+                conn.sock.settimeout(_time_left(deadline, method))
+                if conn.codec is None:
+                    conn.codec = self._negotiate(conn)
+                    if conn.codec is None:
+                        self.pool.discard(conn)
+                        continue
+                msg = make_method(method, list(args),
+                                  timeout=_time_left(deadline, method),
+                                  trace=trace)
+                logging.debug("Stub sending message: {}".format(msg))
+                data = conn.codec.encode(msg)
+                conn.sock.sendall(data)
+                sent = True
+                call.bytes_out += len(data)
+                # Read the answer in a serialized form.
+                conn.sock.settimeout(_time_left(deadline, method))
+                codec, answer = conn.reader.read_frame()
+            except (socket.timeout, DeadlineExceeded):
+                # The answer may still come; the connection is useless.
+                self.pool.discard(conn)
+                raise DeadlineExceeded("No answer to {} from {} in time"
+                                       .format(method, self.address))
+            except OSError:
+                self.pool.discard(conn)
+                if conn.reused and (not sent or retry):
+                    # The peer dropped the idle connection, try a new one.
+                    continue
+                raise
+            except wireCodec.CodecError as err:
+                self.pool.discard(conn)
+                raise ProtocolError(str(err))
+            if codec is None and conn.reused:
+                self.pool.discard(conn)
+                if retry:
+                    continue
+                # The call may have run before the connection was closed.
+                raise ComunicationError("{} closed the connection before "
+                                        "answering {}".format(self.address,
+                                                              method))
+            break
+        logging.debug(answer)
+        call.bytes_in = len(answer)
         try:
-            conn = socket.create_connection(self.address)
-            # Treat the socket as a file stream.
-            worker = conn.makefile(mode="rw")
-            msg = json_dumps_method(method, args)
-            logging.debug("Stub sending JSON message: {}".format(msg))
-            worker.write(msg + '\n')
-            worker.flush()
-            # Read the request in a serialized form (JSON).
-            answer = worker.readline()
-            logging.debug(answer)
-            # Process the request.
-            response = json.loads(answer)
-            
-            if (set(response.keys()) != set(["error"]) and set(response.keys()) != set(["result"])):
-                raise ProtocolError("Bad key(s):", response)
-            if ("error" in response.keys()):
-                throw_ExternalError(response)
-            
-            result = response["result"]
-            return result
-        except JSONDecodeError as err:
-            conn.close()
-            handle_JSONDecodeError(err)
+            # Process the answer.
+            response = decode_answer(answer, codec or wireCodec.JSON)
+        except ProtocolError:
+            self.pool.discard(conn)
+            raise
+        self.pool.release(conn)
+        return check_response(response)
+
+    def call(self, method, *args, timeout=None):
+        """Call method on the remote object and return its result.
+
+        Same as stub.method(*args), except that timeout, when given,
+        replaces the default timeout of the stub for this call.
+        """
+        return self._rmi(method, *args, timeout=timeout)
+
+    def call_async(self, method, *args, timeout=None):
+        """Start a call without waiting for its answer.
+
+        The call goes over the connection shared by all asynchronous calls
+        to this address. The returned Future yields the result of the
+        call or raises the error it produced. If that connection is not
+        open yet, it is opened on a helper thread, so the caller never
+        waits for a peer that does not accept connections.
+        """
+        logging.debug("Stub.call_async({}, {})".format(method, args))
+        if self.address in self.pool.sequential:
+            # The peer closes the connection after each answer, so it
+            # cannot multiplex; make a blocking call on a helper thread.
+            return call_in_thread(self._rmi, method, *args, timeout=timeout)
+        deadline = self._deadline(timeout)
+        call = rmiMetrics.calls.start(method)
+        span = tracing.client_span(method, self.address)
+        future = Future()
+
+        def resolve(raw):
+            try:
+                response = raw.result()
+                if "id" not in response:
+                    self.pool.sequential.add(self.address)
+                future.set_result(check_response(response))
+            except Exception as err:
+                call.finish(True)
+                span.finish(type(err).__name__)
+                future.set_exception(err)
+            else:
+                call.finish()
+                span.finish()
+
+        if self.connected():
+            self._submit(method, args, deadline, call, span).add_done_callback(
+                resolve)
+            return future
+
+        def started(submitted):
+            if submitted.exception() is not None:
+                future.set_exception(submitted.exception())
+            else:
+                submitted.result().add_done_callback(resolve)
+        call_in_thread(self._submit, method, args, deadline, call,
+                       span).add_done_callback(started)
+        return future
+
+    def call_oneway(self, method, *args, on_failure=None, timeout=None):
+        """Send a call without waiting for, or ever getting, an answer.
+
+        Return once the message has been handed to the network: True if
+        it was, False if it could not be sent. In the latter case
+        on_failure(error), when given, is called with the reason. One-way
+        calls share their connection with call_async(), and the peer runs
+        them in the order they were sent, before any later call_async()
+        to the same address; errors they raise there are only logged.
+        timeout bounds the time spent connecting and sending.
+        """
+        logging.debug("Stub.call_oneway({}, {})".format(method, args))
+        try:
+            if self.address in self.pool.sequential:
+                # The peer answers anyway; wait for it on a helper thread.
+                call = call_in_thread(self._rmi, method, *args,
+                                      timeout=timeout)
+                if on_failure is not None:
+                    call.add_done_callback(
+                        lambda call: call.exception() is not None and
+                        on_failure(call.exception()))
+                return True
+            deadline = self._deadline(timeout)
+            for attempt in range(3):
+                try:
+                    mux = self._shared(deadline, method)
+                    with rmiMetrics.calls.start(method) as call, \
+                            tracing.client_span(method, self.address) as span:
+                        call.bytes_out = mux.send_oneway(method, args,
+                                                         span.context)
+                    return True
+                except DeadlineExceeded:
+                    raise
+                except ComunicationError:
+                    if attempt == 2:
+                        raise
+        except (OSError, ComunicationError, wireCodec.CodecError) as err:
+            logging.info("Could not send {} to {}: {}"
+                         .format(method, self.address, err))
+            if on_failure is not None:
+                on_failure(err)
+            return False
+
+    def connected(self):
+        """True if call_async() and call_oneway() can send right away,
+        without opening a connection first."""
+        return self.pool.has_shared(self.address)
+
+    def _submit(self, method, args, deadline, call, span):
+        """Send an asynchronous call; return the future of its answer."""
+        for attempt in range(3):
+            try:
+                mux = self._shared(deadline, method)
+                return mux.submit(method, args, deadline, call, span.context)
+            except ComunicationError as err:
+                # Closed between being handed out and being used.
+                if attempt == 2:
+                    call.finish(True)
+                    span.finish(type(err).__name__)
+                    raise
+            except Exception as err:
+                call.finish(True)
+                span.finish(type(err).__name__)
+                raise
+
+    def _shared(self, deadline, method):
+        """Return the multiplexed connection, opening it before deadline."""
+        def factory(address):
+            return MultiplexedConnection(address, self._negotiate,
+                                         _time_left(deadline, method),
+                                         self.pool.connect)
+        try:
+            return self.pool.shared(self.address, factory)
+        except socket.timeout:
+            raise DeadlineExceeded("Could not connect to {} in time"
+                                   .format(self.address))
+
+    def multi_call(self, calls, timeout=None):
+        """Run several calls on the remote object in one round trip.
+
+        calls is a list of (method, args) pairs; they are executed in
+        order. Return a list holding, for each call, either its result
+        or the ExternalError it raised.
+        """
+        logging.debug("Stub.multi_call({})".format(calls))
+        if not calls:
+            return []
+        answers = self._rmi(MULTI_CALL_METHOD,
+                            [[method, list(args)] for method, args in calls],
+                            timeout=timeout)
+        if len(answers) != len(calls):
+            raise ProtocolError("Expected {} answers, got {}"
+                                .format(len(calls), len(answers)))
+        results = []
+        for answer in answers:
+            try:
+                results.append(check_response(answer))
+            except ExternalError as err:
+                results.append(err)
+        return results
+
+    def batch(self, timeout=None):
+        """Return a Batch collecting calls to send with multi_call()."""
+        return Batch(self, timeout)
 
     def __getattr__(self, attr):
         """Forward call to name over the network at the given address."""
@@ -160,82 +838,601 @@ class Stub(object):
             return self._rmi(attr, *args)
         return rmi_call
 
+
+def address_list(address):
+    """Return [address] for one address, or the list given."""
+    if isinstance(address[0], (list, tuple)):
+        return [tuple(a) for a in address]
+    return [tuple(address)]
+
+
+class FailoverStub(object):
+    """ Stub for an object replicated at several addresses.
+
+    A call goes to the first of the addresses that can be reached. With
+    balance, every call starts at a random address instead, which
+    spreads the calls over all of them. Calls only move on to the next
+    address when the connection fails, unless idempotent is set: then
+    they may safely run twice, and an error raised by the remote method
+    (a replica refusing to answer) moves them on as well. Timeouts are
+    never retried.
+    """
+
+    def __init__(self, addresses, balance=False, idempotent=False,
+                 timeout=None):
+        self.stubs = [Stub(a, timeout=timeout) for a in addresses]
+        self.address = self.stubs[0].address
+        self.balance = balance
+        self.idempotent = idempotent
+        self.rand = random.Random()
+
+    def _order(self):
+        if not self.balance:
+            return self.stubs
+        i = self.rand.randrange(len(self.stubs))
+        return self.stubs[i:] + self.stubs[:i]
+
+    def call(self, method, *args, timeout=None):
+        error = None
+        for stub in self._order():
+            try:
+                return stub.call(method, *args, timeout=timeout)
+            except DeadlineExceeded:
+                raise
+            except (OSError, ComunicationError) as err:
+                error = err
+            except ExternalError as err:
+                if not self.idempotent:
+                    raise
+                error = err
+            logging.debug("{} failed at {}: {}".format(method, stub.address,
+                                                       error))
+        raise error
+
+    def call_oneway(self, method, *args, on_failure=None):
+        for stub in self._order():
+            if stub.call_oneway(method, *args):
+                return True
+        if on_failure is not None:
+            on_failure(ComunicationError("Could not send {} to any of {}"
+                                         .format(method, [s.address for s in
+                                                          self.stubs])))
+        return False
+
+    def __getattr__(self, attr):
+        def rmi_call(*args):
+            return self.call(attr, *args)
+        return rmi_call
+
+
+class Batch(object):
+    """ Calls recorded for a single round trip to a remote object.
+
+    Used as a context manager, the recorded calls are sent when the
+    block exits normally:
+
+        with stub.batch() as b:
+            b.display_status()
+            b.isAlive()
+        status, alive = b.results
+
+    Each entry of results is the value returned by the call or the
+    ExternalError it raised.
+    """
+
+    def __init__(self, stub, timeout=None):
+        self.stub = stub
+        self.timeout = timeout
+        self.calls = []
+        self.results = None
+
+    def send(self):
+        """Send the recorded calls and return their results."""
+        calls, self.calls = self.calls, []
+        self.results = self.stub.multi_call(calls, self.timeout)
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.send()
+        return False
+
+    def __getattr__(self, attr):
+        """Record a call instead of making it."""
+
+        def record(*args):
+            self.calls.append((attr, args))
+        return record
+
+def call_in_thread(fn, *args, **kwargs):
+    """Run fn(*args) on a new thread and return a Future for its result."""
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as err:
+            future.set_exception(err)
+    helper = threading.Thread(target=run)
+    helper.daemon = True
+    helper.start()
+    return future
+
+def _time_left(deadline, method):
+    """Seconds until deadline, None if there is none."""
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("Deadline of {} passed".format(method))
+    return left
+
+class _DeadlineWatcher(object):
+    """Run callbacks when their deadline passes, from a single thread.
+
+    Used to give up on multiplexed calls whose answer is late; a
+    callback whose call has been answered in the meantime does nothing.
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.heap = []      # (deadline, sequence number, callback, args)
+        self.sequence = itertools.count()
+        self.thread = None
+
+    def watch(self, deadline, callback, *args):
+        with self.lock:
+            heapq.heappush(self.heap,
+                           (deadline, next(self.sequence), callback, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.heap:
+                    self.lock.wait()
+                delay = self.heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self.lock.wait(delay)
+                    continue
+                _, _, callback, args = heapq.heappop(self.heap)
+            try:
+                callback(*args)
+            except Exception:
+                logging.info(traceback.format_exc())
+
+_deadlines = _DeadlineWatcher()
+
 class Skeleton(threading.Thread):
     """ Skeleton class for a generic owner.
 
     This is used to listen to an address of the network, manage incoming
-    connections and forward calls to the generic owner class.
+    connections and forward calls to the generic owner class. Every
+    accepted connection is served by its own Request thread.
+
+    If local_path is given, connections are also accepted on a Unix
+    domain socket created at that path. With reuse_port, several
+    processes can listen to the same address (SO_REUSEPORT) and the
+    kernel spreads the incoming connections over them.
     """
 
-    def __init__(self, owner, address):
+    def __init__(self, owner, address, backlog=128, local_path=None,
+                 reuse_port=False):
         logging.debug("Skeleton.__init__()")
         threading.Thread.__init__(self)
         self.address = address
         self.owner = owner
+        self.backlog = backlog
+        self.local_path = local_path
+        self.reuse_port = reuse_port
         self.daemon = True
 
-    def run(self):
-        logging.debug("Skeleton.run()")
+    def _listen(self):
         listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         listener.bind(self.address)
-        listener.listen(1)
+        listener.listen(self.backlog)
         logging.debug("Skeleton running at: {}".format(self.address))
+        return listener
+
+    def _listen_local(self):
+        """Return a listener on the Unix socket at local_path, or None."""
+        if self.local_path is None:
+            return None
+        remove_socket_file(self.local_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.local_path)
+            listener.listen(self.backlog)
+        except OSError as detail:
+            logging.info("Not listening to {}: {}".format(self.local_path, detail))
+            listener.close()
+            self.local_path = None
+            return None
+        logging.debug("Skeleton running at: {}".format(self.local_path))
+        return listener
+
+    def run(self):
+        logging.debug("Skeleton.run()")
+        listener = self._listen()
+        local = self._listen_local()
+        if local is not None:
+            accepter = threading.Thread(target=self._accept_all, args=(local,))
+            accepter.daemon = True
+            accepter.start()
         logging.info("Press Ctrl-C to stop the peer...")
         try:
-            while True:
-                try:
-                    conn, addr = listener.accept()
-                    req = Request(self.owner, conn, addr)
-                    logging.debug("Serving a request from {0}".format(addr))
-                    req.start()
-                except socket.error as socket_error:
-                    logging.debug(socket_error)
-                    continue
+            self._accept_all(listener)
         except KeyboardInterrupt:
             pass
         finally:
             listener.close()
 
+    def _accept_all(self, listener):
+        while True:
+            try:
+                conn, addr = listener.accept()
+                req = Request(self.owner, conn, addr)
+                logging.debug("Serving a request from {0}".format(addr))
+                req.start()
+            except socket.error as socket_error:
+                logging.debug(socket_error)
+                continue
+
+    def stats(self):
+        return {}
+
+    def queue_depth(self):
+        """Number of requests waiting for a thread; never any here."""
+        return 0
+
+
+class _Channel(object):
+    """State of one client connection served by a PooledSkeleton."""
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.buffer = bytearray()
+        # [codec, request, arrival time, decoded request or None]
+        self.inbox = collections.deque()
+        self.running = False                # a worker owns the inbox
+        self.inflight = 0                   # requests being executed
+        self.eof = False
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.last_active = time.monotonic()
+
+
+class PooledSkeleton(Skeleton):
+    """ Skeleton serving all its connections with a fixed worker pool.
+
+    A single thread accepts connections and waits for requests on all
+    of them. Complete requests are handed to a WorkerPool, so idle
+    keep-alive connections cost no thread at all. Requests without a
+    call id are still run one at a time per connection, in order, while
+    multiplexed calls from one connection may run on several workers at
+    once. When the work queue is full the request is refused with a
+    ComunicationError instead of waiting.
+
+    Priority calls (see is_priority()) are run by a second, small pool
+    of reserved workers, so that they are served even while every worker
+    waits for one of them, e.g. writes waiting for the token.
+    """
+
+    def __init__(self, owner, address, workers=8, backlog=128,
+                 max_queue=256, idle_timeout=60.0, local_path=None,
+                 reuse_port=False, reserved_workers=4):
+        Skeleton.__init__(self, owner, address, backlog, local_path,
+                          reuse_port)
+        self.pool = workerPool.WorkerPool(workers, max_queue)
+        self.reserved = workerPool.WorkerPool(reserved_workers, max_queue)
+        self.idle_timeout = idle_timeout
+        self.selector = selectors.DefaultSelector()
+
+    def run(self):
+        logging.debug("PooledSkeleton.run()")
+        listeners = [self._listen(), self._listen_local()]
+        listeners = [l for l in listeners if l is not None]
+        for listener in listeners:
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ, None)
+        logging.info("Press Ctrl-C to stop the peer...")
+        try:
+            while True:
+                events = self.selector.select(timeout=1.0)
+                for key, _ in events:
+                    if key.data is None:
+                        self._accept(key.fileobj)
+                    else:
+                        self._receive(key.data)
+                self._close_idle()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.selector.close()
+            for listener in listeners:
+                listener.close()
+
+    def stats(self):
+        return self.pool.stats()
+
+    def queue_depth(self):
+        return self.pool.tasks.qsize()
+
+    # Private methods
+
+    def _accept(self, listener):
+        try:
+            conn, addr = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as socket_error:
+            logging.debug(socket_error)
+            return
+        logging.debug("Serving requests from {0}".format(addr))
+        # Answers are sent by the workers; a timeout (instead of a
+        # non-blocking socket) keeps sendall() usable for them.
+        conn.settimeout(self.idle_timeout)
+        self.selector.register(conn, selectors.EVENT_READ, _Channel(conn, addr))
+
+    def _receive(self, channel):
+        try:
+            data = channel.conn.recv(65536)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+        except OSError as detail:
+            logging.debug("Connection from {} failed: {}".format(channel.addr, detail))
+            data = b""
+        if not data:
+            # The client has closed the connection.
+            self.selector.unregister(channel.conn)
+            with channel.lock:
+                channel.eof = True
+                idle = not channel.running and channel.inflight == 0
+            if idle:
+                channel.conn.close()
+            return
+
+        channel.last_active = time.monotonic()
+        channel.buffer += data
+        try:
+            frames, used = wireCodec.split_frames(channel.buffer)
+            if used:
+                del channel.buffer[:used]
+        except wireCodec.CodecError as detail:
+            logging.debug("Bad frame from {}: {}".format(channel.addr, detail))
+            frames = []
+            self._drop(channel)
+        now = channel.last_active
+        with channel.lock:
+            channel.inbox.extend([codec, request, now, None]
+                                 for codec, request in frames)
+            start = channel.inbox and not channel.running
+            if start:
+                channel.running = True
+        if start:
+            self._schedule(channel)
+
+    def _schedule(self, channel):
+        pool = self.pool
+        if self._next_is_priority(channel):
+            pool = self.reserved
+        if pool.submit(self._serve_next, channel):
+            return
+        # The pool is saturated: refuse what is waiting on the channel.
+        with channel.lock:
+            refused = list(channel.inbox)
+            channel.inbox.clear()
+            channel.running = False
+            eof = channel.eof
+        logging.info("Worker pool full, refusing {} request(s) from {}"
+                     .format(len(refused), channel.addr))
+        for codec, request, received, r in refused:
+            try:
+                call_id = codec.decode(request).get("id")
+            except (JSONDecodeError, wireCodec.CodecError, AttributeError):
+                call_id = None
+            error = ComunicationError("Server busy, try again later")
+            self._send(channel, codec, make_error(error, call_id))
+        if eof:
+            channel.conn.close()
+
+    def _next_is_priority(self, channel):
+        """Decode the next request of channel; True if it is a priority.
+
+        Only the thread that owns the inbox calls this, so the request
+        is still the next one when it is served.
+        """
+        with channel.lock:
+            entry = channel.inbox[0]
+        if entry[3] is None:
+            codec, request, received, _ = entry
+            try:
+                entry[3] = decode_request(request, codec, received)
+            except ProtocolError as err:
+                entry[3] = err
+        return isinstance(entry[3], dict) and is_priority(self.owner, entry[3])
+
+    def _serve_next(self, channel):
+        with channel.lock:
+            codec, request, received, r = channel.inbox.popleft()
+            channel.inflight += 1
+        logging.debug("Request received: {}".format(request))
+        if isinstance(r, ProtocolError):
+            self._send(channel, codec, make_error(r))
+            self._drop(channel)
+            with channel.lock:
+                channel.inflight -= 1
+            return
+        call = rmiMetrics.served.start(r["method"], received)
+        call.bytes_in = len(request)
+        if "id" in r:
+            # Let another worker start on the next call right away.
+            self._continue(channel)
+            self._answer(channel, codec, r, call)
+        else:
+            self._answer(channel, codec, r, call)
+            self._continue(channel)
+
+    def _answer(self, channel, codec, r, call):
+        # Process the request.
+        result = execute_request(self.owner, r)
+        if not r.get("oneway"):
+            logging.debug("Request processed. Sending result {}\n".format(result))
+            # Send the result.
+            call.bytes_out = self._send(channel, codec, result)
+        call.finish("error" in result)
+        channel.last_active = time.monotonic()
+        with channel.lock:
+            channel.inflight -= 1
+            close = channel.eof and not channel.running and channel.inflight == 0
+        if close:
+            channel.conn.close()
+
+    def _continue(self, channel):
+        with channel.lock:
+            more = len(channel.inbox) > 0
+            if not more:
+                channel.running = False
+            close = channel.eof and not more and channel.inflight == 0
+        if more:
+            self._schedule(channel)
+        elif close:
+            channel.conn.close()
+
+    def _send(self, channel, codec, result):
+        data = encode_answer(codec, result)
+        try:
+            with channel.write_lock:
+                channel.conn.sendall(data)
+        except OSError as detail:
+            logging.debug("Could not answer {}: {}".format(channel.addr, detail))
+            return 0
+        return len(data)
+
+    def _drop(self, channel):
+        try:
+            channel.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _close_idle(self):
+        now = time.monotonic()
+        for key in list(self.selector.get_map().values()):
+            channel = key.data
+            if channel is None or channel.running or channel.inflight:
+                continue
+            if now - channel.last_active > self.idle_timeout:
+                logging.debug("Closing idle connection from {}".format(channel.addr))
+                self.selector.unregister(channel.conn)
+                channel.conn.close()
+
 
 class Peer(object):
-    """Class, extended by objects that communicate over the network."""
+    """Class, extended by objects that communicate over the network.
+
+    Unless local_socket is False, the peer also listens to a Unix domain
+    socket and advertises it when registering, so that peers on the same
+    host reach it without going through TCP. reuse_port lets other
+    processes listen to the address of the peer as well. Once
+    registered, the peer keeps renewing its lease with the name service
+    from a background thread, reporting its load with every renewal.
+    ns_address may also be a list of the addresses of a replicated name
+    service, the primary first; the others are used when it cannot be
+    reached.
+
+    priority_methods names the calls that never wait for other calls;
+    subclasses add theirs. Skeletons with bounded threads serve them
+    apart from the other calls (see is_priority()).
+    """
 
-    def __init__(self, l_address, ns_address, ptype):
+    priority_methods = frozenset(["isAlive"])
+
+    def __init__(self, l_address, ns_address, ptype, workers=None,
+                 use_asyncio=False, local_socket=True, reuse_port=False):
         logging.debug("Peer.__init__()")
         self.type = ptype
         self.hash = ""
         self.id = -1
         self.address = self._get_external_interface(l_address)
-        self.skeleton = Skeleton(self, self.address)
-        self.name_service_address = self._get_external_interface(ns_address)
-        self.name_service = Stub(self.name_service_address)
+        self.lease_stop = threading.Event()
+        local_path = None
+        if local_socket:
+            local_path = connectionPool.local_socket_path(self.address)
+        if use_asyncio:
+            # Imported here as asyncOrb builds on this module.
+            from . import asyncOrb
+            self.skeleton = asyncOrb.AsyncSkeleton(self, self.address,
+                                                   workers=workers or 32,
+                                                   local_path=local_path,
+                                                   reuse_port=reuse_port)
+        elif workers:
+            self.skeleton = PooledSkeleton(self, self.address, workers,
+                                           local_path=local_path,
+                                           reuse_port=reuse_port)
+        else:
+            self.skeleton = Skeleton(self, self.address, local_path=local_path,
+                                     reuse_port=reuse_port)
+        addresses = [self._get_external_interface(a)
+                     for a in address_list(ns_address)]
+        self.name_service_address = addresses[0]
+        if len(addresses) > 1:
+            self.name_service = FailoverStub(addresses, timeout=PEER_TIMEOUT)
+        else:
+            self.name_service = Stub(self.name_service_address,
+                                     timeout=PEER_TIMEOUT)
 
     # Private methods
 
     def _get_external_interface(self, address):
-        """ Determine the external interface associated with a host name.
-
-        This function translates the machine's host name into the
-        machine's external address, not into '127.0.0.1'.
-        """
         logging.debug("Peer._get_external_interface(self, {})".format(address))
+        return external_interface(address)
 
-        addr_name = address[0]
-        if addr_name != "":
-            addrs = socket.gethostbyname_ex(addr_name)[2]
-            if len(addrs) == 0:
-                raise ComunicationError("Invalid address to listen to")
-            elif len(addrs) == 1:
-                addr_name = addrs[0]
-            else:
-                al = [a for a in addrs if a != "127.0.0.1"]
-                addr_name = al[0]
-        addr = list(address)
-        addr[0] = addr_name
-        return tuple(addr)
+    def _register(self):
+        """Register with the name service; return the lease ttl or None."""
+        reply = self.name_service.register(self.type, self.address,
+                                           self.local_address)
+        self.id, self.hash = reply[0], reply[1]
+        return reply[2] if len(reply) > 2 else None
+
+    def _renew_lease(self, ttl):
+        """Renew the registration three times per lease, until destroy().
+
+        If the name service gave the id of this peer to another one in
+        the meantime, the peer registers again under a new id.
+        """
+        while not self.lease_stop.wait(ttl / 3.0):
+            try:
+                renewed = self.name_service.call(
+                    "renew", self.id, self.type, self.hash,
+                    self.local_address, load_report(self), timeout=ttl / 3.0)
+                if not renewed:
+                    old = self.id
+                    ttl = self._register() or ttl
+                    logging.info("Id {} was given to another peer, "
+                                 "registered again as {}".format(old, self.id))
+            except Exception as err:
+                logging.debug("Could not renew the lease: {}".format(err))
 
     # Public methods
 
+    @property
+    def local_address(self):
+        """The [host, path] of the Unix socket listened to, or None."""
+        if self.skeleton.local_path is None:
+            return None
+        return [connectionPool.HOST, self.skeleton.local_path]
+
     def start(self):
         """Start the communication interface."""
         
@@ -245,72 +1442,110 @@ class Peer(object):
 
         logging.debug("Peer done starting Skeleton!")
         logging.debug("Peer registering name service...")
-        self.id, self.hash = self.name_service.register(self.type,
-                                                        self.address)
+        ttl = self._register()
         logging.debug("Peer done registering name service!\n{}"
                       .format((self.id, self.hash)))
+        if ttl is not None:
+            renewer = threading.Thread(target=self._renew_lease,
+                                       args=(ttl,))
+            renewer.daemon = True
+            renewer.start()
 
     def destroy(self):
         """Unregister the object before removal."""
 
         logging.debug("Peer unregistering from name service...")
+        self.lease_stop.set()
         self.name_service.unregister(self.id, self.type, self.hash)
         logging.debug("Peer unregistered from name service")
+        if self.skeleton.local_path is not None:
+            remove_socket_file(self.skeleton.local_path)
 
     def isAlive(self):
         """Someone is checking to see if I'm still alive."""
         logging.debug("Someone wants to know I'm still alive. Responding with {}".format((self.id, self.type)))
         return (self.id, self.type)
 
+    def display_stats(self):
+        """Print the RMI metrics of this peer."""
+        print(rmiMetrics.format_stats(collect_stats(self)))
+
+    def reset_stats(self):
+        """Print the RMI metrics of this peer and start them over."""
+        print(rmiMetrics.format_stats(_reset_stats(self)))
+
+def external_interface(address):
+    """ Determine the external interface associated with a host name.
+
+    This function translates the machine's host name into the
+    machine's external address, not into '127.0.0.1'.
+    """
+    addr_name = address[0]
+    if addr_name != "":
+        addrs = socket.gethostbyname_ex(addr_name)[2]
+        if len(addrs) == 0:
+            raise ComunicationError("Invalid address to listen to")
+        elif len(addrs) == 1:
+            addr_name = addrs[0]
+        else:
+            al = [a for a in addrs if a != "127.0.0.1"]
+            addr_name = al[0]
+    addr = list(address)
+    addr[0] = addr_name
+    return tuple(addr)
+
+def remove_socket_file(path):
+    """Remove a Unix socket file left behind, if there is one."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as detail:
+        logging.debug("Could not remove {}: {}".format(path, detail))
+
 # Liveness Checking
 # (Really doesn't need to belong to any object in particular)
 
 def checkLiveness(pID, pStub, obj_type, timeout=5):
     """ Used to detect if a peer is still alive. """
     logging.debug("Confirming connection to peer {}.".format(pID))
+    expected = [pID, obj_type]
     try:
-        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
-        p = multiprocessing.Process(
-            target=_get_line,
-            args=(child_conn, pID, pStub, obj_type)
-        )
-        p.daemon = True
-        p.start()
-        it_did_timeout = (not parent_conn.poll(timeout))
-        if it_did_timeout:
-            logging.info("Connection to peer {} timed out.".format(pID))
-            return False
-        else:
-            parent_said_yes = parent_conn.recv()
-            if not parent_said_yes:
-                logging.info("No connection to peer {} established.".format(pID))
-            return parent_said_yes
-    except:
-        err = sys.exc_info()
-        logging.debug("Encountered an error while spawning a process to check if peer {} is still alive:\n{}: {}"
-                      .format(pID, err[0], err[1]))
+        response = pStub.call("isAlive", timeout=timeout)
+    except DeadlineExceeded:
+        logging.debug("Connection to peer {} timed out.".format(pID))
         return False
-
-def _get_line(conn, pID, pStub, obj_type):
-    """ Helper function for checkLiveness(). """
-    result = False
-    try:
-        expected = [pID, obj_type]
-        response = pStub.isAlive()
-        result = (response == expected)
-        logging.debug("PeerList received response {} from peer {}".format(response, pID))
-        if result is True:
-            logging.debug("This was the expected response.")
-        else:
-            logging.debug("This was not the expected response.\n Expected response: {}"
-                          .format(expected))
     except ConnectionRefusedError:
-        logging.info("Peer {} refused connection".format(pID))
-        result = False
-    except:
+        logging.debug("Peer {} refused connection".format(pID))
+        return False
+    except Exception:
         err = sys.exc_info()
-        logging.debug("Encountered an error trying to check if peer {} is still alive:\n{}: {}"
-                     .format(pID, err[0], err[1]))
-    finally:
-        conn.send(result)
+        logging.debug("No connection to peer {} established.".format(pID))
+        logging.debug("{}: {}".format(err[0], err[1]))
+        return False
+    logging.debug("PeerList received response {} from peer {}".format(response, pID))
+    if response == expected:
+        logging.debug("This was the expected response.")
+        return True
+    logging.debug("This was not the expected response.\n Expected response: {}"
+                  .format(expected))
+    return False
 
+def checkLivenessAll(peers, timeout=5):
+    """ Detect which of many peers are not alive.
+
+    peers is an iterable of (pID, pStub, obj_type). All the peers are
+    probed at once and the probes share one deadline, so the check never
+    takes much longer than timeout however many peers are dead. Return
+    the set of the ids of the peers that are not alive.
+    """
+    probes = {}
+    for pID, pStub, obj_type in peers:
+        probe = call_in_thread(checkLiveness, pID, pStub, obj_type, timeout)
+        probes[probe] = pID
+    done, pending = wait(probes, timeout)
+    dead = set(probes[probe] for probe in done if not probe.result())
+    for probe in pending:
+        logging.debug("Connection to peer {} timed out.".format(probes[probe]))
+        dead.add(probes[probe])
+    return dead
@@ -0,0 +1,192 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Client side cache of the name service.
+
+A Resolver answers get_peers() and require_object() like the name
+service does, from the members of each object type it fetched with
+get_peers() less than ttl seconds ago. So a client asks the name
+service about a type about once per ttl instead of once per lookup.
+require_any() is still asked of the name service, which alone knows the
+load of the peers and applies its selection policy (see its -s option);
+the cache only serves it while the name service cannot be reached.
+
+--  refresh ::
+        A background thread fetches the types that were looked up since
+        its last round again every ttl / 2 seconds, so lookups of types
+        in use do not wait for the name service. Types nobody looked up
+        for a round are dropped.
+--  replicas ::
+        Given the addresses of several name servers, every fetch asks
+        one of them at random, and the next ones if it fails.
+--  invalidation ::
+        invalidate(address) forgets a member; callers do it when a call
+        to an address they got from the resolver fails with a connection
+        error (see connection_error()). The address is left out of the
+        answers of the name service for ttl seconds too, as its lease may
+        not have run out yet. A type without members left is fetched
+        again on its next lookup.
+"""
+
+import time
+import random
+import socket
+import threading
+import logging
+import traceback
+
+from . import orb
+
+
+def connection_error(err):
+    """True if err means the peer could not be reached at all."""
+    if isinstance(err, (orb.DeadlineExceeded, socket.timeout)):
+        return False
+    return isinstance(err, (OSError, orb.ComunicationError))
+
+
+class _Entry(object):
+
+    """The members of one object type, as last fetched."""
+
+    def __init__(self, members, now, used):
+        self.members = members      # [(id, address, local)]
+        self.fetched = now
+        self.used = used            # looked up since the last refresh
+
+
+class Resolver(object):
+
+    """Cache the answers of the name service for ttl seconds.
+
+    Public methods:
+        --  __init__(ns_address, ttl)
+        --  get_peers(obj_type)
+        --  require_any(obj_type)
+        --  require_object(obj_type, obj_id)
+        --  invalidate(address)
+        --  stop()
+
+    """
+
+    def __init__(self, ns_address, ttl=5.0):
+        self.name_service = orb.FailoverStub(orb.address_list(ns_address),
+                                             balance=True, idempotent=True)
+        self.ttl = ttl
+        self.lock = threading.Condition()
+        self.entries = {}       # obj_type -> _Entry
+        self.failed = {}        # address -> time.monotonic() it failed
+        self.rand = random.Random()
+        self.thread = None
+        self.stopped = False
+
+    # Public methods
+
+    def get_peers(self, obj_type):
+        """Return (id, address, local) for all the peers of obj_type."""
+        return list(self._members(obj_type))
+
+    def require_any(self, obj_type):
+        """Return the address of a peer of obj_type.
+
+        The name service picks the peer. If it cannot be asked, or picks
+        an address that was invalidated, a cached member is chosen at
+        random instead.
+        """
+        try:
+            address = tuple(self.name_service.require_any(obj_type))
+        except Exception as err:
+            logging.debug("Picking a cached peer of {}: {}"
+                          .format(obj_type, err))
+        else:
+            with self.lock:
+                failed = self.failed.get(address)
+                if failed is None or time.monotonic() - failed >= self.ttl:
+                    return address
+        members = self._members(obj_type)
+        if not members:
+            raise Exception("No peer of type: '{}'".format(obj_type))
+        return tuple(self.rand.choice(members)[1])
+
+    def require_object(self, obj_type, obj_id):
+        """Return the address of the peer of obj_type with id obj_id.
+
+        Ids missing from the cache are looked up again, as the peer may
+        have registered after the type was fetched.
+        """
+        for fresh in (False, True):
+            for member_id, address, _ in self._members(obj_type, fresh):
+                if member_id == obj_id:
+                    return tuple(address)
+        raise Exception("No peer of type '{}' with id: '{}'"
+                        .format(obj_type, obj_id))
+
+    def invalidate(self, address):
+        """Forget the member at address, which could not be reached."""
+        address = tuple(address)
+        with self.lock:
+            self.failed[address] = time.monotonic()
+            for obj_type, entry in list(self.entries.items()):
+                members = [m for m in entry.members if tuple(m[1]) != address]
+                if len(members) == len(entry.members):
+                    continue
+                logging.debug("Forgetting {} ({}).".format(address, obj_type))
+                if members:
+                    entry.members = members
+                else:
+                    del self.entries[obj_type]
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.thread = None
+            self.lock.notify_all()
+
+    # Private methods
+
+    def _members(self, obj_type, fresh=False):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(obj_type)
+            if entry is not None and not fresh and now - entry.fetched < self.ttl:
+                entry.used = True
+                return entry.members
+        return self._fetch(obj_type)
+
+    def _fetch(self, obj_type, used=True):
+        members = self.name_service.get_peers(obj_type)
+        with self.lock:
+            now = time.monotonic()
+            for address, failed in list(self.failed.items()):
+                if now - failed >= self.ttl:
+                    del self.failed[address]
+            members = [tuple(m) for m in members
+                       if tuple(m[1]) not in self.failed]
+            self.entries[obj_type] = _Entry(members, time.monotonic(), used)
+            if self.thread is None and not self.stopped:
+                self.thread = threading.Thread(target=self._refresh,
+                                               name="resolver")
+                self.thread.daemon = True
+                self.thread.start()
+        return members
+
+    def _refresh(self):
+        while True:
+            with self.lock:
+                self.lock.wait(self.ttl / 2)
+                if self.stopped:
+                    return
+                wanted = []
+                for obj_type, entry in list(self.entries.items()):
+                    if entry.used:
+                        entry.used = False
+                        wanted.append(obj_type)
+                    else:
+                        del self.entries[obj_type]
+            for obj_type in wanted:
+                try:
+                    self._fetch(obj_type, used=False)
+                except Exception:
+                    # Served from the cache until it expires.
+                    logging.debug(traceback.format_exc())
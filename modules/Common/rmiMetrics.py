@@ -0,0 +1,225 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Per-method counters and latency histograms of remote method calls.
+
+The object request broker keeps two sets of metrics per process:
+
+--  calls ::
+        Calls made through a Stub, measured from the moment the call is
+        started until its answer has been decoded.
+--  served ::
+        Calls answered by a skeleton, measured from the moment the
+        request arrived until its answer has been written.
+
+For every method they count calls, failed calls (including calls
+answered with an error) and the bytes sent and received, and keep a
+histogram of latencies from which percentiles are read. They also count
+the calls in flight and keep a histogram of the latencies of all the
+calls since the last report(), a peer's recent load. Histogram
+buckets grow geometrically, so percentiles are approximate: a reported
+value is at most one bucket (about 19%) above the real one.
+"""
+
+import math
+import threading
+import time
+
+# Bucket i holds the latencies up to BASE * RATIO ** i seconds.
+BASE = 1e-5
+RATIO = 2 ** 0.25
+BUCKETS = 100       # up to about five minutes
+_LOG_RATIO = math.log(RATIO)
+
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram(object):
+
+    """Latency histogram with logarithmic buckets."""
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= BASE:
+            i = 0
+        else:
+            i = min(int(math.ceil(math.log(seconds / BASE) / _LOG_RATIO)),
+                    BUCKETS - 1)
+        self.counts[i] += 1
+        self.total += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding percentile p."""
+        if self.total == 0:
+            return 0.0
+        rank = max(1, int(math.ceil(self.total * p / 100.0)))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(BASE * RATIO ** i, self.max)
+        return self.max
+
+
+class MethodStats(object):
+
+    """Counters of one method."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        stats = {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "max": self.latency.max,
+        }
+        for p in PERCENTILES:
+            stats["p{}".format(p)] = self.latency.percentile(p)
+        return stats
+
+
+class Call(object):
+
+    """Measurement of one call, recorded by finish().
+
+    The byte counters are filled in by whoever reads or writes the call.
+    Used as a context manager, the call is recorded as failed if the
+    block raises.
+    """
+
+    def __init__(self, metrics, method, started=None):
+        self.metrics = metrics
+        self.method = method
+        self.started = time.monotonic() if started is None else started
+        self.generation = metrics.generation
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def finish(self, failed=False):
+        self.metrics._end(self, time.monotonic() - self.started, failed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.finish(exc_type is not None)
+        return False
+
+
+class Metrics(object):
+
+    """Metrics of all the methods called in one direction.
+
+    Public methods:
+        --  start(method, started)
+        --  snapshot()
+        --  report()
+        --  reset()
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}   # method name -> MethodStats
+        self.in_flight = 0  # calls started and not finished
+        self.recent = Histogram()
+        self.generation = 0 # number of resets
+
+    def start(self, method, started=None):
+        """Return a Call measuring method, started now or at started."""
+        with self.lock:
+            self.in_flight += 1
+            return Call(self, method, started)
+
+    def report(self):
+        """Return the calls in flight and the p99 latency of the calls
+        finished since the last report, and start a new period."""
+        with self.lock:
+            recent, self.recent = self.recent, Histogram()
+            return {"in_flight": self.in_flight,
+                    "p99": recent.percentile(99)}
+
+    def snapshot(self):
+        """Return {method: {count, errors, bytes_in, bytes_out, p50, ...}}."""
+        with self.lock:
+            return {method: stats.snapshot()
+                    for method, stats in self.methods.items()}
+
+    def reset(self):
+        """Forget every call so far; calls in flight are not recorded."""
+        with self.lock:
+            self.methods = {}
+            self.in_flight = 0
+            self.recent = Histogram()
+            self.generation += 1
+
+    # Private methods
+
+    def _end(self, call, seconds, failed):
+        with self.lock:
+            if call.generation != self.generation:
+                # Started before a reset.
+                return
+            self.in_flight -= 1
+            self._add(call.method, seconds, call.bytes_in, call.bytes_out,
+                      failed)
+
+    def _add(self, method, seconds, bytes_in, bytes_out, failed):
+        stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = MethodStats()
+        stats.count += 1
+        if failed:
+            stats.errors += 1
+        stats.bytes_in += bytes_in
+        stats.bytes_out += bytes_out
+        stats.latency.add(seconds)
+        self.recent.add(seconds)
+
+
+calls = Metrics()
+served = Metrics()
+
+
+def format_stats(stats):
+    """Return a printable table of the snapshot(s) in stats.
+
+    stats maps a title to a snapshot, e.g. the answer of a __stats__
+    call; entries that are not snapshots (skeleton statistics) are
+    printed as key/value pairs.
+    """
+    lines = []
+    for title in sorted(stats):
+        table = stats[title]
+        lines.append("{}:".format(title.capitalize()))
+        if not table:
+            lines.append("    (none)")
+            continue
+        if not all(isinstance(row, dict) for row in table.values()):
+            for key in sorted(table):
+                lines.append("    {:<20} {}".format(key, table[key]))
+            continue
+        lines.append("    {:<20} {:>7} {:>6} {:>10} {:>10} {:>9} {:>9} {:>9}"
+                     .format("method", "count", "errors", "bytes in",
+                             "bytes out", "p50 ms", "p95 ms", "p99 ms"))
+        for method in sorted(table):
+            row = table[method]
+            lines.append(
+                "    {:<20} {:>7} {:>6} {:>10} {:>10} {:>9.3f} {:>9.3f} {:>9.3f}"
+                .format(method, row["count"], row["errors"], row["bytes_in"],
+                        row["bytes_out"], row["p50"] * 1000,
+                        row["p95"] * 1000, row["p99"] * 1000))
+    return "\n".join(lines)
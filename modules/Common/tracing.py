@@ -0,0 +1,191 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Distributed tracing of remote method calls.
+
+Every remote call can carry a trace context: the id of the trace it
+belongs to and the id of the span that made it. A Stub sends it under
+the "trace" key of the message, and the skeleton that runs the call
+makes it the parent of the span covering the execution, so calls made
+while serving the request join the same trace.
+
+Context is always passed on. Spans are only written once configure()
+has been called, one JSON object per line:
+
+--  trace, span, parent ::
+        Trace id, span id, and id of the parent span (None for a root).
+--  name, kind ::
+        The method or step measured, and "client" (a call made by a
+        Stub), "server" (a call run by a skeleton) or "internal".
+--  service ::
+        The process that recorded the span, as given to configure().
+--  start, duration ::
+        Wall clock start time and duration, in seconds.
+--  error ::
+        Name of the exception that ended the span, or None.
+
+Each process writes its own file; lab5/traceMerge.py merges them into
+one timeline per trace. Start times come from the clocks of different
+machines, so a timeline is only as accurate as their synchronisation.
+"""
+
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+
+CLIENT = "client"
+SERVER = "server"
+INTERNAL = "internal"
+
+# (trace id, span id) of the span running in this thread or task.
+_current = contextvars.ContextVar("trace_context", default=None)
+
+_lock = threading.Lock()
+_output = None
+_service = None
+
+
+def configure(path, service):
+    """Append the spans recorded by this process to the file at path."""
+    global _output, _service
+    with _lock:
+        if _output is not None:
+            _output.close()
+        _output = open(path, "a", buffering=1)
+        _service = service
+    logging.info("Writing trace spans to {}".format(path))
+
+
+def enabled():
+    return _output is not None
+
+
+def current():
+    """Return the (trace id, span id) of the running span, or None."""
+    return _current.get()
+
+
+def _new_id():
+    return "{:016x}".format(random.getrandbits(64))
+
+
+class Span(object):
+
+    """A timed step of a trace.
+
+    context is the (trace id, span id) pair to send along with calls
+    made on behalf of the span. Spans are recorded by finish() only if
+    tracing is enabled, but always have a context so that it can be
+    passed on.
+    """
+
+    def __init__(self, name, kind=INTERNAL, parent=None, **attributes):
+        if parent is None:
+            parent = _current.get()
+        if parent is None:
+            self.trace_id, self.parent_id = _new_id(), None
+        else:
+            self.trace_id, self.parent_id = parent[0], parent[1]
+        self.span_id = _new_id()
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.start = time.time()
+        self.started = time.monotonic()
+        self.error = None
+        self.token = None
+
+    @property
+    def context(self):
+        return [self.trace_id, self.span_id]
+
+    def fail(self, error):
+        """Mark the span as failed with error, recorded when it ends."""
+        self.error = type(error).__name__
+
+    def finish(self, error=None):
+        if _output is None:
+            return
+        if error is None:
+            error = self.error
+        record = {
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "service": _service,
+            "start": self.start,
+            "duration": time.monotonic() - self.started,
+            "error": error,
+        }
+        if self.attributes:
+            record.update(self.attributes)
+        line = json.dumps(record, default=str) + "\n"
+        with _lock:
+            if _output is not None:
+                _output.write(line)
+
+    def __enter__(self):
+        # Calls made inside the block become children of this span.
+        self.token = _current.set((self.trace_id, self.span_id))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _current.reset(self.token)
+        self.finish(exc_type.__name__ if exc_type is not None else None)
+        return False
+
+
+class _NoSpan(object):
+
+    """Stands in for a span when there is nothing to record or pass on."""
+
+    context = None
+
+    def fail(self, error):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, kind=INTERNAL, **attributes):
+    """Return a span for a step of the current trace, used with "with".
+
+    Without a current trace and with tracing disabled nothing is
+    measured.
+    """
+    if _output is None and _current.get() is None:
+        return _NO_SPAN
+    return Span(name, kind, **attributes)
+
+
+def client_span(method, address):
+    """Return the span of a call to method at address, started now."""
+    return span(method, CLIENT, peer="{}:{}".format(*address))
+
+
+def server_span(request):
+    """Return the span running a decoded request, used with "with".
+
+    The span continues the trace the request came with, if any.
+    """
+    context = request.get("trace")
+    if isinstance(context, list) and len(context) == 2:
+        return Span(request["method"], SERVER, tuple(context))
+    if _output is None and _current.get() is None:
+        return _NO_SPAN
+    return Span(request["method"], SERVER)
@@ -0,0 +1,610 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Wire codecs used by the object request broker.
+
+Three codecs are available:
+
+--  json ::
+        The original format: one JSON document per line. Every peer
+        understands it, so it is always the fallback.
+--  binary ::
+        Length-prefixed frames. Each frame starts with a struct-packed
+        header (magic byte, flags, payload length) followed by a compact
+        tagged encoding of the message. Integer dictionary keys survive
+        the trip, and payloads may contain anything, newlines included.
+--  zlib ::
+        Binary frames whose payload is compressed with zlib when it is
+        at least COMPRESS_THRESHOLD bytes long and compression shrinks
+        it. Every frame it sends has the ACCEPT_ZLIB flag set, so that
+        the answers to it are compressed as well.
+
+The magic byte can never start a JSON document, so a reader can tell
+the two formats apart from the first byte of every message. A server
+answers each request with the codec the request came in; the client
+learns which codecs a server decodes by calling the reserved
+CODEC_METHOD once per connection. Compression is only offered by
+stubs once use_compression() has been called.
+"""
+
+import json
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = 0xB7
+HEADER = struct.Struct("!BBI")      # magic, flags, payload length
+
+# Frame flags.
+ZLIB_PAYLOAD = 0x01     # the payload is compressed
+ACCEPT_ZLIB = 0x02      # the sender wants compressed answers
+KNOWN_FLAGS = ZLIB_PAYLOAD | ACCEPT_ZLIB
+
+# Smallest payload worth compressing, and the zlib level used.
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+# Largest payload a compressed frame may inflate to.
+MAX_INFLATED = 2 ** 27
+
+# Reserved method used to agree on a codec. It is answered by the
+# connection itself, never by the owner object.
+CODEC_METHOD = "__codec__"
+
+# Value tags of the binary encoding.
+NONE = 0x00
+TRUE = 0x01
+FALSE = 0x02
+INT8 = 0x03
+INT32 = 0x04
+INT64 = 0x05
+BIGINT = 0x06
+FLOAT = 0x07
+STR = 0x08
+BYTES = 0x09
+LIST = 0x0A
+DICT = 0x0B
+# Packed forms of common homogeneous containers, encoded with a single
+# struct call instead of one tag per item.
+INTS = 0x0C         # list of int64
+INT_DICT = 0x0D     # dict of int64 keys to int64 values
+STRS = 0x0E         # list of str
+
+_TAG = struct.Struct("!B")
+_INT8 = struct.Struct("!Bb")
+_INT32 = struct.Struct("!Bi")
+_INT64 = struct.Struct("!Bq")
+_FLOAT = struct.Struct("!Bd")
+_SIZED = struct.Struct("!BI")       # tag and a length or item count
+_SIZE = struct.Struct("!I")
+
+_NONE_BYTES = _TAG.pack(NONE)
+_TRUE_BYTES = _TAG.pack(TRUE)
+_FALSE_BYTES = _TAG.pack(FALSE)
+
+
+class CodecError(ValueError):
+    pass
+
+
+# Binary encoding
+
+def encode_value(value):
+    """Encode a value made of None, bools, numbers, strings, bytes, lists,
+    tuples and dictionaries."""
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+
+def _encode_frame(value, flags=0):
+    """Encode value into a complete binary frame, header included.
+
+    The header is patched in front of the payload once its length is
+    known, so the message is built in a single buffer without copies.
+    """
+    out = bytearray(HEADER.size)
+    _encode(value, out)
+    HEADER.pack_into(out, 0, MAGIC, flags, len(out) - HEADER.size)
+    return out
+
+
+def _encode(value, out):
+    t = type(value)
+    if t is str:
+        data = value.encode("utf-8")
+        out += _SIZED.pack(STR, len(data))
+        out += data
+    elif t is int:
+        if -0x80 <= value < 0x80:
+            out += _INT8.pack(INT8, value)
+        elif -0x80000000 <= value < 0x80000000:
+            out += _INT32.pack(INT32, value)
+        elif -0x8000000000000000 <= value < 0x8000000000000000:
+            out += _INT64.pack(INT64, value)
+        else:
+            data = str(value).encode("ascii")
+            out += _SIZED.pack(BIGINT, len(data))
+            out += data
+    elif value is None:
+        out += _NONE_BYTES
+    elif value is True:
+        out += _TRUE_BYTES
+    elif value is False:
+        out += _FALSE_BYTES
+    elif isinstance(value, dict):
+        if len(value) > 1 and _encode_int_dict(value, out):
+            return
+        out += _SIZED.pack(DICT, len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    elif isinstance(value, (list, tuple)):
+        if len(value) > 1:
+            first = type(value[0])
+            if first is int and _encode_ints(value, out):
+                return
+            if first is str and _encode_strs(value, out):
+                return
+        out += _SIZED.pack(LIST, len(value))
+        for item in value:
+            _encode(item, out)
+    elif t is float:
+        out += _FLOAT.pack(FLOAT, value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += _SIZED.pack(BYTES, len(value))
+        out += value
+    elif isinstance(value, int):
+        _encode(int(value), out)
+    elif isinstance(value, str):
+        _encode(str(value), out)
+    else:
+        raise CodecError("Cannot encode a value of type {}"
+                         .format(t.__name__))
+
+
+def _encode_ints(value, out):
+    for item in value:
+        if type(item) is not int:
+            return False
+    try:
+        packed = struct.pack("!{}q".format(len(value)), *value)
+    except struct.error:
+        return False
+    out += _SIZED.pack(INTS, len(value))
+    out += packed
+    return True
+
+
+def _encode_int_dict(value, out):
+    for key, item in value.items():
+        if type(key) is not int or type(item) is not int:
+            return False
+    fmt = "!{}q".format(len(value))
+    try:
+        keys = struct.pack(fmt, *value.keys())
+        items = struct.pack(fmt, *value.values())
+    except struct.error:
+        return False
+    out += _SIZED.pack(INT_DICT, len(value))
+    out += keys
+    out += items
+    return True
+
+
+def _encode_strs(value, out):
+    for item in value:
+        if type(item) is not str:
+            return False
+    # Lengths are counted in characters so that the whole text can be
+    # decoded at once and sliced.
+    data = "".join(value).encode("utf-8")
+    out += _SIZED.pack(STRS, len(value))
+    out += struct.pack("!{}I".format(len(value)), *map(len, value))
+    out += _SIZE.pack(len(data))
+    out += data
+    return True
+
+
+def decode_value(data):
+    """The reverse operation to encode_value()."""
+    view = memoryview(data)
+    try:
+        value, offset = _decode(view, 0)
+    except (struct.error, IndexError, UnicodeDecodeError,
+            ValueError, TypeError) as err:
+        raise CodecError("Malformed binary message: {}".format(err))
+    if offset != len(view):
+        raise CodecError("Trailing bytes after binary message")
+    return value
+
+
+def _decode(view, offset):
+    tag = view[offset]
+    if tag == STR:
+        size, = _SIZE.unpack_from(view, offset + 1)
+        start = offset + 5
+        end = start + size
+        if end > len(view):
+            raise CodecError("Truncated string")
+        return str(view[start:end], "utf-8"), end
+    if tag == INT8:
+        return _INT8.unpack_from(view, offset)[1], offset + 2
+    if tag == INT32:
+        return _INT32.unpack_from(view, offset)[1], offset + 5
+    if tag == LIST:
+        count, = _SIZE.unpack_from(view, offset + 1)
+        offset += 5
+        items = []
+        for i in range(count):
+            item, offset = _decode(view, offset)
+            items.append(item)
+        return items, offset
+    if tag == DICT:
+        count, = _SIZE.unpack_from(view, offset + 1)
+        offset += 5
+        items = {}
+        for i in range(count):
+            key, offset = _decode(view, offset)
+            value, offset = _decode(view, offset)
+            if isinstance(key, list):
+                # Lists are not hashable; the sender had a tuple.
+                key = tuple(key)
+            items[key] = value
+        return items, offset
+    if tag == INTS:
+        count, = _SIZE.unpack_from(view, offset + 1)
+        offset += 5
+        items = list(struct.unpack_from("!{}q".format(count), view, offset))
+        return items, offset + 8 * count
+    if tag == INT_DICT:
+        count, = _SIZE.unpack_from(view, offset + 1)
+        offset += 5
+        fmt = "!{}q".format(count)
+        keys = struct.unpack_from(fmt, view, offset)
+        items = struct.unpack_from(fmt, view, offset + 8 * count)
+        return dict(zip(keys, items)), offset + 16 * count
+    if tag == STRS:
+        count, = _SIZE.unpack_from(view, offset + 1)
+        offset += 5
+        lengths = struct.unpack_from("!{}I".format(count), view, offset)
+        offset += 4 * count
+        size, = _SIZE.unpack_from(view, offset)
+        start = offset + 4
+        end = start + size
+        if end > len(view):
+            raise CodecError("Truncated string list")
+        text = str(view[start:end], "utf-8")
+        items = []
+        position = 0
+        for length in lengths:
+            items.append(text[position:position + length])
+            position += length
+        if position != len(text):
+            raise CodecError("Bad string list lengths")
+        return items, end
+    if tag == NONE:
+        return None, offset + 1
+    if tag == TRUE:
+        return True, offset + 1
+    if tag == FALSE:
+        return False, offset + 1
+    if tag == INT64:
+        return _INT64.unpack_from(view, offset)[1], offset + 9
+    if tag == FLOAT:
+        return _FLOAT.unpack_from(view, offset)[1], offset + 9
+    if tag == BIGINT or tag == BYTES:
+        size, = _SIZE.unpack_from(view, offset + 1)
+        start = offset + 5
+        end = start + size
+        if end > len(view):
+            raise CodecError("Truncated value")
+        if tag == BYTES:
+            return bytes(view[start:end]), end
+        return int(str(view[start:end], "ascii")), end
+    raise CodecError("Unknown tag 0x{:02x}".format(tag))
+
+
+# Codecs
+
+class JsonCodec(object):
+
+    """One JSON document per line."""
+
+    name = "json"
+
+    def encode(self, message):
+        return (json.dumps(message) + '\n').encode("utf-8")
+
+    def decode(self, payload):
+        """Decode a line. Raises json.JSONDecodeError on bad input."""
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            payload = bytes(payload).decode("utf-8")
+        return json.loads(payload)
+
+
+class BinaryCodec(object):
+
+    """Length-prefixed frames holding binary encoded messages."""
+
+    name = "binary"
+
+    def encode(self, message):
+        return _encode_frame(message)
+
+    def decode(self, payload):
+        """Decode a frame payload. Raises CodecError on bad input."""
+        return decode_value(payload)
+
+
+class ZlibCodec(BinaryCodec):
+
+    """Binary frames, compressed above COMPRESS_THRESHOLD bytes."""
+
+    name = "zlib"
+
+    def encode(self, message):
+        frame = _encode_frame(message, ACCEPT_ZLIB)
+        size = len(frame) - HEADER.size
+        if size < COMPRESS_THRESHOLD:
+            return frame
+        started = time.thread_time()
+        packed = zlib.compress(memoryview(frame)[HEADER.size:], COMPRESS_LEVEL)
+        _count_compression(size, len(packed), time.thread_time() - started)
+        if len(packed) >= size:
+            return frame
+        return HEADER.pack(MAGIC, ACCEPT_ZLIB | ZLIB_PAYLOAD, len(packed)) + packed
+
+
+class _InflatingZlibCodec(ZlibCodec):
+
+    """The zlib codec for frames whose payload is compressed."""
+
+    def decode(self, payload):
+        started = time.thread_time()
+        inflater = zlib.decompressobj()
+        try:
+            data = inflater.decompress(payload, MAX_INFLATED)
+        except zlib.error as err:
+            raise CodecError("Bad compressed payload: {}".format(err))
+        if inflater.unconsumed_tail:
+            raise CodecError("Compressed payload inflates beyond {} bytes"
+                             .format(MAX_INFLATED))
+        _count_decompression(time.thread_time() - started)
+        return decode_value(data)
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+ZLIB = ZlibCodec()
+_INFLATING_ZLIB = _InflatingZlibCodec()
+CODECS = {JSON.name: JSON, BINARY.name: BINARY, ZLIB.name: ZLIB}
+
+# Codecs offered by a Stub, in order of preference.
+DEFAULT_CODECS = ("binary", "json")
+
+
+def use_compression(threshold=None, level=None):
+    """Make the stubs created from now on offer the zlib codec first."""
+    global DEFAULT_CODECS, COMPRESS_THRESHOLD, COMPRESS_LEVEL
+    if threshold is not None:
+        COMPRESS_THRESHOLD = threshold
+    if level is not None:
+        COMPRESS_LEVEL = level
+    DEFAULT_CODECS = (ZLIB.name,) + tuple(name for name in DEFAULT_CODECS
+                                          if name != ZLIB.name)
+
+
+# Compression counters
+
+_stats_lock = threading.Lock()
+_stats = {
+    "compressed": 0,        # payloads the zlib codec tried to compress
+    "raw_bytes": 0,         # their size before compression
+    "packed_bytes": 0,      # their size after compression
+    "compress_cpu": 0.0,    # seconds of CPU spent compressing
+    "decompressed": 0,      # compressed payloads received
+    "decompress_cpu": 0.0,  # seconds of CPU spent decompressing
+}
+
+
+def _count_compression(raw, packed, cpu):
+    with _stats_lock:
+        _stats["compressed"] += 1
+        _stats["raw_bytes"] += raw
+        _stats["packed_bytes"] += packed
+        _stats["compress_cpu"] += cpu
+
+
+def _count_decompression(cpu):
+    with _stats_lock:
+        _stats["decompressed"] += 1
+        _stats["decompress_cpu"] += cpu
+
+
+def compression_stats():
+    """Return the compression counters, with the overall ratio."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["ratio"] = (stats["packed_bytes"] / stats["raw_bytes"]
+                      if stats["raw_bytes"] else 1.0)
+    return stats
+
+
+def get(name):
+    return CODECS[name]
+
+
+def choose(offered):
+    """Return the name of the first offered codec this side supports."""
+    for name in offered:
+        if name in CODECS:
+            return name
+    return JSON.name
+
+
+# Framing
+
+def frame_codec(flags):
+    """Return the codec decoding the payload of a frame with flags."""
+    if flags & ~KNOWN_FLAGS:
+        raise CodecError("Unsupported frame flags 0x{:02x}".format(flags))
+    if flags & ZLIB_PAYLOAD:
+        return _INFLATING_ZLIB
+    if flags & ACCEPT_ZLIB:
+        return ZLIB
+    return BINARY
+
+
+class FrameReader(object):
+
+    """Read messages from a socket into a reusable buffer.
+
+    Data is received with recv_into() straight into the buffer, and
+    frames are handed out as memoryviews of it, so a message is copied
+    once, by the kernel. A payload stays valid only until the next call
+    to read_frame() and must be decoded before then. Frames larger than
+    the buffer are received into a buffer of their own.
+
+    Unlike a file made with socket.makefile(), the reader can still be
+    used after a socket timeout: nothing that was received is lost.
+    """
+
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0      # first byte not handed out yet
+        self.end = 0        # end of the received data
+        self.scanned = 0    # bytes after start known not to hold a newline
+
+    def read_frame(self):
+        """Return (codec, payload), or (None, b"") when the peer closed."""
+        while True:
+            frame = self._next_frame()
+            if frame is not None:
+                return frame
+            if not self._receive():
+                if self.end > self.start:
+                    raise CodecError("Connection closed in the middle of a frame")
+                return None, b""
+
+    def buffered(self):
+        """Return the number of received bytes not handed out yet."""
+        return self.end - self.start
+
+    # Private methods
+
+    def _next_frame(self):
+        start, end = self.start, self.end
+        if start == end:
+            return None
+        if self.buffer[start] != MAGIC:
+            newline = self.buffer.find(b"\n", start + self.scanned, end)
+            if newline < 0:
+                self.scanned = end - start
+                return None
+            self.start = newline + 1
+            self.scanned = 0
+            return JSON, self.view[start:newline + 1]
+        if end - start < HEADER.size:
+            return None
+        magic, flags, length = HEADER.unpack_from(self.buffer, start)
+        codec = frame_codec(flags)
+        first = start + HEADER.size
+        if first + length <= end:
+            self.start = first + length
+            return codec, self.view[first:first + length]
+        if length > len(self.buffer) - HEADER.size:
+            return codec, self._read_large(first, length)
+        return None
+
+    def _read_large(self, first, length):
+        """Receive a frame that does not fit in the buffer."""
+        payload = bytearray(length)
+        view = memoryview(payload)
+        got = self.end - first
+        view[:got] = self.view[first:self.end]
+        self.start = self.end = self.scanned = 0
+        while got < length:
+            n = self.sock.recv_into(view[got:])
+            if n == 0:
+                raise CodecError("Connection closed in the middle of a frame")
+            got += n
+        return view
+
+    def _receive(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            # Move the partial frame to the front to make room.
+            size = self.end - self.start
+            if self.start == 0:
+                # A JSON line longer than the buffer.
+                self._grow()
+            else:
+                self.buffer[:size] = self.view[self.start:self.end]
+                self.start, self.end = 0, size
+        n = self.sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n > 0
+
+    def _grow(self):
+        bigger = bytearray(2 * len(self.buffer))
+        bigger[:self.end] = self.view[:self.end]
+        self.buffer = bigger
+        self.view = memoryview(bigger)
+
+
+def read_frame(reader):
+    """Read one message from a buffered binary stream.
+
+    Return (codec, payload), or (None, b"") when the stream is closed.
+    """
+    first = reader.peek(1)[:1]
+    if not first:
+        return None, b""
+    if first[0] != MAGIC:
+        return JSON, reader.readline()
+    header = _read_exact(reader, HEADER.size)
+    magic, flags, length = HEADER.unpack(header)
+    codec = frame_codec(flags)
+    return codec, _read_exact(reader, length)
+
+
+def split_frames(buffer):
+    """Cut the complete messages out of a receive buffer.
+
+    Return a list of (codec, payload) and the number of bytes they took,
+    which the caller removes from the front of the buffer. Nothing is
+    copied while a large frame is still incomplete.
+    """
+    frames = []
+    start = 0
+    size = len(buffer)
+    while start < size:
+        if buffer[start] == MAGIC:
+            if size - start < HEADER.size:
+                break
+            magic, flags, length = HEADER.unpack_from(buffer, start)
+            codec = frame_codec(flags)
+            end = start + HEADER.size + length
+            if end > size:
+                break
+            frames.append((codec, buffer[start + HEADER.size:end]))
+        else:
+            newline = buffer.find(b"\n", start)
+            if newline < 0:
+                break
+            end = newline + 1
+            frames.append((JSON, buffer[start:end]))
+        start = end
+    return frames, start
+
+
+def _read_exact(reader, size):
+    data = reader.read(size)
+    if len(data) != size:
+        raise CodecError("Connection closed in the middle of a frame")
+    return data
@@ -0,0 +1,99 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Fixed-size pool of worker threads fed from a bounded queue.
+
+Used by orb.PooledSkeleton instead of starting one thread per incoming
+connection. When the queue is full new work is refused rather than
+queued without limit, and the caller decides how to report it.
+"""
+
+import queue
+import threading
+import time
+import logging
+import traceback
+
+
+class WorkerPool(object):
+
+    """Run submitted callables on a fixed set of worker threads.
+
+    Public methods:
+        --  __init__(workers, max_queue)
+        --  submit(fn, *args)
+        --  stats()
+
+    """
+
+    def __init__(self, workers=8, max_queue=256):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.tasks = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        # Metrics
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.active = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        for i in range(workers):
+            worker = threading.Thread(target=self._work,
+                                      name="worker-{}".format(i))
+            worker.daemon = True
+            worker.start()
+
+    # Public methods
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) for a worker. Return False if the queue is full."""
+        try:
+            self.tasks.put_nowait((fn, args, time.monotonic()))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.tasks.qsize())
+        return True
+
+    def stats(self):
+        """Return a snapshot of the queue depth and wait time metrics."""
+        with self.lock:
+            started = self.completed + self.active
+            return {
+                "workers": self.workers,
+                "active": self.active,
+                "queue_depth": self.tasks.qsize(),
+                "max_queue": self.max_queue,
+                "max_queue_depth": self.max_depth,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait": self.total_wait / started if started else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+    # Private methods
+
+    def _work(self):
+        while True:
+            fn, args, queued_at = self.tasks.get()
+            wait = time.monotonic() - queued_at
+            with self.lock:
+                self.active += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                fn(*args)
+            except Exception:
+                logging.info(traceback.format_exc())
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.completed += 1
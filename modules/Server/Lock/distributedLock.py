@@ -31,6 +31,7 @@ The implementation should satisfy the following requests:
 from threading import Lock
 import time
 from collections import Counter
+from Common import tracing
 
 NO_TOKEN = 0
 TOKEN_PRESENT = 1
@@ -150,13 +151,18 @@ class DistributedLock(object):
 
             self.request[self.owner.id]=self.time
 
-            for peer in self.peer_list.get_peers().values():
-                peer.request_token(self.time,self.owner.id)
+            # The acknowledgements carry no information, so the requests
+            # are sent one-way and we only wait for the token itself.
+            outcome = self.peer_list.broadcast("request_token", self.time,
+                                               self.owner.id, oneway=True)
+            for pid, err in outcome.errors.items():
+                print("Could not request the token from peer {}: {}".format(pid, err))
 
             # If we acquired the token while requesting, this will pass immediately
             print("Status is {}. Waiting for token...".format(self.state))
-            while self.state == NO_TOKEN:
-                time.sleep(1)
+            with tracing.span("wait_for_token"):
+                while self.state == NO_TOKEN:
+                    time.sleep(1)
 
         # If we do have the token, we can just silently acquire it
         # If we have it but someone else asked for it, this should be
@@ -257,14 +263,20 @@ class DistributedLock(object):
                 break
 
         if targetID is not None:
-            try:
-                self._clean_token()
-                self.state = NO_TOKEN
-                self.peer_list.get_peers()[pid].obtain_token(self.token)
-                wasSent = True
-            except Exception as e:
-                print("ERROR: Could not send token to pid",pid)
-                print(e)
+            stub = self._find_peer(targetID)
+            if stub is None:
+                print("ERROR: Could not find peer", targetID)
+            else:
+                try:
+                    self._clean_token()
+                    self.state = NO_TOKEN
+                    stub.obtain_token(self.token)
+                    wasSent = True
+                except Exception as e:
+                    # Keep the token rather than lose it.
+                    self.state = TOKEN_PRESENT
+                    print("ERROR: Could not send token to pid", targetID)
+                    print(e)
 
         self.localLock.release()
 
@@ -297,11 +309,28 @@ class DistributedLock(object):
             except Exception as e:
                 print("ERROR: Could not forcibly send token to pid {}:".format(pid))
                 print(e)
+        if not wasSent:
+            self.state = TOKEN_PRESENT
 
         self.localLock.release()
 
         return(wasSent)
 
+    def _find_peer(self, pid):
+        """Return the stub of peer pid, or None if there is no such peer.
+
+        A peer that just joined may ask for the token before the name
+        service told us about it, so unknown peers are looked up first.
+        """
+        peer = self.peer_list.get_peers().get(pid)
+        if peer is None:
+            try:
+                self.peer_list.refresh()
+            except Exception as e:
+                print("ERROR: Could not fetch the peers:", e)
+            peer = self.peer_list.get_peers().get(pid)
+        return peer
+
     def display_status(self):
         """Print the status of this peer."""
         self.localLock.acquire()
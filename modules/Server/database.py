@@ -11,8 +11,11 @@
 
 """Implementation of a simple database class."""
 
+import os
 import random
 
+SEPARATOR = '\n%\n'
+
 
 class Database(object):
 
@@ -23,10 +26,11 @@ class Database(object):
         self.rand = random.Random()
         self.rand.seed()
         
-        db = open(self.db_file,'r')
+        db = open(self.db_file,'rb')
         contents = db.read()
         db.close()
-        self.fortunes = str.split(contents,'\n%\n')
+        self.size = len(contents)   # Bytes of the file loaded so far
+        self.fortunes = str.split(contents.decode('utf-8'), SEPARATOR)
         self.fortunes=self.fortunes[:-1] # Remove empty fortune at end
         
     def read(self):
@@ -39,6 +43,28 @@ class Database(object):
         self.fortunes.append(fortune)
         
         # Append to file
-        db = open(self.db_file,'a')
-        db.write(fortune+'\n%\n')
-        db.close()
\ No newline at end of file
+        record = (fortune + SEPARATOR).encode('utf-8')
+        db = open(self.db_file,'ab')
+        db.write(record)
+        db.close()
+        self.size += len(record)
+
+    def refresh(self):
+        """Load the fortunes another process has appended to the file.
+
+        Only complete records are loaded; a fortune still being written
+        is picked up by a later call.
+        """
+        size = os.path.getsize(self.db_file)
+        if size <= self.size:
+            return
+        db = open(self.db_file,'rb')
+        db.seek(self.size)
+        data = db.read(size - self.size)
+        db.close()
+        end = data.rfind(SEPARATOR.encode('utf-8'))
+        if end < 0:
+            return
+        end += len(SEPARATOR)
+        self.fortunes.extend(data[:end].decode('utf-8').split(SEPARATOR)[:-1])
+        self.size += end
\ No newline at end of file
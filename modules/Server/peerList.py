@@ -12,87 +12,239 @@
 import threading
 import copy
 import logging
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
 from Common import orb
+from Common import failureDetector
+from Server import swimMembership
 
 logging.basicConfig(format="%(levelname)s:%(filename)s: %(message)s",
                     level=logging.INFO)
 
+# Value of broadcast()'s need argument asking for a majority of the peers.
+QUORUM = "quorum"
+
+# Seconds between two requests for the changes of the group.
+RESYNC = 5.0
+
+
+def _remaining(deadline):
+    """Seconds left until deadline, never negative; None if there is none."""
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+class BroadcastResult(object):
+
+    """Outcome of PeerList.broadcast().
+
+    results maps the id of every peer that answered to its answer (None
+    for one-way calls that were sent), errors maps the id of every peer
+    whose call failed to the exception, and missing holds the ids of the
+    peers that had not answered when the broadcast returned.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.results = {}
+        self.errors = {}
+        self.missing = set()
+
+    @property
+    def complete(self):
+        """True if every peer answered without an error."""
+        return not self.errors and not self.missing
+
+    def raise_error(self):
+        """Raise the error of one of the failed calls, if there is any."""
+        for pid in sorted(self.errors):
+            raise self.errors[pid]
+
+    def __repr__(self):
+        return "BroadcastResult({}, results={}, errors={}, missing={})".format(
+            self.method, self.results, self.errors, sorted(self.missing))
+
+
 class PeerList(object):
 
-    """Class that builds a list of objects of the same type as this one."""
+    """Class that builds a list of objects of the same type as this one.
+
+    Joins and leaves are pushed by the name service; the list also asks
+    for the changes it missed every RESYNC seconds, which subscribes it
+    again after the name service was restarted.
+
+    The peers in the list are watched by a failure detector running in
+    the background; peers it finds dead are unregistered from the owner.
+    The next resync then fetches all the members of the group, and
+    registers again those the name service still lists: they were only
+    slow, or their lease would have run out too.
+    With gossip, the detector is a swimMembership.SwimMembership, which
+    also registers the peers it hears about from the others; the owner
+    must then dispatch swim_ping and swim_ping_req to this list.
+    """
 
-    def __init__(self, owner):
+    def __init__(self, owner, gossip=False):
         self.owner = owner
         self.lock = threading.Condition()
         self.peers = {} # ID -> STUB
+        self.sync_lock = threading.Lock()
+        self.version = None     # of the group, as last heard of
+        self.evicted = set()    # ids of the peers the detector removed
+        self.resync_stop = threading.Event()
+        self.resync = threading.Thread(target=self._resync, name="resync")
+        self.resync.daemon = True
+        if gossip:
+            self.detector = swimMembership.SwimMembership(
+                owner, on_dead=self._peer_evicted, on_join=self._peer_joined)
+        else:
+            self.detector = failureDetector.FailureDetector(
+                on_dead=self._peer_evicted)
 
     # Public methods
 
     def initialize(self):
-        """Populates the list of existing peers and registers the current
-        peer at each of the discovered peers.
+        """Populates the list of existing peers and starts following the
+        changes of the group.
 
-        It only adds the peers with lower ids than this one or else
-        deadlocks may occur. This method must be called after the owner
-        object has been registered with the name service.
+        The peers are taken from a snapshot returned by the watch() of
+        the name service, which then pushes every later join and leave
+        to membership_changed(). So this peer does not have to announce
+        itself to the others: its registration does. This method must be
+        called after the owner object has been registered with the name
+        service.
 
         """
+        version, _, deltas = self.owner.name_service.watch(
+            self.owner.type, None, list(self.owner.address))
+        with self.sync_lock:
+            for _, kind, peer_id, peer_addr, peer_local in deltas:
+                if kind == "join" and peer_id != self.owner.id:
+                    self.register_peer(peer_id, peer_addr, peer_local)
+            self.version = version
+        self.detector.start()
+        self.resync.start()
 
-        # This isn't just some dumb function,
-        # This should actually handle contacting the nameserver
-        # And receiving the list of peers from it.
+    def destroy(self):
+        """Stop following the group.
 
-        try:
-            self.lock.acquire()
-            # Get the owner's access to the name server
-            name_service = self.owner.name_service
-
-            # Get the list of peers from the name service
-            # We get a list of tuples from the name service
-            # of the format (id, addr)
-            peer_set = name_service.get_peers(self.owner.type)
-        except:
-            self.lock.release()
-            raise
+        The other peers hear that this one left from the name service,
+        once the owner has unregistered.
+        """
+        self.detector.stop()
+        self.resync_stop.set()
 
-        # We need to make sure we release the lock if things go well, too.
-        self.lock.release()
-        
-        # Using the list of tuples, register the peers
-        # Then register itself with each peer registered
-        for peer_tuple in peer_set:
-            peer_id, peer_addr = peer_tuple
-            if peer_id != self.owner.id:
-                self.register_peer(peer_id, peer_addr,
-                # We're just spawning, we don't need to check if they've died
-                                   False) 
-                self.peers[peer_id].register_peer(self.owner.id, self.owner.address)
+    def membership_changed(self, obj_type, deltas):
+        """Apply changes of the group pushed by the name service."""
+        with self.sync_lock:
+            if self.version is None:
+                # Not initialized yet; the snapshot will cover them.
+                return
+            for delta in deltas:
+                if delta[0] <= self.version:
+                    continue
+                if delta[0] != self.version + 1:
+                    # Missed a change; fetch all of them instead.
+                    self._sync()
+                    return
+                self._apply(delta)
+                self.version = delta[0]
 
-    def destroy(self):
-        """Unregister this peer from all others in the list."""
-        # If we tell a dead peer to unregister us, we'll crash
-        self.check_all_alive()
+    def refresh(self):
+        """Apply the changes of the group the name service has not
+        pushed to us yet."""
+        with self.sync_lock:
+            self._sync()
+
+    def broadcast(self, method, *args, timeout=None, need=None, oneway=False):
+        """Call method(*args) on all the peers in parallel.
 
+        Every call is started before any answer is waited for. Return a
+        BroadcastResult once all the peers have answered, or earlier if
+
+            --  timeout seconds have passed; peers that have not answered
+                yet are listed as missing.
+            --  need peers have answered successfully. need is a number
+                of answers or QUORUM, a majority of the peers called.
+
+        One-way calls only wait until every message has been sent, or
+        until timeout. Connections that are not open yet are opened on
+        helper threads, so a peer that does not answer cannot hold the
+        caller past timeout.
+        """
         self.lock.acquire()
         try:
-            # Ask all the other peers to deregister us
-            for fellowPeer in self.peers.keys():
-                self.peers[fellowPeer].unregister_peer(self.owner.id)
+            peers = dict(self.peers)
         finally:
             self.lock.release()
 
-    def register_peer(self, pid, paddr, doubleChecking=True):
-        """Register a new peer joining the network."""
-        if doubleChecking:
-            self.check_all_alive()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        outcome = BroadcastResult(method)
+        if oneway:
+            sends = {}
+            for pid, stub in peers.items():
+                def failed(err, pid=pid):
+                    outcome.errors[pid] = err
+                if stub.connected():
+                    if stub.call_oneway(method, *args, on_failure=failed,
+                                        timeout=_remaining(deadline)):
+                        outcome.results[pid] = None
+                    continue
+                send = orb.call_in_thread(stub.call_oneway, method, *args,
+                                          on_failure=failed,
+                                          timeout=_remaining(deadline))
+                sends[send] = pid
+            done, pending = wait(sends, _remaining(deadline))
+            for send in done:
+                if send.result():
+                    outcome.results[sends[send]] = None
+            outcome.missing = {sends[send] for send in pending}
+            return outcome
+
+        if need == QUORUM:
+            need = len(peers) // 2 + 1
+        calls = {}
+        for pid, stub in peers.items():
+            try:
+                calls[stub.call_async(method, *args,
+                                      timeout=_remaining(deadline))] = pid
+            except Exception as err:
+                outcome.errors[pid] = err
+
+        pending = set(calls)
+        while pending:
+            if need is not None and (len(outcome.results) >= need or
+                                     len(outcome.results) + len(pending) < need):
+                # Enough answers, or too many failures to ever get them.
+                break
+            remaining = _remaining(deadline)
+            if remaining == 0:
+                break
+            done, pending = wait(pending, remaining, FIRST_COMPLETED)
+            for call in done:
+                try:
+                    outcome.results[calls[call]] = call.result()
+                except Exception as err:
+                    outcome.errors[calls[call]] = err
+        outcome.missing = {calls[call] for call in pending}
+        return outcome
+
+    def register_peer(self, pid, paddr, local=None):
+        """Register a new peer joining the network.
 
+        local is the Unix socket the peer advertised, if any; it is used
+        instead of TCP when the peer runs on this host.
+        """
         # Synchronize access to the peer list as several peers might call
         # this method in parallel.
         self.lock.acquire()
         try:
-            self.peers[pid] = orb.Stub(paddr)
+            stub = orb.Stub(paddr, timeout=orb.PEER_TIMEOUT)
+            stub.pool.advertise(paddr, local)
+            self.peers[pid] = stub
         finally:
             self.lock.release()
+        self.detector.monitor(pid, stub, pid, self.owner.type)
 
     def unregister_peer(self, pid):
         """Unregister a peer leaving the network."""
@@ -108,9 +260,7 @@ class PeerList(object):
                 raise Exception("No peer with id: '{}'".format(pid))
         finally:
             self.lock.release()
-
-        # Ought to be up-to-date.
-        self.check_all_alive()
+        self.detector.forget(pid)
 
     def display_peers(self):
         """Display all the peers in the list."""
@@ -118,10 +268,12 @@ class PeerList(object):
         self.lock.acquire()
         try:
             pids = sorted(self.peers.keys())
+            states = self.detector.view()
             print("List of peers of type '{}':".format(self.owner.type))
             for pid in pids:
                 addr = self.peers[pid].address
-                print("    id: {:>2}, address: {}".format(pid, addr))
+                print("    id: {:>2}, address: {}, {}".format(
+                    pid, addr, states.get(pid, failureDetector.DEAD)))
         finally:
             self.lock.release()
 
@@ -143,20 +295,77 @@ class PeerList(object):
         finally:
             self.lock.release()
 
-    def check_alive(self, pID):
-        """ Checks whether a peer has disconnected without telling us. """
-        logging.debug("PeerList confirming connections to Peer {}.".format(pID))
-        alive = orb.checkLiveness(pID, self.get_peer(pID), self.owner.type)
-        if not alive:
-            logging.debug("Confirmed {} is not alive.".format(pID))
-            self.owner.unregister_peer(pID)
-
-    def check_all_alive(self):
-        """ Checks whether any peer has disconnected without telling us. """
-        logging.debug("PeerList confirming connections to all peers.")
-        allPeers = self.get_peers()
-        for pID in list(allPeers.keys()):
-            alive = orb.checkLiveness(pID, allPeers[pID], self.owner.type)
-            if not alive:
-                logging.debug("Confirmed {} is not alive.".format(pID))
-                self.owner.unregister_peer(pID)
+    def peer_states(self):
+        """Return {pid: ALIVE or SUSPECT} as seen by the failure detector."""
+        return self.detector.view()
+
+    def swim_ping(self, sender, updates):
+        """Answer a gossip ping (gossip membership only)."""
+        return self.detector.ping(sender, updates)
+
+    def swim_ping_req(self, sender, target, updates):
+        """Ping target for sender (gossip membership only)."""
+        return self.detector.ping_req(sender, target, updates)
+
+    # Private methods
+
+    def _peer_died(self, pid):
+        try:
+            self.owner.unregister_peer(pid)
+        except Exception as err:
+            # Unregistered in the meantime.
+            logging.debug("Could not unregister Peer {}: {}".format(pid, err))
+
+    def _peer_evicted(self, pid):
+        with self.lock:
+            self.evicted.add(pid)
+        self._peer_died(pid)
+
+    def _apply(self, delta):
+        _, kind, pid, paddr, local = delta
+        if pid == self.owner.id:
+            return
+        with self.lock:
+            known = pid in self.peers
+        if kind == "join" and not known:
+            self.owner.register_peer(pid, paddr, local)
+        elif kind == "leave" and known:
+            self._peer_died(pid)
+
+    def _sync(self):
+        """Fetch the changes since self.version, or all the members if
+        the detector removed peers since the last time. Needs
+        self.sync_lock."""
+        with self.lock:
+            evicted, self.evicted = self.evicted, set()
+        since = None if evicted else self.version
+        try:
+            version, snapshot, deltas = self.owner.name_service.watch(
+                self.owner.type, since, list(self.owner.address))
+        except:
+            with self.lock:
+                self.evicted |= evicted
+            raise
+        for delta in deltas:
+            # A snapshot cannot tell who left; the failure detector will.
+            if not snapshot or delta[1] == "join":
+                if delta[1] == "join" and delta[2] in evicted:
+                    logging.info("Peer {} is still registered; adding it "
+                                 "again.".format(delta[2]))
+                self._apply(delta)
+        self.version = version
+
+    def _resync(self):
+        while not self.resync_stop.wait(RESYNC):
+            try:
+                with self.sync_lock:
+                    self._sync()
+            except Exception as err:
+                logging.debug("Could not fetch the changes of the group: {}"
+                              .format(err))
+
+    def _peer_joined(self, pid, paddr, local):
+        with self.lock:
+            if pid in self.peers:
+                return
+        self.owner.register_peer(pid, paddr, local)
@@ -0,0 +1,131 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Worker processes serving reads next to a database server.
+
+A Skeleton runs all its requests in one process, so decoding requests
+and reading the database never use more than one core at a time. A
+server can instead fork worker processes that listen to its address as
+well (SO_REUSEPORT); the kernel spreads the incoming connections over
+the server and its workers.
+
+--  ReadWorker ::
+        Owner of the skeleton of a worker process. Reads are served from
+        the worker's own copy of the database, which picks up the
+        fortunes appended to the file by the server. Every other call
+        (writes, lock traffic, liveness checks) is forwarded to the
+        server, the coordinator, which alone owns the distributed lock
+        and is registered with the name service.
+
+Workers reach the coordinator through its Unix domain socket only, so a
+forwarded call can never land on another worker. Reads served by a
+worker do not take the read lock of the coordinator and may miss a
+write that is still in progress.
+"""
+
+import os
+import time
+import logging
+import threading
+import multiprocessing
+
+from Common import orb
+from Common import connectionPool
+from Common.asyncOrb import AsyncSkeleton
+from Server import database
+
+
+class _CoordinatorPool(connectionPool.ConnectionPool):
+
+    """Connection pool that only ever connects to the coordinator's socket."""
+
+    def __init__(self, path):
+        connectionPool.ConnectionPool.__init__(self)
+        self.path = path
+
+    def connect(self, address, timeout=None):
+        return connectionPool.open_socket(address, timeout, self.path)
+
+
+class ReadWorker(object):
+
+    """Serve reads locally and forward the other calls to the coordinator.
+
+    Only the calls in FORWARDED are forwarded; those of them the
+    coordinator serves as priority calls are priority calls here too, as
+    they wait for it.
+    """
+
+    FORWARDED = frozenset([
+        "write", "write_local", "isAlive", "acquire", "release",
+        "request_token", "obtain_token", "membership_changed",
+        "swim_ping", "swim_ping_req", "display_peers", "display_status",
+    ])
+
+    priority_methods = frozenset([
+        "isAlive", "request_token", "obtain_token", "membership_changed",
+        "swim_ping", "swim_ping_req", "write_local",
+    ])
+
+    def __init__(self, db_file, coordinator_address, coordinator_path):
+        self.db = database.Database(db_file)
+        self.lock = threading.Lock()
+        self.coordinator = orb.Stub(coordinator_address,
+                                    pool=_CoordinatorPool(coordinator_path))
+        self.skeleton = None
+
+    # Public methods
+
+    def read(self):
+        """Read a fortune from this worker's copy of the database."""
+        with self.lock:
+            self.db.refresh()
+            return self.db.read()
+
+    def __getattr__(self, attr):
+        """Calls this worker does not serve are forwarded."""
+        if attr not in self.FORWARDED:
+            raise AttributeError(
+                "ReadWorker instance has no attribute '{}'".format(attr))
+
+        def forward(*args):
+            return self.coordinator.call(attr, *args)
+        return forward
+
+
+def _run(address, db_file, coordinator_path, workers, use_asyncio):
+    owner = ReadWorker(db_file, address, coordinator_path)
+    if use_asyncio:
+        skeleton = AsyncSkeleton(owner, address, workers=workers or 32,
+                                 reuse_port=True)
+    elif workers:
+        skeleton = orb.PooledSkeleton(owner, address, workers, reuse_port=True)
+    else:
+        skeleton = orb.Skeleton(owner, address, reuse_port=True)
+    owner.skeleton = skeleton
+    skeleton.start()
+    logging.info("Read worker {} listening to {}".format(os.getpid(), address))
+    # Stop with the coordinator, even if it was killed.
+    parent = os.getppid()
+    while os.getppid() == parent:
+        time.sleep(1.0)
+
+
+def start_workers(count, address, db_file, workers=None, use_asyncio=False):
+    """Fork count read workers listening to address; return the processes.
+
+    Must be called before the coordinator starts any thread. The
+    coordinator must then listen to address with reuse_port, and to the
+    Unix socket given by connectionPool.local_socket_path(address).
+    """
+    context = multiprocessing.get_context("fork")
+    path = connectionPool.local_socket_path(address)
+    processes = []
+    for _ in range(count):
+        process = context.Process(target=_run, args=(address, db_file, path,
+                                                     workers, use_asyncio))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    return processes
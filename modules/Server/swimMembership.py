@@ -0,0 +1,325 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""SWIM-style gossip membership, a failure detection backend for PeerList.
+
+Instead of every peer probing every other peer, each protocol period a
+peer pings one member, chosen round robin over a shuffled list:
+
+--  ping ::
+        swim_ping(sender, updates) is sent to the member. Its answer
+        carries updates of its own.
+--  indirect ping ::
+        If the member does not answer in time, k other members are
+        asked to ping it with swim_ping_req(sender, target, updates).
+        If none of them gets an answer either, the member is suspected.
+--  suspicion ::
+        A suspected member that does not refute the suspicion within a
+        few periods (more in larger groups) is declared dead.
+
+Membership changes are not sent in messages of their own. They are
+piggybacked on the pings and their answers as updates
+[kind, pid, incarnation, address, local], kind being "alive", "suspect"
+or "dead", and every update is passed on about LAMBDA * log(n) times.
+A member that hears it is suspected or dead refutes it by gossiping
+"alive" with a higher incarnation number. A member that hears about an
+unknown live peer reports it through on_join; peers that left or died
+only come back with a higher incarnation.
+
+So every peer sends a constant number of messages per period, whatever
+the size of the group, and news reaches everybody in O(log n) periods.
+"""
+
+import math
+import random
+import threading
+import time
+import logging
+import traceback
+from concurrent.futures import wait
+
+from Common import orb
+
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
+PERIOD = 1.0        # seconds per protocol period
+INDIRECT = 3        # members asked to ping a member that did not answer
+LAMBDA = 3          # an update is passed on LAMBDA * log(n + 1) times
+SUSPICION = 3       # periods per log(n + 1) before a suspect is dead
+MAX_UPDATES = 8     # updates piggybacked on one message
+
+
+class _Member(object):
+
+    """What this peer knows about another one."""
+
+    def __init__(self, stub, address, local, incarnation):
+        self.stub = stub
+        self.address = address
+        self.local = local
+        self.incarnation = incarnation
+        self.state = ALIVE
+        self.suspected = None   # time.monotonic() of the suspicion
+
+
+class SwimMembership(object):
+
+    """Failure detection and membership dissemination by gossip.
+
+    Offers the interface of failureDetector.FailureDetector, so that
+    PeerList can use either of them, plus the handlers of the two
+    remote calls of the protocol.
+
+    Public methods:
+        --  __init__(owner, on_dead, on_join)
+        --  start()
+        --  stop()
+        --  monitor(key, stub, pid, obj_type)
+        --  forget(key)
+        --  view()
+        --  ping(sender, updates)
+        --  ping_req(sender, target, updates)
+
+    """
+
+    def __init__(self, owner, on_dead=None, on_join=None, period=PERIOD):
+        self.owner = owner
+        self.on_dead = on_dead
+        self.on_join = on_join
+        self.period = period
+        self.lock = threading.Lock()
+        self.members = {}       # pid -> _Member
+        self.updates = {}       # pid -> [update, times passed on]
+        self.gone = {}          # pid -> incarnation it left or died with
+        self.incarnation = 0
+        self.order = []         # pids left to ping this round
+        self.rand = random.Random()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Public methods
+
+    def start(self):
+        """Announce this peer and start the protocol."""
+        with self.lock:
+            self._announce()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="swim")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def monitor(self, key, stub, pid, obj_type):
+        with self.lock:
+            member = self.members.get(pid)
+            if member is None:
+                self.members[pid] = _Member(stub, stub.address, None, 0)
+            else:
+                member.stub = stub
+
+    def forget(self, key):
+        with self.lock:
+            member = self.members.pop(key, None)
+            if member is not None:
+                self.gone[key] = member.incarnation
+
+    def view(self):
+        """Return {pid: ALIVE or SUSPECT} for all the known members."""
+        with self.lock:
+            return {pid: m.state for pid, m in self.members.items()}
+
+    def ping(self, sender, updates):
+        """Handle a ping; answer with updates for the sender."""
+        self._merge(updates)
+        with self.lock:
+            return self._piggyback()
+
+    def ping_req(self, sender, target, updates):
+        """Ping target for sender; return [acknowledged, updates]."""
+        self._merge(updates)
+        with self.lock:
+            member = self.members.get(target)
+        acked = member is not None and self._ping(target, member,
+                                                  self.period / 2)
+        with self.lock:
+            return [acked, self._piggyback()]
+
+    # Private methods
+
+    def _run(self):
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                self._expire_suspects()
+                self._probe_next()
+            except Exception:
+                logging.info(traceback.format_exc())
+            self.stopped.wait(max(0.0, started + self.period - time.monotonic()))
+
+    def _probe_next(self):
+        with self.lock:
+            if not self.order:
+                self.order = list(self.members)
+                self.rand.shuffle(self.order)
+            target = None
+            while self.order and target is None:
+                pid = self.order.pop()
+                if pid in self.members:
+                    target = pid
+            if target is None:
+                return
+            member = self.members[target]
+        if self._ping(target, member, self.period / 2):
+            return
+        if self._ping_indirectly(target, self.period / 2):
+            return
+        with self.lock:
+            if self.members.get(target) is member and member.state == ALIVE:
+                self._suspect(target, member)
+
+    def _ping(self, pid, member, timeout):
+        with self.lock:
+            updates = self._piggyback()
+        try:
+            answer = member.stub.call("swim_ping", self.owner.id, updates,
+                                      timeout=timeout)
+        except Exception as err:
+            logging.debug("Ping of Peer {} failed: {}".format(pid, err))
+            return False
+        self._merge(answer)
+        return True
+
+    def _ping_indirectly(self, target, timeout):
+        with self.lock:
+            helpers = [m for pid, m in self.members.items()
+                       if pid != target and m.state == ALIVE]
+            helpers = self.rand.sample(helpers, min(INDIRECT, len(helpers)))
+            updates = self._piggyback()
+        if not helpers:
+            return False
+        calls = []
+        for helper in helpers:
+            try:
+                calls.append(helper.stub.call_async(
+                    "swim_ping_req", self.owner.id, target, updates,
+                    timeout=timeout))
+            except Exception as err:
+                logging.debug("Could not ask for an indirect ping: {}".format(err))
+        done, _ = wait(calls, timeout)
+        acked = False
+        for call in done:
+            try:
+                ack, answer = call.result()
+            except Exception:
+                continue
+            self._merge(answer)
+            acked = acked or ack
+        return acked
+
+    def _expire_suspects(self):
+        dead = []
+        now = time.monotonic()
+        with self.lock:
+            limit = self.period * SUSPICION * math.log(len(self.members) + 1)
+            limit = max(limit, 3 * self.period)
+            for pid, member in list(self.members.items()):
+                if member.state == SUSPECT and now - member.suspected > limit:
+                    self._remove(pid, member)
+                    dead.append(pid)
+        for pid in dead:
+            self._declare_dead(pid)
+
+    def _suspect(self, pid, member):
+        logging.info("Suspecting Peer {}.".format(pid))
+        member.state = SUSPECT
+        member.suspected = time.monotonic()
+        self._queue(SUSPECT, pid, member)
+
+    def _announce(self):
+        """Queue an update telling everybody this peer is alive."""
+        self.updates[self.owner.id] = [
+            [ALIVE, self.owner.id, self.incarnation, list(self.owner.address),
+             self.owner.local_address], 0]
+
+    def _remove(self, pid, member):
+        del self.members[pid]
+        self.gone[pid] = member.incarnation
+        self._queue(DEAD, pid, member)
+
+    def _queue(self, kind, pid, member):
+        self.updates[pid] = [[kind, pid, member.incarnation,
+                              list(member.address), member.local], 0]
+
+    def _piggyback(self):
+        """Return the updates to send along with a message."""
+        limit = int(math.ceil(LAMBDA * math.log(len(self.members) + 2)))
+        chosen = sorted(self.updates.items(), key=lambda item: item[1][1])
+        chosen = chosen[:MAX_UPDATES]
+        for pid, entry in chosen:
+            entry[1] += 1
+            if entry[1] >= limit:
+                del self.updates[pid]
+        return [entry[0] for pid, entry in chosen]
+
+    def _merge(self, updates):
+        joined = []
+        dead = []
+        with self.lock:
+            for kind, pid, incarnation, address, local in updates or []:
+                if pid == self.owner.id:
+                    if kind != ALIVE and incarnation >= self.incarnation:
+                        # Refute: we are alive.
+                        self.incarnation = incarnation + 1
+                        self._announce()
+                    continue
+                member = self.members.get(pid)
+                if kind == ALIVE:
+                    if member is None:
+                        if incarnation <= self.gone.get(pid, -1):
+                            # Old news about a peer that has left.
+                            continue
+                        stub = orb.Stub(address, timeout=orb.PEER_TIMEOUT)
+                        stub.pool.advertise(address, local)
+                        member = _Member(stub, tuple(address), local, incarnation)
+                        self.members[pid] = member
+                        self._queue(ALIVE, pid, member)
+                        joined.append((pid, address, local))
+                    elif incarnation > member.incarnation:
+                        member.incarnation = incarnation
+                        member.state = ALIVE
+                        self._queue(ALIVE, pid, member)
+                elif kind == SUSPECT:
+                    if member is None:
+                        continue
+                    if (incarnation > member.incarnation or
+                            (incarnation == member.incarnation and
+                             member.state == ALIVE)):
+                        member.incarnation = incarnation
+                        self._suspect(pid, member)
+                elif kind == DEAD:
+                    if member is None or incarnation < member.incarnation:
+                        continue
+                    self._remove(pid, member)
+                    dead.append(pid)
+        for pid, address, local in joined:
+            logging.info("Peer {} joined at {}.".format(pid, tuple(address)))
+            if self.on_join is not None:
+                try:
+                    self.on_join(pid, address, local)
+                except Exception:
+                    logging.info(traceback.format_exc())
+        for pid in dead:
+            self._declare_dead(pid)
+
+    def _declare_dead(self, pid):
+        logging.info("Peer {} is considered dead.".format(pid))
+        if self.on_dead is not None:
+            try:
+                self.on_dead(pid)
+            except Exception:
+                logging.info(traceback.format_exc())